@@ -1,117 +1,916 @@
 #!/usr/bin/python -tt
 from __future__ import absolute_import
 from __future__ import print_function
+import time
+STARTED = time.monotonic()        #for --profile-startup, before the imports
+
 from daemonpy.daemon import Daemon
 
 import configparser
 import logging
-from logging.handlers import TimedRotatingFileHandler
+import signal
 import sys
-import paho.mqtt.client as mqtt
-import time
+import simplejson as json
 import os
 
 import GoodWeCommunicator as goodwe
+import GoodWeCapture as capture
+import GoodWePublisher as publisher
+import GoodWeMetrics as metrics
 
-millis = lambda: int(round(time.time() * 1000))
+millis = goodwe.millis
 
 class GoodWeProcessor(object):
-    def run_process(self, foreground):
+
+    DEVICE_SCAN_INTERVAL = 30000    #look for added or removed inverters every 30 seconds without hotplug events
+    DEVICE_RESCAN_INTERVAL = 300000    #and every 5 minutes with, in case an event was missed
+    STATS_INTERVAL = 300000            #log the publisher statistics and publish /stats every 5 minutes
+
+    # settings a reload can't change while the daemon runs
+    RESTART_SETTINGS = ('vendorId', 'modelId', 'logfile', 'simulate', 'capturepath', 'capturemaxbytes', 'capturebackups',
+                        'cachefile', 'storepath', 'storeretention', 'storemaxbytes', 'metricsport', 'metricsaddress',
+                        'sinkoptions', 'controlsocket')
+    # settings that need a new MQTT connection
+    MQTT_SETTINGS = ('mqttserver', 'mqttport', 'mqttclientid', 'mqttusername', 'mqttpasswd', 'mqttqueuesize', 'mqttspoolfile',
+                     'mqttspoolmaxbytes')
+
+    # reported by --profile-startup, in this order
+    STARTUP_EVENTS = ('config', 'mqtt', 'loop', 'device open', 'first sample', 'first publish')
+
+    CONTROL_HELP = [
+        'status                          state of the communicators, the publisher and the sinks',
+        'set pollmin|pollmax <ms>        time between running info queries, until the next reload',
+        'set pollalign on|off            poll on the wall clock grid',
+        'set pollinterval <ms>           time between MQTT publishes',
+        'set loglevel <level>            DEBUG, INFO, WARNING or ERROR',
+        'rediscover [device ...]         register the inverters again without closing the devices',
+        'reload                          read /etc/goodwe.conf again, like SIGHUP',
+    ]
+
+    def __init__(self):
+        # state of the running daemon, the configuration is in loadConfig
+        self.changeFilters = {}
+        self.publishedInfo = {}
+        self.batches = {}
+        self.analytics = {}
+        self.sinks = []
+        self.loop = None
+        self.transportFactory = None
+        self.profileStartup = False
+        self.startupProfile = {}            #event -> seconds since the process started
+        self.stopping = False               #set by SIGTERM, the loop finishes and shuts down
+
+
+    def profileEvent(self, event):
+        if not self.profileStartup or event in self.startupProfile:
+            return
+        self.startupProfile[event] = time.monotonic() - STARTED
+        if len(self.startupProfile) == len(self.STARTUP_EVENTS):
+            logging.warning('Startup profile: %s', ', '.join('%s %.3f s' % (event, self.startupProfile[event]) for event in self.STARTUP_EVENTS))
+            self.profileStartup = False
+
+
+    def loadConfig(self):
         config = configparser.RawConfigParser()
         config.read('/etc/goodwe.conf')
         
-        mqttserver = config.get("mqtt", "server", fallback="localhost")
-        mqttport = config.getint("mqtt", "port", fallback=1883)
-        mqtttopic = config.get("mqtt", "topic", fallback="goodwe")
-        mqttclientid = config.get("mqtt", "clientid", fallback="goodwe-usb")
-        mqttusername = config.get("mqtt", "username", fallback="")
-        mqttpasswd = config.get("mqtt", "password", fallback=None) 
+        self.mqttserver = config.get("mqtt", "server", fallback="localhost")
+        self.mqttport = config.getint("mqtt", "port", fallback=1883)
+        self.mqtttopic = config.get("mqtt", "topic", fallback="goodwe")
+        self.mqttclientid = config.get("mqtt", "clientid", fallback="goodwe-usb")
+        self.mqttusername = config.get("mqtt", "username", fallback="")
+        self.mqttpasswd = config.get("mqtt", "password", fallback=None) 
+        self.mqttcompact = config.getboolean("mqtt", "compact", fallback=False)
+        # messages are published from a bounded queue, and spooled to disk while the broker is unreachable
+        self.mqttqueuesize = config.getint("mqtt", "queuesize", fallback=1000)
+        self.mqttspoolfile = config.get("mqtt", "spoolfile", fallback="")
+        self.mqttspoolmaxbytes = config.getint("mqtt", "spoolmaxbytes", fallback=10485760)
+        # full publishes the whole inverter document on /data every pollinterval. changes publishes the changed running info
+        # values as one document on /delta, fields publishes every changed value retained on its own topic. Both publish the
+        # full document every keyframeinterval ms and /online only when it changes. batch collects every sample and publishes
+        # them together on /batch, see [batch].
+        self.publishmode = config.get("mqtt", "publishmode", fallback="full")
+        if self.publishmode not in ('full', 'changes', 'fields', 'batch'):
+            raise ValueError('Invalid publish mode: %s' % self.publishmode)
+        self.keyframeinterval = config.getint("mqtt", "keyframeinterval", fallback=300000)
+        # [deadband] <field> = <minimal change to publish>, e.g. vpv1 = 0.5
+        self.deadbands = {}
+        if config.has_section("deadband"):
+            fields = dict((name.lower(), name) for name in goodwe.RunningInfo.__slots__)
+            for option in config.options("deadband"):
+                if option not in fields:
+                    raise ValueError('Invalid deadband field: %s' % option)
+                self.deadbands[fields[option]] = config.getfloat("deadband", option)
+
+        # a batch is published when it holds samples samples or its first sample is interval ms old, as json or msgpack
+        self.batchsamples = config.getint("batch", "samples", fallback=60)
+        self.batchinterval = config.getint("batch", "interval", fallback=60000)
+        self.batchformat = config.get("batch", "format", fallback="json")
+        if self.publishmode == 'batch':
+            # GoodWeBatch imports msgpack, only needed in batch mode
+            import GoodWeBatch as batch
+            if self.batchformat not in batch.FORMATS:
+                raise ValueError('Invalid batch format: %s' % self.batchformat)
+            if self.batchformat == 'msgpack' and batch.msgpack is None:
+                raise ValueError('Batch format msgpack needs the msgpack package')
 
         
-        loglevel = config.get("inverter", "loglevel", fallback="INFO")
-        interval = config.getint("inverter", "pollinterval", fallback=2500)
-        vendorId = config.get("inverter", "vendorId", fallback="0084")
-        modelId = config.get("inverter", "modelId", fallback="0041")
+        self.loglevel = config.get("inverter", "loglevel", fallback="INFO")
+        self.interval = config.getint("inverter", "pollinterval", fallback=2500)
+        # running info is queried every pollmin ms while the inverter produces, backing off to pollmax ms while it is idle or does not answer
+        self.pollmin = config.getint("inverter", "pollmin", fallback=goodwe.GoodWeCommunicator.POLL_MIN)
+        self.pollmax = config.getint("inverter", "pollmax", fallback=goodwe.GoodWeCommunicator.POLL_MAX)
+        if not 0 < self.pollmin <= self.pollmax < goodwe.GoodWeCommunicator.OFFLINE_TIMEOUT / 2:
+            raise ValueError('Invalid poll interval: pollmin %d, pollmax %d' % (self.pollmin, self.pollmax))
+        # query on wall clock multiples of the poll interval, so the samples of all inverters line up
+        self.pollalign = config.getboolean("inverter", "pollalign", fallback=True)
+        self.vendorId = config.get("inverter", "vendorId", fallback="0084")
+        self.modelId = config.get("inverter", "modelId", fallback="0041")
         
-        logfile = config.get("inverter", "logfile", fallback="/var/log/goodwe.log")
+        self.logfile = config.get("inverter", "logfile", fallback="/var/log/goodwe.log")
+
+        # raw HID reports of every device are captured to <capturepath>/<hidrawN>.cap when set
+        self.capturepath = config.get("inverter", "capturepath", fallback="")
+        self.capturemaxbytes = config.getint("inverter", "capturemaxbytes", fallback=10485760)
+        self.capturebackups = config.getint("inverter", "capturebackups", fallback=5)
+
+        # serial and address of the inverter on every device, so a restart resumes without discovery. Empty to disable.
+        self.cachefile = config.get("inverter", "cachefile", fallback="/var/tmp/goodwe-registrations.json")
+
+        # every sample is kept in a local store when a path is set, see GoodWeStore
+        self.storepath = config.get("store", "path", fallback="")
+        self.storeflushinterval = config.getint("store", "flushinterval", fallback=60000)
+        self.storeretention = {}
+        if self.storepath:
+            import GoodWeStore as store
+            self.storeretention = dict((resolution, config.getint("store", "retention" + resolution, fallback=days))
+                                       for resolution, days in store.Store.RETENTION.items())
+        self.storemaxbytes = config.getint("store", "maxbytes", fallback=0)
+
+        # metrics in the Prometheus format on http://<address>:<port>/metrics when a port is set, and as JSON on <topic>/stats
+        self.metricsport = config.getint("metrics", "port", fallback=0)
+        self.metricsaddress = config.get("metrics", "address", fallback="")
+        self.mqttstats = config.getboolean("metrics", "mqttstats", fallback=True)
 
+        # every sample is also written to the sinks with a url or path, each with its own queue, batches and thread
+        self.sinkoptions = []
+        for name, key in (('influx', 'url'), ('csv', 'path'), ('parquet', 'path'), ('http', 'url')):
+            target = config.get(name, key, fallback="")
+            if not target:
+                continue
+            # parquet files can't be appended to, so they hold an hour by default
+            options = {
+                'maxQueue': config.getint(name, "queuesize", fallback=10000),
+                'batchSize': config.getint(name, "batchsize", fallback=3600 if name == 'parquet' else 100),
+                'flushInterval': config.getint(name, "flushinterval", fallback=3600000 if name == 'parquet' else 10000),
+            }
+            if name in ('influx', 'http'):
+                options['token'] = config.get(name, "token", fallback=None)
+            if name == 'influx':
+                options['measurement'] = config.get(name, "measurement", fallback="goodwe")
+                if target.split(':')[0] not in ('udp', 'http', 'https'):
+                    raise ValueError('Invalid InfluxDB url: %s' % target)
+            if name == 'parquet':
+                import GoodWeSinks as sinks
+                if not sinks.hasParquet():
+                    raise ValueError('The parquet sink needs the pyarrow package')
+            self.sinkoptions.append((name, target, options))
+
+        # min/max/mean, energy and averages of every window of ms on <topic>/<serial>/analytics, 0 to disable
+        self.analyticswindow = config.getint("analytics", "window", fallback=300000)
+        self.analyticsewmatime = config.getint("analytics", "ewmatime", fallback=60000)
+        if self.analyticswindow < 0 or self.analyticsewmatime <= 0:
+            raise ValueError('Invalid analytics window %d or ewmatime %d' % (self.analyticswindow, self.analyticsewmatime))
+
+        # commands for the running daemon, see GoodWe.py ctl. Empty to disable.
+        self.controlsocket = config.get("control", "socket", fallback="/var/run/goodwe.sock")
+
+        # run against a number of simulated inverters instead of the USB devices
+        self.simulate = config.getint("inverter", "simulate", fallback=0)
+        return config
+
+
+    def getLogLevel(self, loglevel):
         numeric_level = getattr(logging, loglevel.upper(), None)
         if not isinstance(numeric_level, int):
             raise ValueError('Invalid log level: %s' % loglevel)
+        return numeric_level
+
+
+    def setupLogging(self, foreground):
+        numeric_level = self.getLogLevel(self.loglevel)
         
         # If we are running in the foreground we use stderr for logging, if running as forking daemon we use the logfile            
         if (foreground):
             logging.basicConfig(format='%(asctime)-15s %(funcName)s(%(lineno)d) - %(levelname)s: %(message)s', stream=sys.stderr, level=numeric_level)
         else:
-            logging.basicConfig(format='%(asctime)-15s %(funcName)s(%(lineno)d) - %(levelname)s: %(message)s', filename=logfile, level=numeric_level)
-        
-        try:
-            client = mqtt.Client(mqttclientid)
-            if mqttusername != "":
-                client.username_pw_set(mqttusername, mqttpasswd);
-                logging.debug("Set username -%s-, password -%s-", mqttusername, mqttpasswd)
-            client.connect(mqttserver,port=mqttport )
+            logging.basicConfig(format='%(asctime)-15s %(funcName)s(%(lineno)d) - %(levelname)s: %(message)s', filename=self.logfile, level=numeric_level)
+
+
+    def connectMQTT(self):
+        client = self.createMQTTClient()
+        if client is not None:
+            self.publisher = publisher.Publisher(client, self.mqttqueuesize, self.mqttspoolfile, self.mqttspoolmaxbytes)
             client.loop_start()
+            self.publisher.start()
+        return client
+
+
+    def createMQTTClient(self):
+        # The connection is made in the background and retried by paho once loop_start is called, after the
+        # publisher took over the callbacks. The publisher spools until it is up.
+        try:
+            # paho is only imported when needed, not for ctl and replay
+            import paho.mqtt.client as mqtt
+            client = mqtt.Client(self.mqttclientid)
+            if self.mqttusername != "":
+                client.username_pw_set(self.mqttusername, self.mqttpasswd);
+                logging.debug("Set username -%s-, password -%s-", self.mqttusername, self.mqttpasswd)
+            client.connect_async(self.mqttserver,port=self.mqttport )
         except Exception as e:
-            logging.error("%s:%s: %s",mqttserver, mqttport, e)
+            logging.error("%s:%s: %s",self.mqttserver, self.mqttport, e)
+            return None
+
+        logging.info('Connecting to MQTT %s:%s', self.mqttserver, self.mqttport)
+        return client
+
+
+    def disconnectMQTT(self, client):
+        self.publisher.stop()
+        if client is not None:
+            client.disconnect()
+            client.loop_stop()
+
+
+    def reloadConfig(self):
+        # Apply /etc/goodwe.conf to the running daemon. The devices stay open and the inverters registered.
+        reloaded = GoodWeProcessor.__new__(GoodWeProcessor)
+        try:
+            reloaded.loadConfig()
+            reloaded.getLogLevel(reloaded.loglevel)
+        except (ValueError, configparser.Error) as e:
+            logging.error('Keeping the running configuration, /etc/goodwe.conf is invalid: %s', e)
+            return str(e)
+
+        settings = vars(reloaded)
+        restart = [name for name in self.RESTART_SETTINGS if settings[name] != getattr(self, name)]
+        if restart:
+            logging.warning('Changes to %s take effect after a restart', ', '.join(restart))
+        reconnect = any(settings[name] != getattr(self, name) for name in self.MQTT_SETTINGS)
+        republish = any(settings[name] != getattr(self, name) for name in ('mqtttopic', 'mqttcompact'))
+        refilter = any(settings[name] != getattr(self, name) for name in ('publishmode', 'deadbands', 'keyframeinterval'))
+        reanalyze = any(settings[name] != getattr(self, name) for name in ('analyticswindow', 'analyticsewmatime'))
+
+        keep = self.RESTART_SETTINGS
+        if reconnect:
+            # The running publisher moves over to the new client, what the old connection didn't get out is sent
+            # on the new one. Without a new client the old one stays, and the next reload tries again.
+            logging.info('Reconnecting to MQTT')
+            client = reloaded.createMQTTClient()
+            if client is None:
+                logging.error('Keeping the MQTT connection to %s:%s', self.mqttserver, self.mqttport)
+                keep = keep + self.MQTT_SETTINGS
+                reconnect = False
+            else:
+                self.publisher.setClient(client, reloaded.mqttqueuesize, reloaded.mqttspoolfile, reloaded.mqttspoolmaxbytes)
+                client.loop_start()
+                self.client = client
+
+        for name, value in settings.items():
+            if name not in keep:
+                setattr(self, name, value)
+
+        if republish or reconnect:
+            self.publishedInfo = {}
+        if refilter:
+            # start over with a keyframe
+            self.changeFilters = {}
+        if reanalyze:
+            self.analytics = {}
+        for samples in self.batches.values():
+            samples.maxSamples = self.batchsamples
+            samples.maxAge = self.batchinterval
+        self.applySettings()
+        logging.info('Reloaded the configuration')
+        return None
+
+
+    def applySettings(self):
+        # push the settings that can change at runtime to the logger and the communicators
+        logging.getLogger().setLevel(self.getLogLevel(self.loglevel))
+        for gw in self.loop.communicators.values():
+            gw.pollMin = self.pollmin
+            gw.pollMax = self.pollmax
+            gw.pollAlign = self.pollalign
+            gw.pollInterval = min(max(gw.pollInterval, self.pollmin), self.pollmax)
+
+
+    def setSetting(self, name, value):
+        if name in ('pollmin', 'pollmax', 'pollinterval'):
+            try:
+                value = int(value)
+            except ValueError:
+                raise ValueError('Invalid %s: %s' % (name, value))
+            pollmin = value if name == 'pollmin' else self.pollmin
+            pollmax = value if name == 'pollmax' else self.pollmax
+            if not 0 < pollmin <= pollmax < goodwe.GoodWeCommunicator.OFFLINE_TIMEOUT / 2 or value <= 0:
+                raise ValueError('Invalid poll interval: pollmin %d, pollmax %d' % (pollmin, pollmax))
+        elif name == 'pollalign':
+            if value.lower() not in ('on', 'off', 'true', 'false', '1', '0'):
+                raise ValueError('Invalid pollalign: %s' % value)
+            value = value.lower() in ('on', 'true', '1')
+        elif name == 'loglevel':
+            self.getLogLevel(value)
+            value = value.upper()
+        else:
+            raise ValueError('Unknown setting: %s' % name)
+
+        # the publish interval is called pollinterval in the config
+        setattr(self, 'interval' if name == 'pollinterval' else name, value)
+        self.applySettings()
+        logging.info('Set %s to %s', name, value)
+        return {name: value}
+
+
+    def getStatus(self):
+        devices = {}
+        for device, gw in self.loop.communicators.items():
+            inverter = gw.getInverter()
+            devices[device] = dict(gw.getStats(), serial=inverter.serial, address=inverter.address,
+                                   addressConfirmed=inverter.addressConfirmed, pollMin=gw.pollMin, pollMax=gw.pollMax)
+        return {
+            'devices': devices,
+            'publisher': self.publisher.getStats(),
+            'sinks': dict((sink.sinkName, sink.getStats()) for sink in self.sinks),
+            'analytics': dict((serial, inverterAnalytics.current()) for serial, inverterAnalytics in self.analytics.items()),
+            'settings': {'loglevel': self.loglevel, 'pollinterval': self.interval, 'pollmin': self.pollmin, 'pollmax': self.pollmax,
+                         'pollalign': self.pollalign, 'publishmode': self.publishmode},
+        }
+
+
+    def handleControl(self, words):
+        # a command from the control socket, see CONTROL_HELP
+        if not words:
+            raise ValueError('No command, try help')
+        command = words[0]
+        if command == 'help':
+            return self.CONTROL_HELP
+        if command == 'status' and len(words) == 1:
+            return self.getStatus()
+        if command == 'set' and len(words) == 3:
+            return self.setSetting(words[1].lower(), words[2])
+        if command == 'rediscover':
+            devices = words[1:] or list(self.loop.communicators)
+            for device in devices:
+                if device not in self.loop.communicators:
+                    raise ValueError('Unknown device: %s' % device)
+            for device in devices:
+                logging.info('Looking for the inverter at %s again', device)
+                self.loop.communicators[device].rediscover()
+            return devices
+        if command == 'reload' and len(words) == 1:
+            error = self.reloadConfig()
+            if error is not None:
+                raise ValueError(error)
+            return 'reloaded'
+        raise ValueError('Unknown command: %s, try help' % ' '.join(words))
+
+
+    def handleSignals(self):
+        try:
+            signals = bytearray(os.read(self.signalPipe[0], 64))
+        except (IOError, OSError):
+            return
+        if signal.SIGTERM in signals:
+            logging.info('SIGTERM, stopping')
+            self.stopping = True
+        elif signal.SIGHUP in signals:
+            logging.info('SIGHUP, reloading the configuration')
+            self.reloadConfig()
+
+
+    def publish(self, inverter):
+        combinedtopic = self.mqtttopic + '/' + inverter.serial
+        self.publishStaticInfo(inverter, combinedtopic)
+
+        if self.publishmode == 'batch':
+            self.publishOnlineChange(inverter, combinedtopic)
+            samples = self.batches.get(inverter.serial)
+            if samples is not None and len(samples) and (samples.due(goodwe.epochMillis()) or not inverter.isOnline):
+                self.publishBatch(samples, combinedtopic)
+        elif self.publishmode != 'full':
+            self.publishChanges(inverter, combinedtopic)
+        elif inverter.isOnline:
+            self.profileEvent('first publish')
+            datagram = inverter.toJSON(self.mqttcompact)
+            logging.debug('Publishing telegram to MQTT on channel ' + combinedtopic + '/data')
+            self.publisher.submit(combinedtopic + '/data', datagram)
+            logging.debug('Publishing 1 to MQTT on channel ' + combinedtopic + '/online')
+            self.publisher.submit(combinedtopic + '/online', 1, coalesce=True)
+        else:
+            logging.debug('Publishing 0 to MQTT on channel ' + combinedtopic + '/online')
+            self.publisher.submit(combinedtopic + '/online', 0, coalesce=True)
+
+
+    def publishStaticInfo(self, inverter, combinedtopic):
+        # ID and setting info are queried once per registration, publish them retained when they arrive and differ
+        published = self.publishedInfo.setdefault(inverter.serial, {})
+        for name, info in (('info', inverter.idInfo), ('settings', inverter.settingInfo)):
+            if info is None or published.get(name, (None, None))[0] is info:
+                continue
+            payload = info.toJSON(self.mqttcompact)
+            if published.get(name, (None, None))[1] != payload:
+                logging.debug('Publishing %s to MQTT on channel %s/%s', name, combinedtopic, name)
+                self.publisher.submit(combinedtopic + '/' + name, payload, retain=True, coalesce=True)
+            published[name] = (info, payload)
+
+
+    def getChangeFilter(self, serial):
+        changeFilter = self.changeFilters.get(serial)
+        if changeFilter is None:
+            changeFilter = self.changeFilters[serial] = publisher.ChangeFilter(self.deadbands, self.keyframeinterval)
+        return changeFilter
+
+
+    def publishOnlineChange(self, inverter, combinedtopic):
+        # retained, subscribers no longer see it every interval
+        if not self.getChangeFilter(inverter.serial).onlineChanged(inverter.isOnline):
+            return False
+        logging.debug('Publishing %d to MQTT on channel %s/online', inverter.isOnline, combinedtopic)
+        self.publisher.submit(combinedtopic + '/online', int(inverter.isOnline), retain=True, coalesce=True)
+        return True
+
+
+    def publishChanges(self, inverter, combinedtopic):
+        changeFilter = self.getChangeFilter(inverter.serial)
+        if self.publishOnlineChange(inverter, combinedtopic):
+            # start over with a complete state after an outage
+            changeFilter.forceKeyframe()
+        if not inverter.isOnline:
+            return
+        self.profileEvent('first publish')
+
+        keyframe, changed = changeFilter.changes(inverter.runningInfo.toDict(), millis())
+        if keyframe:
+            logging.debug('Publishing keyframe to MQTT on channel %s/data', combinedtopic)
+            self.publisher.submit(combinedtopic + '/data', inverter.toJSON(self.mqttcompact))
+        elif not changed:
+            return
+        else:
+            changed['timestamp'] = inverter.runningInfo.timestamp
+            changed['requestTime'] = inverter.runningInfo.requestTime
+            changed['responseTime'] = inverter.runningInfo.responseTime
+
+        if self.publishmode == 'fields':
+            for name, value in changed.items():
+                self.publisher.submit(combinedtopic + '/' + name, value if isinstance(value, str) else json.dumps(value), retain=True, coalesce=True)
+        elif not keyframe:
+            logging.debug('Publishing %d changed values to MQTT on channel %s/delta', len(changed) - 1, combinedtopic)
+            self.publisher.submit(combinedtopic + '/delta', json.dumps(changed, sort_keys=True, separators=(',', ':')))
+
+
+    def publishBatch(self, samples, combinedtopic):
+        self.profileEvent('first publish')
+        logging.debug('Publishing %d samples to MQTT on channel %s/batch', len(samples), combinedtopic)
+        self.publisher.submit(combinedtopic + '/batch', samples.encode(self.batchformat))
+        samples.clear()
+
+
+    def onRunningInfo(self, inverter):
+        # called for every sample, not only every pollinterval
+        self.profileEvent('first sample')
+        if self.store is not None:
+            self.store.append(inverter.serial, inverter.runningInfo, inverter.runningInfo.responseTime)
+        for sink in self.sinks:
+            sink.submit(inverter.serial, inverter.runningInfo)
+
+        if self.analyticswindow:
+            inverterAnalytics = self.analytics.get(inverter.serial)
+            if inverterAnalytics is None:
+                import GoodWeAnalytics as analytics
+                inverterAnalytics = self.analytics[inverter.serial] = analytics.Analytics(inverter.serial, self.analyticswindow, self.analyticsewmatime)
+            inverterAnalytics.add(inverter.runningInfo)
+            self.publishAnalytics(inverterAnalytics, inverter.runningInfo.responseTime)
+
+        if self.publishmode == 'batch':
+            samples = self.batches.get(inverter.serial)
+            if samples is None:
+                import GoodWeBatch as batch
+                samples = self.batches[inverter.serial] = batch.SampleBatch(inverter.serial, self.batchsamples, self.batchinterval)
+            values = inverter.runningInfo.toDict()
+            del values['function'], values['timestamp'], values['requestTime'], values['responseTime']
+            samples.add(inverter.runningInfo.responseTime, values)
+            if samples.due(goodwe.epochMillis()):
+                self.publishBatch(samples, self.mqtttopic + '/' + inverter.serial)
+
+
+    def publishAnalytics(self, inverterAnalytics, now):
+        for summary in inverterAnalytics.summaries(now):
+            topic = self.mqtttopic + '/' + inverterAnalytics.serial + '/analytics'
+            logging.debug('Publishing the analytics of %d samples to MQTT on channel %s', summary['samples'], topic)
+            self.publisher.submit(topic, json.dumps(summary, sort_keys=True, separators=(',', ':')))
+
+
+    def run_process(self, foreground):
+        self.loadConfig()
+        self.setupLogging(foreground)
+        self.profileEvent('config')
+
+        self.client = self.connectMQTT()
+        if self.client is None:
             return 3
+        self.profileEvent('mqtt')
 
-        logging.info('Connected to MQTT %s:%s', mqttserver, mqttport)
+        if self.simulate:
+            # run against a number of simulated inverters instead of the USB devices
+            import GoodWeSimulator
+            self.transportFactory = GoodWeSimulator.Simulator().open
         
-        self.gw = goodwe.GoodWeCommunicator(logging, vendorId, modelId)
+        # One communicator per GoodWe USB device, all multiplexed on the same selector. Every communicator
+        # keeps its own framing state, state machine and inverter address.
+        self.loop = goodwe.CommunicatorLoop()
 
-        lastUpdate = millis()
+        # Inverters plugged in or removed are picked up from udev events right away
+        scanInterval = self.DEVICE_SCAN_INTERVAL
+        self.monitor = None
+        if not self.simulate:
+            try:
+                self.monitor = goodwe.DeviceMonitor(self.vendorId, self.modelId)
+                self.loop.addReader(self.monitor, self.handleDeviceEvents)
+                scanInterval = self.DEVICE_RESCAN_INTERVAL
+            except Exception as e:
+                logging.warning('No hotplug events, looking for devices every %d seconds: %s', scanInterval / 1000, e)
+
+        # SIGHUP reloads the configuration, SIGTERM stops the daemon. The handlers only wake up the selector,
+        # the reload and the shutdown run from the loop.
+        self.signalPipe = os.pipe()
+        for fd in self.signalPipe:
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self.signalPipe[1])
+        signal.signal(signal.SIGHUP, lambda signum, frame: None)
+        signal.signal(signal.SIGTERM, lambda signum, frame: None)
+        self.loop.addReader(self.signalPipe[0], self.handleSignals)
+
+        controlServer = None
+        if self.controlsocket:
+            import GoodWeControl as control
+            try:
+                controlServer = control.ControlServer(self.controlsocket, self.loop, self.handleControl)
+            except (IOError, OSError) as e:
+                logging.error('Unable to listen for commands on %s: %s', self.controlsocket, e)
+
+        self.registrations = self.loadRegistrations()
 
-        while True:
+        self.sinks = []
+        if self.sinkoptions:
+            import GoodWeSinks as sinks
+            self.sinks = [sinks.SINKS[name](target, **options) for name, target, options in self.sinkoptions]
+        for sink in self.sinks:
+            sink.start()
+
+        self.store = None
+        if self.storepath:
+            import GoodWeStore as store
+            self.store = store.Store(self.storepath, self.storeretention, self.storemaxbytes)
+
+        self.registry = metrics.Registry()
+        self.registry.register(self.collectMetrics)
+        metricsServer = None
+        if self.metricsport:
             try:
-                self.gw.handle()
+                metricsServer = metrics.MetricsServer(self.registry, self.metricsport, self.metricsaddress)
+                metricsServer.start()
+            except (IOError, OSError) as e:
+                logging.error('Unable to serve metrics on port %s: %s', self.metricsport, e)
 
-                if (millis() - lastUpdate) > interval:
+        lastUpdate = millis()
+        lastScan = 0
+        lastStats = millis()
+        lastFlush = millis()
+        self.profileEvent('loop')
+
+        # Everything below the loop also runs on SIGTERM and on errors, so captures, the store and partly
+        # filled batches are written out before the daemon exits.
+        try:
+            while not self.stopping:
+                try:
+                    if (millis() - lastScan) >= scanInterval:
+                        self.scanDevices()
+                        lastScan = millis()
 
-                    inverter = self.gw.getInverter()
+                    if self.profileStartup and any(gw.transport is not None for gw in self.loop.communicators.values()):
+                        self.profileEvent('device open')
+
+                    # Wait on the inverter devices and the timers instead of polling. We only wake up when data arrives
+                    # or when a communicator, the publish interval or the device scan has something to do.
+                    self.loop.poll(min(lastUpdate + self.interval, lastScan + scanInterval) - millis())
+
+                    if (millis() - lastUpdate) >= self.interval:
+
+                        for gw in self.loop.communicators.values():
+                            inverter = gw.getInverter()
                     
-                    if inverter.addressConfirmed:
-
-                        combinedtopic = mqtttopic + '/' + inverter.serial
-
-                        if inverter.isOnline:
-                            datagram = inverter.toJSON()
-                            logging.debug('Publishing telegram to MQTT on channel ' + combinedtopic + '/data')
-                            client.publish(combinedtopic + '/data', datagram)
-                            logging.debug('Publishing 1 to MQTT on channel ' + combinedtopic + '/online')
-                            client.publish(combinedtopic + '/online', 1)
-                        else:
-                            logging.debug('Publishing 0 to MQTT on channel ' + combinedtopic + '/online')
-                            client.publish(combinedtopic + '/online', 0)
+                            if inverter.addressConfirmed:
+                                self.publish(inverter)
+
+                        # windows end without a sample while the inverters are off
+                        for inverterAnalytics in self.analytics.values():
+                            self.publishAnalytics(inverterAnalytics, goodwe.epochMillis())
                         
-                    lastUpdate = millis()
-                
-                time.sleep(0.1)
+                        lastUpdate = millis()
+
+                    if (millis() - lastFlush) >= self.storeflushinterval:
+                        if self.store is not None:
+                            try:
+                                self.store.flush()
+                            except (IOError, OSError) as e:
+                                logging.error('Unable to write to the sample store %s: %s', self.storepath, e)
+                        # the capture writers buffer as well, a replay of the file sees up to the last flush
+                        for device, gw in self.loop.communicators.items():
+                            if gw.capture is not None:
+                                try:
+                                    gw.capture.flush()
+                                except (IOError, OSError) as e:
+                                    logging.error('Unable to write the capture of %s: %s', device, e)
+                        lastFlush = millis()
+
+                    if (millis() - lastStats) >= self.STATS_INTERVAL:
+                        logging.info('MQTT publisher: %s', self.publisher.getStats())
+                        for sink in self.sinks:
+                            logging.info('Sink %s: %s', sink.sinkName, sink.getStats())
+                        if self.mqttstats:
+                            self.publisher.submit(self.mqtttopic + '/stats', json.dumps(self.registry.toDict(), sort_keys=True, separators=(',', ':')))
+                        lastStats = millis()
                 
-            except Exception as err:
-                logging.exception("Error in RUN-loop")
-                break
+                except Exception:
+                    logging.exception("Error in RUN-loop")
+                    break
+        finally:
+            # partly filled batches first, the publisher sends them before it disconnects
+            for samples in self.batches.values():
+                if len(samples):
+                    self.publishBatch(samples, self.mqtttopic + '/' + samples.serial)
+            for gw in self.loop.communicators.values():
+                if gw.capture is not None:
+                    gw.capture.close()
+            if controlServer is not None:
+                controlServer.close()
+            self.loop.close()
+            if metricsServer is not None:
+                metricsServer.stop()
+            if self.store is not None:
+                self.store.close()
+            for sink in self.sinks:
+                sink.stop()
+            self.disconnectMQTT(self.client)
+        return 0
+
+
+    def collectMetrics(self):
+        frames = metrics.Metric('goodwe_frames_total', 'counter', 'Frames received with a valid crc')
+        crcErrors = metrics.Metric('goodwe_crc_errors_total', 'counter', 'Frame headers followed by a bad crc')
+        garbage = metrics.Metric('goodwe_garbage_bytes_total', 'counter', 'Received bytes that are not part of a frame')
+        transitions = metrics.Metric('goodwe_state_transitions_total', 'counter', 'Transitions into every communicator state')
+        stateTimeouts = metrics.Metric('goodwe_state_timeouts_total', 'counter', 'States left because the inverter did not answer')
+        resets = metrics.Metric('goodwe_device_resets_total', 'counter', 'Attempts to (re)open the USB device')
+        queryTimeouts = metrics.Metric('goodwe_query_timeouts_total', 'counter', 'Running info queries without an answer')
+        rtt = metrics.Metric('goodwe_response_latency_seconds', 'histogram', 'Time from running info query to answer')
+        jitter = metrics.Metric('goodwe_poll_jitter_seconds', 'histogram', 'Time queries were sent after their scheduled time')
+        pollInterval = metrics.Metric('goodwe_poll_interval_seconds', 'gauge', 'Current time between running info queries')
+        online = metrics.Metric('goodwe_inverter_online', 'gauge', 'Whether the inverter answers')
+
+        for device, gw in list(self.loop.communicators.items()):
+            stats = gw.getStats()
+            frames.add(stats['frames'], device=device)
+            crcErrors.add(stats['crcErrors'], device=device)
+            garbage.add(stats['garbageBytes'], device=device)
+            for state, count in stats['stateTransitions'].items():
+                transitions.add(count, device=device, state=state)
+            stateTimeouts.add(stats['stateTimeouts'], device=device)
+            resets.add(stats['resets'], device=device)
+            queryTimeouts.add(stats['queryTimeouts'], device=device)
+            rtt.add(gw.rttHistogram, device=device)
+            jitter.add(gw.pollJitter, device=device)
+            pollInterval.add(stats['pollInterval'] / 1000.0, device=device)
+            online.add(int(stats['online']), device=device)
+
+        sinkQueue = metrics.Metric('goodwe_sink_queue', 'gauge', 'Samples waiting to be written to a sink')
+        sinkWritten = metrics.Metric('goodwe_sink_written_total', 'counter', 'Samples written to a sink')
+        sinkDropped = metrics.Metric('goodwe_sink_dropped_total', 'counter', 'Samples dropped on a full sink queue')
+        sinkErrors = metrics.Metric('goodwe_sink_errors_total', 'counter', 'Failed writes to a sink')
+        for sink in self.sinks:
+            stats = sink.getStats()
+            sinkQueue.add(stats['queue'], sink=sink.sinkName)
+            sinkWritten.add(stats['written'], sink=sink.sinkName)
+            sinkDropped.add(stats['dropped'], sink=sink.sinkName)
+            sinkErrors.add(stats['errors'], sink=sink.sinkName)
+
+        stats = self.publisher.getStats()
+        return [frames, crcErrors, garbage, transitions, stateTimeouts, resets, queryTimeouts, rtt, jitter, pollInterval, online,
+                sinkQueue, sinkWritten, sinkDropped, sinkErrors,
+                metrics.Metric('goodwe_mqtt_queue', 'gauge', 'Messages waiting to be published').add(stats['queue']),
+                metrics.Metric('goodwe_mqtt_inflight', 'gauge', 'Messages published but not yet acknowledged').add(stats['inflight']),
+                metrics.Metric('goodwe_mqtt_published_total', 'counter', 'Messages handed to the broker').add(stats['published']),
+                metrics.Metric('goodwe_mqtt_dropped_total', 'counter', 'Messages dropped on a full queue or spool').add(stats['dropped']),
+                metrics.Metric('goodwe_mqtt_coalesced_total', 'counter', 'Messages replaced by a newer one for the same topic').add(stats['coalesced']),
+                metrics.Metric('goodwe_mqtt_spooled_total', 'counter', 'Messages spooled while the broker was unreachable').add(stats['spooled']),
+                metrics.Metric('goodwe_mqtt_spool_bytes', 'gauge', 'Size of the spool file').add(stats['spoolBytes']),
+                metrics.Metric('goodwe_mqtt_publish_latency_seconds', 'histogram', 'Time from submit to publish').add(self.publisher.latencyHistogram)]
 
-        client.loop_stop()
+
+    def scanDevices(self):
+        if self.simulate:
+            devices = ['sim%d' % i for i in range(self.simulate)]
+        else:
+            devices = goodwe.findGoodWeUSBDevices(self.vendorId, self.modelId)
+
+        for device in devices:
+            if device not in self.loop.communicators:
+                self.addDevice(device)
+
+        # forget devices that were unplugged, a replugged inverter shows up again under a new hidraw node
+        for device, gw in list(self.loop.communicators.items()):
+            if device not in devices and gw.state == goodwe.State.OFFLINE:
+                self.removeDevice(device)
+
+
+    def handleDeviceEvents(self):
+        for action, device in self.monitor.events():
+            gw = self.loop.communicators.get(device)
+            if action == 'add':
+                if gw is None:
+                    self.addDevice(device)
+                else:
+                    gw.deviceAdded()
+            elif gw is not None:
+                gw.deviceRemoved()
+                if gw.inverter.addressConfirmed:
+                    self.publish(gw.getInverter())
+                self.removeDevice(device)
+
+
+    def addDevice(self, device):
+        logging.info('Adding GoodWe Inverter at %s', device)
+        gw = goodwe.GoodWeCommunicator(logging, self.vendorId, self.modelId, device, self.transportFactory)
+        gw.pollMin = self.pollmin
+        gw.pollMax = self.pollmax
+        gw.pollAlign = self.pollalign
+        gw.onRunningInfo = self.onRunningInfo
+        gw.onRegistered = lambda inverter: self.saveRegistration(device, inverter)
+        registration = self.registrations.get(device)
+        if registration is not None:
+            gw.restoreRegistration(registration['serial'], registration['address'])
+        if self.capturepath:
+            capturefile = os.path.join(self.capturepath, os.path.basename(device) + '.cap')
+            try:
+                gw.capture = capture.CaptureWriter(capturefile, self.capturemaxbytes, self.capturebackups)
+            except (IOError, OSError) as e:
+                logging.error('Unable to capture to %s: %s', capturefile, e)
+        self.loop.add(device, gw)
+
+
+    def loadRegistrations(self):
+        # device -> {'serial': ..., 'address': ...}
+        if not self.cachefile or not os.path.exists(self.cachefile):
+            return {}
+        try:
+            with open(self.cachefile) as fp:
+                registrations = json.load(fp)
+            return dict((device, registration) for device, registration in registrations.items()
+                        if isinstance(registration, dict) and 'serial' in registration and 'address' in registration)
+        except (IOError, OSError, ValueError, AttributeError) as e:
+            logging.warning('Ignoring the registration cache %s: %s', self.cachefile, e)
+            return {}
+
+
+    def saveRegistration(self, device, inverter):
+        registration = {'serial': inverter.serial, 'address': inverter.address}
+        if self.registrations.get(device) == registration:
+            return
+        self.registrations[device] = registration
+        if not self.cachefile:
+            return
+        try:
+            # replace the file at once, a crash never leaves half of it
+            with open(self.cachefile + '.tmp', 'w') as fp:
+                json.dump(self.registrations, fp, sort_keys=True)
+            os.rename(self.cachefile + '.tmp', self.cachefile)
+        except (IOError, OSError) as e:
+            logging.warning('Unable to write the registration cache %s: %s', self.cachefile, e)
+
+
+    def removeDevice(self, device):
+        logging.info('Removing GoodWe Inverter at %s', device)
+        gw = self.loop.remove(device)
+        if gw.capture is not None:
+            gw.capture.close()
+
+
+    def replay(self, capturefile, realtime, publish):
+        # Feed a capture through the same parse, decode and serialize path as the daemon. By default as fast as possible
+        # and without publishing, to benchmark the pipeline, or at the recorded pace and published to reproduce an issue.
+        self.loadConfig()
+        self.setupLogging(True)
+
+        client = None
+        if publish:
+            client = self.connectMQTT()
+            if client is None:
+                return 3
+
+        samples = [0]
+        def onRunningInfo(inverter):
+            samples[0] += 1
+            if client is not None:
+                self.publish(inverter)
+            else:
+                inverter.toJSON(self.mqttcompact)
+
+        gw = goodwe.GoodWeCommunicator(logging, self.vendorId, self.modelId)
+        gw.onRunningInfo = onRunningInfo
+        gw.inverter.addressConfirmed = True
+
+        reports = 0
+        firstTimestamp = None
+        started = time.time()
+        for timestamp, direction, report in capture.readCapture(capturefile):
+            if direction != capture.RECEIVED:
+                continue
+            if realtime:
+                if firstTimestamp is None:
+                    firstTimestamp = timestamp
+                delay = started + (timestamp - firstTimestamp) / 1000000.0 - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            # stamp the samples with the time they were captured
+            gw.receiveTime = timestamp // 1000
+            gw.receiveData(report)
+            reports += 1
+
+        elapsed = time.time() - started
+        print("Replayed %d reports, %d frames with %d crc errors and %d garbage bytes, %d samples in %.3f s (%.0f samples/s)" % (
+            reports, gw.frameBuffer.frameCount, gw.frameBuffer.crcErrors, gw.frameBuffer.garbageBytes, samples[0],
+            elapsed, samples[0] / elapsed if elapsed > 0 else 0))
+
+        if client is not None:
+            self.disconnectMQTT(client)
         return 0
 
+
 class MyDaemon(Daemon):
+    profileStartup = False
+
     def run(self):
         processor = GoodWeProcessor()
+        processor.profileStartup = self.profileStartup
         processor.run_process(foreground=False)
 
     
 if __name__ == "__main__":
+    if len(sys.argv) >= 3 and 'replay' == sys.argv[1]:
+        processor = GoodWeProcessor()
+        retval = processor.replay(sys.argv[2], '--realtime' in sys.argv[3:], '--publish' in sys.argv[3:])
+        sys.exit(retval)
+
+    if len(sys.argv) >= 3 and 'ctl' == sys.argv[1]:
+        # only the socket, a broken configuration must not keep us from asking the daemon to reload it
+        config = configparser.RawConfigParser(strict=False)
+        config.read('/etc/goodwe.conf')
+        controlsocket = config.get("control", "socket", fallback="/var/run/goodwe.sock")
+        import GoodWeControl as control
+        try:
+            response = control.request(controlsocket, sys.argv[2:])
+        except (IOError, OSError, ValueError) as e:
+            print ("Unable to reach the daemon on %s: %s" % (controlsocket, e))
+            sys.exit(3)
+        if not response['ok']:
+            print (response['error'])
+            sys.exit(1)
+        if sys.argv[2] == 'help':
+            print ('\n'.join(response['result']))
+        else:
+            print (json.dumps(response['result'], sort_keys=True, indent=4))
+        sys.exit(0)
+
+    # log the time to the first device open, sample and publish
+    profileStartup = '--profile-startup' in sys.argv[2:]
+    if profileStartup:
+        sys.argv.remove('--profile-startup')
+
     if len(sys.argv) != 2:
-        print ("usage: %s start|stop|restart|foreground" % sys.argv[0])
+        print ("usage: %s start|stop|restart|foreground [--profile-startup]" % sys.argv[0])
+        print ("       %s replay <capturefile> [--realtime] [--publish]" % sys.argv[0])
+        print ("       %s ctl help|status|set|rediscover|reload ..." % sys.argv[0])
         sys.exit(2)
 
     if 'foreground' == sys.argv[1]:
         processor = GoodWeProcessor()
+        processor.profileStartup = profileStartup
         retval = processor.run_process(foreground=True)
         sys.exit(retval)
 
     daemon = MyDaemon('/var/run/goodwecomm.pid', '/dev/null', '/dev/null', '/dev/null')
+    daemon.profileStartup = profileStartup
  
     if 'start' == sys.argv[1]:
         daemon.start()
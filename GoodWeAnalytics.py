@@ -0,0 +1,176 @@
+"""
+Derived values of the running info, computed incrementally in the daemon.
+
+Every sample updates a constant number of aggregates: the PV power of
+both strings, the efficiency of the inverter (pac over PV power), time
+based exponentially weighted moving averages, min/max/mean over a wall
+clock window, the energy of the window integrated from pac and counted
+from eTotal, and the peak power of the day. A summary is produced for
+every window with samples, at a much lower rate than the samples.
+"""
+from __future__ import absolute_import
+import math
+import time
+
+# eTotal is an unsigned 32 bit counter of 0.1 kWh
+ETOTAL_WRAP = 2 ** 32 / 10.0
+# ms between two samples to still integrate the power between them
+MAX_GAP = 300000
+
+
+class WindowStats(object):
+
+    __slots__ = ('count', 'sum', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def toDict(self):
+        if not self.count:
+            return None
+        return {'min': round(self.min, 3), 'max': round(self.max, 3), 'mean': round(self.sum / self.count, 3)}
+
+
+class Ewma(object):
+    """
+    Moving average with a time constant instead of a sample count, so irregular
+    polling (backoff, timeouts) weighs every sample by the time it covers.
+    """
+
+    __slots__ = ('timeConstant', 'value', 'last')
+
+    def __init__(self, timeConstant):
+        self.timeConstant = timeConstant    #ms
+        self.value = None
+        self.last = None
+
+    def add(self, timestamp, value):
+        if self.value is None:
+            self.value = float(value)
+        elif timestamp > self.last:
+            self.value += (1.0 - math.exp(float(self.last - timestamp) / self.timeConstant)) * (value - self.value)
+        self.last = timestamp
+
+
+class Analytics(object):
+
+    # aggregated per window, and averaged
+    WINDOW_FIELDS = ('pac', 'ppv', 'efficiency', 'temp')
+    EWMA_FIELDS = ('pac', 'ppv', 'efficiency')
+
+    def __init__(self, serial, window = 300000, ewmaTime = 60000):
+        self.serial = serial
+        self.window = window                #ms, windows start on wall clock multiples
+        self.ewma = dict((name, Ewma(ewmaTime)) for name in self.EWMA_FIELDS)
+        self.windowStart = None
+        self.stats = None
+        self.energyIntegrated = 0.0            #kWh in the window, from pac
+        self.energyCounted = 0.0            #kWh in the window, from eTotal
+        self.lastTime = None
+        self.lastPac = None
+        self.lastETotal = None
+        self.day = None
+        self.pacMaxToday = 0
+        self.pacMaxTodayTime = None
+        self.completed = []                    #summaries of the windows that ended
+
+    def add(self, runningInfo):
+        timestamp = runningInfo.responseTime
+        if self.windowStart is not None:
+            #samples stamped before the open window, after a wall clock step back or a late answer, belong to a window
+            #that is already summarized
+            if timestamp < (self.windowStart if self.stats is not None else self.windowStart + self.window):
+                return
+        if self.stats is None or timestamp >= self.windowStart + self.window:
+            if self.stats is not None:
+                self.finishWindow()
+            self.startWindow(timestamp)
+
+        ppv = runningInfo.vpv1 * runningInfo.ipv1 + runningInfo.vpv2 * runningInfo.ipv2
+        pac = runningInfo.pac
+        efficiency = min(1.0, pac / ppv) if ppv > 0 else None
+        stats = self.stats
+        stats['pac'].add(pac)
+        stats['ppv'].add(ppv)
+        if efficiency is not None:
+            stats['efficiency'].add(efficiency)
+            self.ewma['efficiency'].add(timestamp, efficiency)
+        stats['temp'].add(runningInfo.temp)
+        self.ewma['pac'].add(timestamp, pac)
+        self.ewma['ppv'].add(timestamp, ppv)
+
+        #trapezoid between this and the previous sample, unless the inverter was away too long to tell
+        if self.lastTime is not None and 0 < timestamp - self.lastTime <= MAX_GAP:
+            self.energyIntegrated += (self.lastPac + pac) / 2.0 * (timestamp - self.lastTime) / 3600000000.0
+        self.lastTime = timestamp
+        self.lastPac = pac
+
+        eTotal = runningInfo.eTotal
+        if eTotal > 0:
+            if self.lastETotal is not None:
+                delta = eTotal - self.lastETotal
+                if delta < 0 and self.lastETotal > ETOTAL_WRAP / 2:
+                    delta += ETOTAL_WRAP
+                if delta > 0:
+                    #a counter that went back, e.g. a replaced inverter, counts from the new value
+                    self.energyCounted += delta
+            self.lastETotal = eTotal
+
+        day = time.localtime(timestamp // 1000)[0:3]
+        if day != self.day:
+            self.day = day
+            self.pacMaxToday = 0
+            self.pacMaxTodayTime = None
+        if pac > self.pacMaxToday:
+            self.pacMaxToday = pac
+            self.pacMaxTodayTime = timestamp
+
+    def startWindow(self, timestamp):
+        self.windowStart = timestamp - timestamp % self.window
+        self.stats = dict((name, WindowStats()) for name in self.WINDOW_FIELDS)
+        self.energyIntegrated = 0.0
+        self.energyCounted = 0.0
+
+    def finishWindow(self):
+        summary = {
+            'serial': self.serial,
+            'start': self.windowStart,
+            'end': self.windowStart + self.window,
+            'samples': self.stats['pac'].count,
+            'energyIntegrated': round(self.energyIntegrated, 4),
+            'energyCounted': round(self.energyCounted, 1),
+        }
+        for name, stats in self.stats.items():
+            summary[name] = stats.toDict()
+        summary.update(self.current())
+        self.completed.append(summary)
+        self.stats = None
+
+    def current(self):
+        #the averages and peak now, also part of every summary
+        return {
+            'ewma': dict((name, round(ewma.value, 3) if ewma.value is not None else None) for name, ewma in self.ewma.items()),
+            'pacMaxToday': self.pacMaxToday,
+            'pacMaxTodayTime': self.pacMaxTodayTime,
+        }
+
+    def summaries(self, now):
+        """
+        Returns and forgets the summaries of the windows that ended before now (UTC ms since the epoch).
+        """
+        if self.stats is not None and now >= self.windowStart + self.window:
+            self.finishWindow()
+        completed = self.completed
+        self.completed = []
+        return completed
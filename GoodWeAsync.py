@@ -0,0 +1,134 @@
+#!/usr/bin/python -tt
+"""
+asyncio API for GoodWeCommunicator, to run inverters inside an existing event loop.
+
+The transport of the communicator is registered with loop.add_reader and
+its deadlines from getTimeout() become loop timers, so any number of
+communicators share the loop of the host application without threads:
+
+    communicator = AsyncCommunicator(GoodWeCommunicator(logging, '0084', '0041', '/dev/hidraw0'))
+    async for runningInfo in communicator.samples():
+        ...
+
+Run this module to print the samples of simulated inverters.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import asyncio
+import logging
+
+import GoodWeCommunicator as goodwe
+
+
+class AsyncCommunicator(object):
+
+    def __init__(self, gw, maxQueue = 100, loop = None):
+        self.gw = gw
+        self.loop = loop
+        self.queue = asyncio.Queue(maxQueue)
+        self.transport = None                #transport registered with the loop
+        self.fd = None
+        self.timer = None
+        self.dropped = 0                    #samples dropped because nobody consumed them
+
+        onRunningInfo = gw.onRunningInfo
+        def queueSample(inverter):
+            if onRunningInfo is not None:
+                onRunningInfo(inverter)
+            if self.queue.full():
+                self.queue.get_nowait()
+                self.dropped += 1
+            #every sample is a new RunningInfo, the inverter itself is updated in place
+            self.queue.put_nowait(inverter.runningInfo)
+        gw.onRunningInfo = queueSample
+
+    def start(self):
+        #without a loop given to the constructor, start from a coroutine or callback of the loop to run in
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        if self.timer is None:
+            self.timer = self.loop.call_soon(self.handle)
+
+    def handle(self):
+        #called when the transport is readable or the next deadline passed
+        try:
+            self.gw.handle()
+        except Exception:
+            #an exception would end up in the loop's exception handler and the communicator would never run again.
+            #It is rescheduled like after a timeout instead.
+            logging.exception('Error handling the inverter at %s', self.gw.devicePath)
+
+        transport = self.gw.transport
+        if transport is not self.transport:
+            #the device was closed or reopened
+            if self.fd is not None:
+                self.loop.remove_reader(self.fd)
+                self.fd = None
+            if transport is not None:
+                self.fd = transport.fileno()
+                self.loop.add_reader(self.fd, self.handle)
+            self.transport = transport
+
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.loop.call_later(self.gw.getTimeout() / 1000.0, self.handle)
+
+    async def samples(self):
+        """
+        Yields the RunningInfo of every answer of the inverter, starts the communicator if needed.
+        """
+        self.start()
+        while True:
+            yield await self.queue.get()
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.fd = None
+        self.transport = None
+        self.gw.closeDevice()
+
+
+async def printSamples(device, communicator):
+    async for runningInfo in communicator.samples():
+        print(device, communicator.gw.inverter.serial, runningInfo.toJSON(True))
+
+
+def main():
+    import argparse
+    import GoodWeSimulator
+
+    parser = argparse.ArgumentParser(description = 'Print the samples of simulated inverters from one asyncio loop.')
+    parser.add_argument('-n', '--inverters', type = int, default = 2)
+    parser.add_argument('-d', '--duration', type = float, default = 10, help = 'seconds')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)-15s %(funcName)s(%(lineno)d) - %(levelname)s: %(message)s', level = logging.WARNING)
+
+    simulator = GoodWeSimulator.Simulator()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    communicators = []
+    tasks = []
+    for i in range(args.inverters):
+        device = 'sim%d' % i
+        gw = goodwe.GoodWeCommunicator(logging, None, None, device, simulator.open)
+        communicator = AsyncCommunicator(gw, loop = loop)
+        communicators.append(communicator)
+        tasks.append(loop.create_task(printSamples(device, communicator)))
+
+    loop.run_until_complete(asyncio.sleep(args.duration))
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions = True))
+    for communicator in communicators:
+        communicator.close()
+    loop.close()
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
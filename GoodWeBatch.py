@@ -0,0 +1,115 @@
+#!/usr/bin/python -tt
+"""
+Batches of running info samples in one compact MQTT payload.
+
+A batch is a columnar document: the time of the first sample in ms since
+the epoch (t0), the time between consecutive samples (dt, starting with 0)
+and one list of values per field (columns):
+
+    {"columns":{"pac":[2480,2491],...},"dt":[0,1000],"serial":"...","t0":1792312345000,"version":1}
+
+It is sent as JSON, or as MessagePack when the msgpack package is
+installed. This module has no other dependencies, so consumers can use it
+to decode the batches. Run it to print the samples of payloads read from
+files or stdin as JSON lines:
+
+usage: GoodWeBatch.py [file ...]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import sys
+
+try:
+    # simplejson supports byte strings
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+VERSION = 1
+FORMATS = ('json', 'msgpack')
+
+
+class SampleBatch(object):
+
+    def __init__(self, serial, maxSamples = 60, maxAge = 60000):
+        self.serial = serial
+        self.maxSamples = maxSamples        #publish when this many samples are collected
+        self.maxAge = maxAge                #or when the first one is this many ms old
+        self.clear()
+
+    def clear(self):
+        self.first = None
+        self.last = None
+        self.deltas = []
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.deltas)
+
+    def add(self, timestamp, values):
+        #values is a dict of field name to value, the same fields for every sample
+        if self.first is None:
+            self.first = self.last = timestamp
+            self.columns = dict((name, []) for name in values)
+        self.deltas.append(timestamp - self.last)
+        self.last = timestamp
+        for name, column in self.columns.items():
+            column.append(values.get(name))
+
+    def due(self, now):
+        return len(self.deltas) >= self.maxSamples or (self.first is not None and now - self.first >= self.maxAge)
+
+    def encode(self, format = 'json'):
+        document = {'version': VERSION, 'serial': self.serial, 't0': self.first, 'dt': self.deltas, 'columns': self.columns}
+        if format == 'msgpack':
+            return msgpack.packb(document, use_bin_type = True)
+        return json.dumps(document, sort_keys = True, separators = (',', ':'))
+
+
+def decode(payload):
+    """
+    Returns the samples of a batch as dicts with the field values, the 'time' in ms and the 'serial'.
+    """
+    if isinstance(payload, (bytes, bytearray)) and payload[:1] != b'{':
+        if msgpack is None:
+            raise ValueError("MessagePack batch, but msgpack is not installed")
+        document = msgpack.unpackb(payload, raw = False)
+    else:
+        document = json.loads(payload)
+    if document.get('version') != VERSION:
+        raise ValueError("Unsupported batch version %s" % document.get('version'))
+
+    samples = []
+    timestamp = document['t0']
+    columns = document['columns']
+    for i, delta in enumerate(document['dt']):
+        timestamp += delta
+        sample = dict((name, column[i]) for name, column in columns.items())
+        sample['time'] = timestamp
+        sample['serial'] = document['serial']
+        samples.append(sample)
+    return samples
+
+
+def main(paths):
+    payloads = []
+    for path in paths or ['-']:
+        if path == '-':
+            payloads.append(getattr(sys.stdin, 'buffer', sys.stdin).read())
+        else:
+            with open(path, 'rb') as fp:
+                payloads.append(fp.read())
+
+    for payload in payloads:
+        for sample in decode(payload):
+            print(json.dumps(sample, sort_keys = True))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
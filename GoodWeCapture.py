@@ -0,0 +1,87 @@
+"""
+Capture of the raw HID reports exchanged with the inverters.
+
+A capture file starts with the 8 byte MAGIC, followed by records of a
+little endian header (timestamp in microseconds since the epoch,
+direction, length) and the report bytes. Files are only appended to and
+rotate like logging.handlers.RotatingFileHandler.
+"""
+from __future__ import absolute_import
+import os
+import struct
+import time
+
+MAGIC = b'GWCAP001'
+RECORD = struct.Struct('<qBB')
+
+RECEIVED = 0
+SENT = 1
+
+
+class CaptureWriter(object):
+
+    BUFFERSIZE = 65536            #write in large chunks, this is usually on an SD card
+
+    def __init__(self, path, maxBytes = 10485760, backupCount = 5):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.fp = None
+        self.size = 0
+        self.open()
+
+    def open(self):
+        self.fp = open(self.path, 'ab', self.BUFFERSIZE)
+        self.size = self.fp.tell()
+        if self.size == 0:
+            self.fp.write(MAGIC)
+            self.size = len(MAGIC)
+
+    def write(self, direction, report, timestamp = None):
+        if timestamp is None:
+            timestamp = int(time.time() * 1000000)
+        if self.maxBytes and self.size + RECORD.size + len(report) > self.maxBytes:
+            self.rotate()
+        self.fp.write(RECORD.pack(timestamp, direction, len(report)))
+        self.fp.write(report)
+        self.size += RECORD.size + len(report)
+
+    def rotate(self):
+        self.fp.close()
+        if self.backupCount > 0:
+            for i in range(self.backupCount - 1, 0, -1):
+                source = "%s.%d" % (self.path, i)
+                if os.path.exists(source):
+                    os.replace(source, "%s.%d" % (self.path, i + 1))
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+
+def readCapture(path):
+    """
+    Yields (timestamp in microseconds, direction, report) for every record in a capture file.
+    """
+    with open(path, 'rb') as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a GoodWe capture file" % path)
+
+        while True:
+            header = fp.read(RECORD.size)
+            if len(header) < RECORD.size:
+                #end of file, or a record that was cut off when the daemon stopped
+                return
+            timestamp, direction, length = RECORD.unpack(header)
+            report = fp.read(length)
+            if len(report) < length:
+                return
+            yield timestamp, direction, report
@@ -2,20 +2,90 @@ from __future__ import absolute_import
 from enum import IntEnum
 
 import time
-from pyudev import Devices, Context, Monitor, MonitorObserver
-import datetime
-import hidrawpure as hidraw
-import os, fcntl
+import GoodWeCapture as capture
+from GoodWeMetrics import Histogram, JITTER_BUCKETS
+import os
+import selectors
 import logging
+import struct
+import operator
 # simplejson supports byte strings
 import simplejson as json
 from six.moves import map
 from six.moves import range
 
-millis = lambda: int(round(time.time() * 1000))
+#all intervals and timeouts use the monotonic clock, NTP steps and DST don't affect them
+millis = lambda: int(time.monotonic() * 1000)
+#samples are stamped with UTC milliseconds since the epoch
+epochMillis = lambda: int(time.time() * 1000)
+
+
+class JSONTemplate(object):
+    """
+    JSON serializer for the fixed schema records below.
+
+    The sorted keys and all JSON punctuation are rendered once into a
+    %-format template. Serializing a record is then one attrgetter call for
+    all (nested) fields and one string formatting operation. Only booleans,
+    strings and lists of integers are converted per field.
+    """
+
+    def __init__(self, recordClass, indent = None):
+        self.indent = indent
+        self.paths = []
+        self.converters = []
+        self.template = self._render(recordClass, '', 1)
+        self.values = operator.attrgetter(*self.paths)
+
+    def _render(self, recordClass, prefix, level):
+        if self.indent is None:
+            start, separator, end, colon = '{', ',', '}', ':'
+        else:
+            padding = '\n' + ' ' * (self.indent * level)
+            start, separator, end, colon = '{' + padding, ',' + padding, '\n' + ' ' * (self.indent * (level - 1)) + '}', ': '
+
+        items = []
+        for name, kind in recordClass.JSON_FIELDS:
+            if isinstance(kind, type):
+                value = self._render(kind, prefix + name + '.', level + 1)
+            else:
+                self.paths.append(prefix + name)
+                value = '%d' if kind == 'int' else ('%r' if kind == 'num' else '%s')
+                if kind not in ('int', 'num'):
+                    self.converters.append((len(self.paths) - 1, self._converter(kind, level)))
+            items.append('"%s"%s%s' % (name, colon, value))
+        return start + separator.join(items) + end
+
+    def _converter(self, kind, level):
+        if kind == 'bool':
+            return lambda value: 'true' if value else 'false'
+        if kind == 'str':
+            return json.dumps
+        #lists of integers, or the 0 errorMessage of a running info that was not decoded yet
+        if self.indent is None:
+            return lambda value: str(value) if isinstance(value, int) else '[' + ','.join(map(str, value)) + ']'
+        padding = '\n' + ' ' * (self.indent * (level + 1))
+        end = '\n' + ' ' * (self.indent * level) + ']'
+        return lambda value: str(value) if isinstance(value, int) else ('[' + padding + (',' + padding).join(map(str, value)) + end if value else '[]')
+
+    def encode(self, record):
+        values = list(self.values(record))
+        for index, convert in self.converters:
+            values[index] = convert(values[index])
+        return self.template % tuple(values)
+
 
 class RunningInfo(object):
 
+    __slots__ = ('function', 'timestamp', 'vpv1', 'vpv2', 'ipv1', 'ipv2', 'vac1', 'vac2', 'vac3', 'iac1', 'iac2', 'iac3',
+                 'fac1', 'fac2', 'fac3', 'pac', 'workMode', 'temp', 'errorMessage', 'eTotal', 'hTotal', 'tempFault',
+                 'pv1Fault', 'pv2Fault', 'line1VFault', 'line2VFault', 'line3VFault', 'line1FFault', 'line2FFault',
+                 'line3FFault', 'gcfiFault', 'eDay', 'requestTime', 'responseTime')
+
+    # serialized fields and their JSON kind, sorted like the keys in the published document
+    JSON_FIELDS = tuple(sorted([(name, 'num') for name in __slots__ if name not in ('function', 'timestamp', 'errorMessage', 'requestTime', 'responseTime')] +
+                               [('function', 'int'), ('timestamp', 'str'), ('errorMessage', 'ints'), ('requestTime', 'int'), ('responseTime', 'int')]))
+
     ERRORS = []
     ERRORS.append("GFCI Device Failure")
     ERRORS.append("AC HCT Failure")
@@ -54,7 +124,9 @@ class RunningInfo(object):
     def __init__(self):
         self.function = FC_RESRUN        # Function 0x81 'Running Info List'
 
-        self.timestamp = ""
+        self.timestamp = ""                    #local time of the response as YYYYmmddHHMMSS
+        self.requestTime = 0                    #UTC ms since the epoch the query was sent
+        self.responseTime = 0                    #and its answer was received
         self.vpv1 = 0.0
         self.vpv2 = 0.0
         self.ipv1 = 0.0
@@ -86,24 +158,100 @@ class RunningInfo(object):
         self.gcfiFault = 0
         self.eDay = 0.0
         
-    def toJSON(self):
-        return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
+    def toDict(self):
+        return dict((name, getattr(self, name)) for name, kind in self.JSON_FIELDS)
+
+    def toJSON(self, compact = False):
+        return (RUNNINGINFO_JSON_COMPACT if compact else RUNNINGINFO_JSON).encode(self)
+
+
+class IdInfo(object):
+    #static identity from the 'ID Info' (0x82) frame
+
+    __slots__ = ('firmwareVersion', 'modelName', 'manufacturer', 'serial', 'nominalVpv', 'internalVersion', 'safetyCountryCode', 'safetyCountry')
+
+    JSON_FIELDS = (('firmwareVersion', 'str'), ('internalVersion', 'str'), ('manufacturer', 'str'), ('modelName', 'str'),
+                   ('nominalVpv', 'num'), ('safetyCountry', 'str'), ('safetyCountryCode', 'int'), ('serial', 'str'))
+
+    SAFETY_COUNTRIES = ['Italy', 'Czech', 'Germany', 'Spain', 'GreeceMainland', 'GreeceIslands', 'Belgium', 'ItalianSpecial',
+                        'G83Spec', 'Australian', 'France']
+
+    def __init__(self):
+        self.firmwareVersion = ""
+        self.modelName = ""
+        self.manufacturer = ""
+        self.serial = ""
+        self.nominalVpv = 0.0                    #V
+        self.internalVersion = ""
+        self.safetyCountryCode = 0
+        self.safetyCountry = ""
+
+    def toDict(self):
+        return dict((name, getattr(self, name)) for name, kind in self.JSON_FIELDS)
+
+    def toJSON(self, compact = False):
+        return (IDINFO_JSON_COMPACT if compact else IDINFO_JSON).encode(self)
+
+
+class SettingInfo(object):
+    #grid connection settings from the 'Setting Info' (0x83) frame
+
+    __slots__ = ('vpvStart', 'tStart', 'vacMin', 'vacMax', 'facMin', 'facMax')
+
+    JSON_FIELDS = (('facMax', 'num'), ('facMin', 'num'), ('tStart', 'int'), ('vacMax', 'num'), ('vacMin', 'num'), ('vpvStart', 'num'))
+
+    def __init__(self):
+        self.vpvStart = 0.0                        #PV start-up voltage
+        self.tStart = 0                            #seconds to connect to the grid
+        self.vacMin = 0.0                        #operational grid voltage
+        self.vacMax = 0.0
+        self.facMin = 0.0                        #operational grid frequency
+        self.facMax = 0.0
+
+    def toDict(self):
+        return dict((name, getattr(self, name)) for name, kind in self.JSON_FIELDS)
+
+    def toJSON(self, compact = False):
+        return (SETTINGINFO_JSON_COMPACT if compact else SETTINGINFO_JSON).encode(self)
+
 
-        
 class Inverter(object):
+
+    __slots__ = ('serialNumber', 'serial', 'address', 'addressConfirmed', 'lastSeen', 'isOnline', 'inverterType', 'runningInfo',
+                 'idInfo', 'settingInfo')
+
+    JSON_FIELDS = (('address', 'int'), ('addressConfirmed', 'bool'), ('inverterType', 'int'), ('isOnline', 'bool'),
+                   ('lastSeen', 'int'), ('runningInfo', RunningInfo), ('serial', 'str'), ('serialNumber', 'ints'))
     
     def __init__(self):
         self.serialNumber = [17]                #serial number (ascii) from inverter with zero appended
         self.serial = ""                        # serial number as string
         self.address = 0                        #address provided by this software
         self.addressConfirmed = False            #wether or not the address is confirmed by te inverter
-        self.lastSeen = 0                        #when was the inverter last seen? If not seen for 30 seconds the inverter is marked offline. 
+        self.lastSeen = 0                        #UTC ms since the epoch the inverter was last seen
         self.isOnline = False                    #is the inverter online (see above)
         self.inverterType = InverterType.SINGLEPHASE    #1 or 3 phase inverter
         self.runningInfo = RunningInfo()
+        self.idInfo = None                        #static information, queried once after registration and not part of the JSON
+        self.settingInfo = None
         
-    def toJSON(self):
-        return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
+    def toDict(self):
+        values = dict((name, getattr(self, name)) for name, kind in self.JSON_FIELDS)
+        values['runningInfo'] = self.runningInfo.toDict()
+        return values
+
+    def toJSON(self, compact = False):
+        return (INVERTER_JSON_COMPACT if compact else INVERTER_JSON).encode(self)
+
+
+RUNNINGINFO_JSON = JSONTemplate(RunningInfo, indent = 4)
+RUNNINGINFO_JSON_COMPACT = JSONTemplate(RunningInfo)
+INVERTER_JSON = JSONTemplate(Inverter, indent = 4)
+INVERTER_JSON_COMPACT = JSONTemplate(Inverter)
+IDINFO_JSON = JSONTemplate(IdInfo, indent = 4)
+IDINFO_JSON_COMPACT = JSONTemplate(IdInfo)
+SETTINGINFO_JSON = JSONTemplate(SettingInfo, indent = 4)
+SETTINGINFO_JSON_COMPACT = JSONTemplate(SettingInfo)
 
 class State(IntEnum):
     OFFLINE = 1
@@ -112,6 +260,7 @@ class State(IntEnum):
     ALLOC = 4
     ALLOC_WAIT_CONFIRM = 5
     ALLOC_ASK_INFO = 6
+    RESUME = 7
     RUNNING = 11
 
 
@@ -142,48 +291,348 @@ FC_QRYSTT     = 0x03
 FC_RESSTT     = 0x83
 
 NODATA         = 0x00
+
+# USB header (0xCC 0x99, length of the frame) and frame header (0xAA 0x55, source, destination, control code, function code, data length)
+REPORT_HEADER = struct.Struct('>BBBBBBBBBB')
+CRC = struct.Struct('>H')
+
+
+class RunningInfoLayout(object):
+    """
+    Precompiled layout of a 'Running Info List' (0x81) frame.
+
+    All fields are big endian unsigned integers and are read with a single
+    struct.Struct.unpack_from call. Fields with a scale factor are divided by
+    it, the others are kept as integers.
+    """
+
+    def __init__(self, inverterType, fields):
+        """
+        fields
+            List of (name, struct format character, scale factor or None) in frame order.
+        """
+        self.inverterType = inverterType
+        self.names = tuple(name for name, fmt, scale in fields)
+        self.scales = tuple(scale for name, fmt, scale in fields)
+        self.struct = struct.Struct('>' + ''.join(fmt for name, fmt, scale in fields))
+        self.size = self.struct.size
+        self.fields = tuple(zip(self.names, self.scales))
+
+    def decode(self, data, runningInfo = None):
+        #data can be anything supporting the buffer protocol, a memoryview of the receive buffer avoids any copies
+        if runningInfo is None:
+            runningInfo = RunningInfo()
+
+        for (name, scale), value in zip(self.fields, self.struct.unpack_from(data)):
+            if scale:
+                value = float(value) / scale
+            setattr(runningInfo, name, value)
+
+        errorMessage = runningInfo.errorMessage
+        runningInfo.errorMessage = [i for i, x in enumerate(reversed(bin(errorMessage))) if x == "1"] if errorMessage else []
+        return runningInfo
+
+    def encode(self, runningInfo):
+        #build the frame data for a RunningInfo, the reverse of decode. Used by tools that generate frames.
+        values = []
+        for name, scale in self.fields:
+            value = getattr(runningInfo, name)
+            if name == 'errorMessage':
+                value = sum(1 << bit for bit in value)
+            elif scale:
+                value = int(round(value * scale))
+            values.append(value)
+        return self.struct.pack(*values)
+
+
+def _runningInfoFields(threePhase, eDay = True):
+    #field list of the running info frame. The fields for phase 2 and 3 are only sent by three phase (DT) inverters.
+    def phases(name, scale):
+        if threePhase:
+            return [(name % 1, 'H', scale), (name % 2, 'H', scale), (name % 3, 'H', scale)]
+        return [(name % 1, 'H', scale)]
+
+    fields = [('vpv1', 'H', 10), ('vpv2', 'H', 10), ('ipv1', 'H', 10), ('ipv2', 'H', 10)]
+    fields += phases('vac%d', 10) + phases('iac%d', 10) + phases('fac%d', 100)
+    fields += [('pac', 'H', None), ('workMode', 'H', None), ('temp', 'H', 10), ('errorMessage', 'I', None),
+               ('eTotal', 'I', 10), ('hTotal', 'I', None), ('tempFault', 'H', 10), ('pv1Fault', 'H', 10), ('pv2Fault', 'H', 10)]
+    fields += phases('line%dVFault', 10) + phases('line%dFFault', 100)
+    fields += [('gcfiFault', 'H', None)]
+    if eDay:
+        fields += [('eDay', 'H', 10)]
+    return fields
+
+
+RUNNINGINFO_SINGLEPHASE = RunningInfoLayout(InverterType.SINGLEPHASE, _runningInfoFields(False))                    # 46 bytes
+RUNNINGINFO_SINGLEPHASE_SHORT = RunningInfoLayout(InverterType.SINGLEPHASE, _runningInfoFields(False, eDay = False)) # 44 bytes, without eDay
+RUNNINGINFO_THREEPHASE = RunningInfoLayout(InverterType.THREEPHASE, _runningInfoFields(True))                       # 66 bytes
+
+
+def getRunningInfoLayout(dataLength):
+    #layout to decode a running info frame with dataLength data bytes, None if the frame is too short
+    if dataLength == RUNNINGINFO_THREEPHASE.size:
+        return RUNNINGINFO_THREEPHASE
+    if dataLength >= RUNNINGINFO_SINGLEPHASE.size:
+        return RUNNINGINFO_SINGLEPHASE
+    if dataLength >= RUNNINGINFO_SINGLEPHASE_SHORT.size:
+        return RUNNINGINFO_SINGLEPHASE_SHORT
+    return None
+
+
+_udevContext = None
+
+def getUdevContext():
+    #opening a udev context reads the udev configuration, do it once
+    global _udevContext
+    if _udevContext is None:
+        #pyudev is only imported for real devices, not for the simulator, replays or ctl
+        from pyudev import Context
+        _udevContext = Context()
+    return _udevContext
+
+
+def isGoodWeDevice(udev, vendorId, modelId):
+    #the DEVPATH of a hidraw node contains the bus:vendor:model.instance of its HID device
+    return udev.device_node is not None and udev.device_path.find(str(vendorId) + ":" + str(modelId)) > -1
+
+
+# firmware version, model name, manufacturer, serial number, nominal PV voltage, internal version (all ascii) and safety country code
+IDINFO = struct.Struct('>5s10s16s16s4s12sB')
+# PV start-up voltage, time to connect, grid voltage min and max, grid frequency min and max
+SETTINGINFO = struct.Struct('>HHHHHH')
+
+
+def decodeIdInfo(data):
+    idInfo = IdInfo()
+    firmwareVersion, modelName, manufacturer, serial, nominalVpv, internalVersion, safetyCountryCode = IDINFO.unpack_from(data)
+    text = lambda value: value.decode('ascii', 'replace').strip(' \x00')
+    idInfo.firmwareVersion = text(firmwareVersion)
+    idInfo.modelName = text(modelName)
+    idInfo.manufacturer = text(manufacturer)
+    idInfo.serial = text(serial)
+    try:
+        #ascii digits in 0.1V, '3600' is 360.0V
+        idInfo.nominalVpv = float(text(nominalVpv)) / 10
+    except ValueError:
+        pass
+    idInfo.internalVersion = text(internalVersion)
+    idInfo.safetyCountryCode = safetyCountryCode
+    if safetyCountryCode < len(IdInfo.SAFETY_COUNTRIES):
+        idInfo.safetyCountry = IdInfo.SAFETY_COUNTRIES[safetyCountryCode]
+    return idInfo
+
+
+def decodeSettingInfo(data):
+    settingInfo = SettingInfo()
+    vpvStart, settingInfo.tStart, vacMin, vacMax, facMin, facMax = SETTINGINFO.unpack_from(data)
+    settingInfo.vpvStart = vpvStart / 10.0
+    settingInfo.vacMin = vacMin / 10.0
+    settingInfo.vacMax = vacMax / 10.0
+    settingInfo.facMin = facMin / 100.0
+    settingInfo.facMax = facMax / 100.0
+    return settingInfo
+
+
+def findGoodWeUSBDevices(vendorId, modelId):
+    #all hidraw devices of GoodWe inverters, sorted so the device numbering is stable
+    return sorted(udev.device_node for udev in getUdevContext().list_devices(subsystem = 'hidraw')
+                  if isGoodWeDevice(udev, vendorId, modelId))
+
+
+class DeviceMonitor(object):
+    """
+    Hotplug events of GoodWe devices from the udev netlink socket. Register
+    it with a selector and call events() when it becomes readable, instead
+    of running a MonitorObserver thread.
+    """
+
+    def __init__(self, vendorId, modelId):
+        self.vendorId = vendorId
+        self.modelId = modelId
+        from pyudev import Monitor
+        self.monitor = Monitor.from_netlink(getUdevContext())
+        self.monitor.filter_by('hidraw')
+        self.monitor.start()
+
+    def fileno(self):
+        return self.monitor.fileno()
+
+    def events(self):
+        #(action, device node) of the pending events, action is 'add' or 'remove'
+        events = []
+        while True:
+            udev = self.monitor.poll(timeout = 0)
+            if udev is None:
+                return events
+            if udev.action in ('add', 'remove') and isGoodWeDevice(udev, self.vendorId, self.modelId):
+                events.append((udev.action, udev.device_node))
+
+
+class FrameBuffer(object):
+    """
+    Reassembles GoodWe frames from the raw bytes of the HID reports.
+
+    Reports are appended to a bytearray, frame headers are located with
+    bytearray.find and complete frames are handed out as memoryview slices
+    of the buffer, so no byte is copied on its way to the decoder.
+    Some types of inverters send out garbage all the time; everything that
+    is not part of a frame with a valid crc is skipped.
+    """
+
+    HEADER = b'\xAA\x55'
+    MAX_DATA_LENGTH = 89            #longest data part we accept, a longer length means we locked on garbage
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.start = 0                #first byte in the buffer that has not been processed
+        self.frameCount = 0
+        self.garbageBytes = 0        #number of bytes skipped because they are not part of a frame
+        self.crcErrors = 0
+
+    def clear(self):
+        self.buffer = bytearray()
+        self.start = 0
+
+    def feed(self, data):
+        self.buffer += data
+
+    def frames(self):
+        """
+        Yields every complete frame with a valid crc, without the 0xAA 0x55 header.
+        A frame is only valid until the next one is requested, copy what needs to be kept.
+        """
+        buffer = self.buffer
+        view = memoryview(buffer)
+        try:
+            while True:
+                pos = buffer.find(self.HEADER, self.start)
+                if pos < 0:
+                    #keep a trailing 0xAA, it might be the first half of a header
+                    end = len(buffer) - 1 if buffer.endswith(b'\xAA') else len(buffer)
+                    self.garbageBytes += end - self.start
+                    self.start = end
+                    break
+
+                self.garbageBytes += pos - self.start
+                self.start = pos
+                if len(buffer) < pos + 7:
+                    break
+
+                dataLength = buffer[pos + 6]
+                if dataLength > self.MAX_DATA_LENGTH:
+                    self.garbageBytes += 1
+                    self.start = pos + 1
+                    continue
+
+                #header, source, destination, control code, function code, length, data and crc
+                end = pos + 9 + dataLength
+                if len(buffer) < end:
+                    #wait for the rest, the data can contain 0xAA 0x55 as well. If we locked on garbage the crc
+                    #tells once the length, at most MAX_DATA_LENGTH, has arrived, and we resync from there.
+                    break
+
+                #the crc is the sum of all bytes, including the header
+                if (sum(view[pos:end - 2]) & 0xffff) != ((buffer[end - 2] << 8) | buffer[end - 1]):
+                    #not a frame after all, look for the next header after this one
+                    self.crcErrors += 1
+                    self.garbageBytes += 1
+                    self.start = pos + 1
+                    continue
+
+                self.start = end
+                self.frameCount += 1
+                frame = view[pos + 2:end]
+                yield frame
+                frame.release()
+        finally:
+            view.release()
+            #drop the processed bytes. Only the start of an incomplete frame is left, so this copy is small.
+            if self.start:
+                self.buffer = buffer[self.start:]
+                self.start = 0
+
     
 class GoodWeCommunicator(object):
 
-    BUFFERSIZE = 96
+    MAX_REPORTS_PER_READ = 16                    #reports read per wakeup, more data makes the device readable again
     GOODWE_COMMS_ADDRESS = 0x80        #our address
-    INVERTER_COMMS_ADDRESS = 0x0B    #inverter address. We only have one inverter using USB.
+    INVERTER_COMMS_ADDRESS = 0x0B    #inverter address. There is only one inverter on every USB device.
     STATE_TIMEOUT = 10000            #10 seconds timeout between states
     OFFLINE_TIMEOUT = 30000            #30 seconds no data -> inverter offline
     DISCOVERY_INTERVAL = 10000        #10 secs between discovery 
-    INFO_INTERVAL = 2500            #get inverter info every 2.5 second
-    DEFAULT_RESETWAIT = 30            #default wait time in seconds
+    POLL_MIN = 1000                    #ask for info at most every second while the inverter produces
+    POLL_MAX = 10000                #back off to every 10 seconds while it is idle or does not answer
+    RESPONSE_TIMEOUT = 2000            #minimal time to wait for the answer to an info query
+    STATIC_ATTEMPTS = 3                #times to ask for the ID and setting info before giving up
+    DEFAULT_RESETWAIT = 30            #longest wait in seconds before looking for a device that is not there
+    RESET_WAIT_MIN = 1000            #wait in ms before reopening a device that is there, doubled every time it is not
 
 
-    def __init__(self, logger, vendorId, modelId):
+    def __init__(self, logger, vendorId, modelId, devicePath = None, transportFactory = None):
         self.log = logger
         self.vendorId = vendorId
         self.modelId = modelId
-        self.inputBuffer = [0] * self.BUFFERSIZE
+        self.devicePath = devicePath            #fixed hidraw device to use, None to use the first GoodWe device found
+        self.transportFactory = transportFactory    #opens a transport for a device path, a hidraw device when None
+        self.inverterAddress = self.INVERTER_COMMS_ADDRESS    #every device is its own bus, so each communicator allocates its own address
+        self.frameBuffer = FrameBuffer()
         self.lastReceived = millis()             #timeout detection
-        self.startPacketReceived = False        #start packet marker
-        self.lastReceivedByte = 0                #packet start consist of 2 bytes to test. This holds the previous byte
-        self.curReceivePtr = 0                    #the ptr in our OutputBuffer when reading
-        self.numToRead = 0                        #number of bytes to read after the header is read.
+        self.capture = None                        #GoodWeCapture.CaptureWriter for the raw reports, if enabled
+        self.onRunningInfo = None                #called with the inverter after every decoded running info
+        self.onRegistered = None                #called with the inverter when its address is confirmed
+        self.resumeRegistration = False            #try the known address of the inverter before discovery when connected
+        self.resuming = False                    #a known address is being tried
 
         self.lastDiscoverySent = 0                #discovery needs to be sent every 10 secs. 
         self.lastInfoUpdateSent = 0                #last info update sent to the registered inverters
+        self.queryPending = False                #an info query was sent and its answer has not arrived yet
+        self.pendingQuery = None                #function code of that query
+        self.staticQueries = []                    #ID and setting queries still to do after a registration
+        self.staticAttempts = 0
+        self.pollMin = self.POLL_MIN
+        self.pollMax = self.POLL_MAX
+        self.pollInterval = self.POLL_MIN        #current time between info queries, between pollMin and pollMax
+        self.rtt = 0                            #round trip time of the last info query in ms
+        self.rttAvg = 0.0                        #moving average of the round trip time
+        self.queryTimeouts = 0
+        self.rttHistogram = Histogram()            #round trip times in seconds
+        self.pollAlign = True                    #poll on wall clock multiples of the poll interval, e.g. every second on the second
+        self.pollJitter = Histogram(JITTER_BUCKETS)    #seconds queries were sent after their scheduled time
+        self.pollJitterMax = 0                    #ms
+        self.requestTime = 0                    #UTC ms since the epoch the last query was sent
+        self.receiveTime = None                    #and the last report was received
+        self.lastSeen = 0                        #when was the inverter last seen? If not seen for 30 seconds the inverter is marked offline.
+        self.stateCounts = dict((state, 0) for state in State)    #transitions into every state
+        self.stateTimeouts = 0
+        self.resets = 0                            #attempts to (re)open the device
 
         self.state = State.OFFLINE
         self.statetime = millis()
+        self.resetDeadline = None                #when to try to (re)open the USB device while OFFLINE
+        self.resetWait = 0                        #the first open is right away, there is nothing to wait for yet
 
         self.inverter = Inverter()
         self.rawdevice = None
-        self.devfp = None
-        self.device = None
+        self.transport = None
+
+        self.frameCache = {}                    #(address, control code, function code) -> report of the frames without data
+        self.sendBuffer = bytearray(REPORT_HEADER.size + FrameBuffer.MAX_DATA_LENGTH + CRC.size)    #reused for frames with data
+        self.allocReport = None                    #report of the last allocation request, resent until it is confirmed
+        self.allocSerialNumber = None            #serial number and address the allocation report was built for
+        self.allocAddress = None
+        #hex dumps are only built when they are logged, the logger can also be the logging module
+        self.isEnabledFor = getattr(logger, 'isEnabledFor', None) or logging.getLogger().isEnabledFor
 
 
     def resetUSBDevice(self):
+        self.resets += 1
         self.closeDevice()
         
-        time.sleep(self.DEFAULT_RESETWAIT)
-        
-        self.rawdevice = self.findGoodWeUSBDevice()
+        if self.devicePath is None:
+            self.rawdevice = self.findGoodWeUSBDevice()
+        elif self.transportFactory is not None or os.path.exists(self.devicePath):
+            self.rawdevice = self.devicePath
+
         if self.rawdevice is None:
             self.log.error('No GoodWe Inverter found.')
             return
@@ -191,165 +640,140 @@ class GoodWeCommunicator(object):
         self.log.debug('Found GoodWe Inverter at %s', self.rawdevice)
         
         self.lastReceived = millis()
-        self.startPacketReceived = False
-        self.curReceivePtr = 0
-        self.numToRead = 0
-        self.lastReceivedByte = 0x00
+        self.frameBuffer.clear()
         self.inverter.runningInfo = RunningInfo()
+        self.queryPending = False
+        self.pollInterval = self.pollMin
         
         if self.openDevice():
             self.setState(State.CONNECTED)
     
     
     def findGoodWeUSBDevice(self):
-        context = Context()
-        
-        usb_list = [d for d in os.listdir("/dev") if d.startswith("hidraw")]
-        for hidraw in usb_list:
-            device = "/dev/" + hidraw
-
-            udev = Devices.from_device_file(context, device)
-            
-            if udev['DEVPATH'].find(str(self.vendorId) + ":" + str(self.modelId)) > -1:
-                return device
+        devices = findGoodWeUSBDevices(self.vendorId, self.modelId)
+        if devices:
+            return devices[0]
         
         return None
     
     
     def openDevice(self):
         try:
-            #open in non-blocking mode
-            self.devfp = open(self.rawdevice, 'r+b')
-            fd = self.devfp.fileno()
-            flag = fcntl.fcntl(fd, fcntl.F_GETFL)
-            fcntl.fcntl(fd, fcntl.F_SETFL, flag | os.O_NONBLOCK)
-        
-            self.device = hidraw.HIDRaw(self.devfp)
+            if self.transportFactory is None:
+                # hidrawpure and its ioctls only when a real device is opened, not for the simulator, replay or ctl
+                from GoodWeTransport import HidrawTransport
+                self.transport = HidrawTransport(self.rawdevice)
+            else:
+                self.transport = self.transportFactory(self.rawdevice)
 
             self.log.debug ("Connected to %s", self.rawdevice)
             
             return True
         except Exception as e:
-            self.log.error("Unable to open %s", self.rawdevice)
+            self.log.error("Unable to open %s: %s", self.rawdevice, e)
             return False
             
 
     def closeDevice(self):
-        self.device = None
-        if not self.devfp is None:
+        if not self.transport is None:
             try:
-                self.devfp.close()
+                self.transport.close()
             except Exception as e:
                 self.log.debug("Unable to close device: %s", e)
 
-        self.devfp = None
+        self.transport = None
         self.rawdevice = None
 
     def setState(self, state):
+        if state != self.state:
+            self.stateCounts[state] += 1
         self.state = state
         self.statetime = millis()
         
 
     def sendRemoveRegistration(self):
         #send out the remove address to the inverter. If the inverter is still connected it will reconnect after discovery
-        self.sendData(self.INVERTER_COMMS_ADDRESS, CC_REG, FC_REMREG, NODATA)
+        self.sendData(self.inverterAddress, CC_REG, FC_REMREG, NODATA)
+
+
+    def buildReport(self, buffer, address, controlCode, functionCode, dataLength, data = None):
+        #write the USB report into buffer and return its length: USB header, frame header, data and crc
+        REPORT_HEADER.pack_into(buffer, 0, 0xCC, 0x99, 9 + dataLength,
+                                0xAA, 0x55, self.GOODWE_COMMS_ADDRESS, address, controlCode, functionCode, dataLength)
+        end = REPORT_HEADER.size + dataLength
+        if dataLength:
+            buffer[REPORT_HEADER.size:end] = data if len(data) == dataLength else data[0:dataLength]
+        #the crc is the addition of all frame bytes, starting at 0xAA
+        CRC.pack_into(buffer, end, sum(memoryview(buffer)[3:end]) & 0xffff)
+        return end + CRC.size
 
 
     def sendData(self, address, controlCode, functionCode, dataLength, data = None):
-        if self.devfp is None:
+        if self.transport is None:
             return
-            
-        #send the header first
-        buffer = bytearray([0xAA, 0x55, self.GOODWE_COMMS_ADDRESS, address, controlCode, functionCode, dataLength])
-        #check if we need to write the data part and send it.
-        for i in range(dataLength):
-            buffer.append(data[i])
-        #need to send out the crc which is the addition of all previous values.
-        crc = 0
-        for cnt in range(7 + dataLength):
-            crc += buffer[cnt]
-
-        #write out the high and low
-        high = (crc >> 8) & 0xff
-        low = crc & 0xff
-        buffer.append(high)
-        buffer.append(low)
-
-        # First 3 bytes are the header bytes and length of the full USB packet.
-        fullBuffer = bytearray([0xCC, 0x99, len(buffer)])
-        fullBuffer.extend(buffer)
-
-        self.log.debug("Sending data to inverter: %s", " ".join(hex(b) for b in fullBuffer))
-        
-        self.device.sendOutputReport(bytes(fullBuffer))
-        return len(fullBuffer) #USBHeader, USBlength, header, data, crc
+
+        if dataLength == 0:
+            #queries, discovery and removal are the same every time
+            report = self.frameCache.get((address, controlCode, functionCode))
+            if report is None:
+                buffer = bytearray(REPORT_HEADER.size + CRC.size)
+                self.buildReport(buffer, address, controlCode, functionCode, 0)
+                report = self.frameCache[(address, controlCode, functionCode)] = bytes(buffer)
+        else:
+            report = memoryview(self.sendBuffer)[:self.buildReport(self.sendBuffer, address, controlCode, functionCode, dataLength, data)]
+
+        return self.writeReport(report)
+
+
+    def writeReport(self, report):
+        if self.isEnabledFor(logging.DEBUG):
+            self.log.debug("Sending data to inverter: %s", " ".join(hex(b) for b in report))
+
+        if self.capture is not None:
+            self.capture.write(capture.SENT, report)
+        self.transport.write(report)
+        return len(report) #USBHeader, USBlength, header, data, crc
 
 
     def checkIncomingData(self):
-        try:
-            datstr = self.devfp.read(8)
-            if datstr == None:
-                raise IOError
-
-            for data in bytearray(datstr):
-                incomingData = data
-                # continuously check for GoodWe HEADER packets.
-                # Some types of Inverters send out garbage all the time. The header packet is the only true marker for a meaningfull command following.
-                if self.lastReceivedByte == 0xAA and incomingData == 0x55:
-                    #packet start received
-                    self.startPacketReceived = True
-                    self.curReceivePtr = 0
-                    self.numToRead = 0
-                    self.lastReceivedByte = 0x00 #reset last received for next packet
-
-                elif self.startPacketReceived:
-                    if self.numToRead > 0 or self.curReceivePtr < 5:
-                        self.inputBuffer[self.curReceivePtr] = incomingData
-                        self.curReceivePtr += 1
-                        if self.curReceivePtr == 5:
-                            #we received the data length. keep on reading until data length is read.
-                            #we need to add two for the crc calculation
-                            self.numToRead = self.inputBuffer[4] + 2
-
-                        elif self.curReceivePtr > 5:
-                            self.numToRead -= 1
-
-                    if self.curReceivePtr >= 5 and self.numToRead == 0:
-                        #got the complete packet
-                        #parse it
-                        self.startPacketReceived = False
-                        self.parseIncomingData(self.curReceivePtr)
-
-                self.lastReceivedByte = incomingData #keep track of the last incoming byte so we detect the packet start
-
-            self.lastReceived = millis()
-        except IOError as e:
-            pass
-
-    def parseIncomingData(self, incomingDataLength):
-        #first check the crc
-        #Data always start without the start bytes of 0xAA 0x55
-        #incomingDataLength also has the crc data in it
-        
-        crc = 0xAA + 0x55
-        for cnt in range(0, incomingDataLength - 2):
-            crc += self.inputBuffer[cnt]
- 
-        high = (crc >> 8) & 0xff
-        low = crc & 0xff
- 
-        #match the crc
-        if not (high == self.inputBuffer[incomingDataLength - 2] and low == self.inputBuffer[incomingDataLength - 1]):
+        if self.transport is None:
             return
-        
-        src = self.inputBuffer[0]
-        dst = self.inputBuffer[1]
-        cc = self.inputBuffer[2]
-        fc = self.inputBuffer[3]
-        len = self.inputBuffer[4]
-        data = self.inputBuffer[5:]
-
-        self.log.debug('|0xAA 0x55|%s|%s|%s|%s|%s|%s|OK|', hex(src),hex(dst),hex(cc),hex(fc),hex(len),' '.join(hex(b) for b in data[0:len]))
+
+        try:
+            for i in range(self.MAX_REPORTS_PER_READ):
+                report = self.transport.read()
+                if report is None:
+                    break
+                self.receiveTime = epochMillis()
+                if self.capture is not None:
+                    self.capture.write(capture.RECEIVED, report)
+                self.frameBuffer.feed(report)
+        except (IOError, OSError) as e:
+            #the device is gone, the state machine takes care of it when it times out
+            self.log.debug("Unable to read from device: %s", e)
+
+        self.receiveData(b'')
+        self.lastReceived = millis()
+
+
+    def receiveData(self, data):
+        #feed raw report bytes and handle all frames that are complete. Also used to replay captures.
+        self.frameBuffer.feed(data)
+        for frame in self.frameBuffer.frames():
+            self.parseIncomingData(frame)
+
+
+    def parseIncomingData(self, frame):
+        #frame starts without the start bytes of 0xAA 0x55 and ends with the crc, which is already checked
+        src = frame[0]
+        dst = frame[1]
+        cc = frame[2]
+        fc = frame[3]
+        len = frame[4]
+        data = frame[5:]
+
+        if self.isEnabledFor(logging.DEBUG):
+            self.log.debug('|0xAA 0x55|%s|%s|%s|%s|%s|%s|OK|', hex(src),hex(dst),hex(cc),hex(fc),hex(len),' '.join(hex(b) for b in data[0:len]))
  
         #check the control code and function code to see what to do
         if cc == CC_REG and fc == FC_REMCONF:
@@ -360,6 +784,10 @@ class GoodWeCommunicator(object):
             self.handleRegistrationConfirmation(src)
         elif cc == CC_READ and fc == FC_RESRUN:
             self.handleIncomingInformation(src, len, data)
+        elif cc == CC_READ and fc == FC_RESID:
+            self.handleIdInfo(len, data)
+        elif cc == CC_READ and fc == FC_RESSTT:
+            self.handleSettingInfo(len, data)
 
 
     def handleRegistration(self, serialNumber, length):
@@ -368,10 +796,15 @@ class GoodWeCommunicator(object):
             return
  
         self.inverter.addressConfirmed = False
-        self.inverter.lastSeen = millis()
-        self.inverter.serialNumber = serialNumber[0:16]
-        self.inverter.serial = "".join(map(chr, serialNumber[0:16]))
-        self.inverter.address = self.INVERTER_COMMS_ADDRESS
+        self.inverterSeen()
+        self.inverter.serialNumber = list(serialNumber[0:16])
+        serial = "".join(map(chr, self.inverter.serialNumber))
+        if serial != self.inverter.serial:
+            #another inverter, forget what we know about the previous one
+            self.inverter.idInfo = None
+            self.inverter.settingInfo = None
+        self.inverter.serial = serial
+        self.inverter.address = self.inverterAddress
         self.log.info("New inverter found with serial id: %s. Register address.", self.inverter.serial)
  
         self.setState(State.ALLOC)
@@ -380,12 +813,19 @@ class GoodWeCommunicator(object):
     def sendAllocateRegisterAddress(self, serialNumber, address):
         self.log.debug("SendAllocateRegisterAddress address: %s", address)
  
-        #create our registrationpacket with serialnumber and address and send it over
-        registerData = bytearray()
-        registerData.extend(serialNumber[0:16])
-        registerData.append(address)
+        #create our registrationpacket with serialnumber and address. It is sent again until the inverter confirms it,
+        #so it is only built for another serial number or address.
+        if self.allocReport is None or serialNumber != self.allocSerialNumber or address != self.allocAddress:
+            registerData = bytearray(serialNumber[0:16])
+            registerData.append(address)
+            buffer = bytearray(REPORT_HEADER.size + len(registerData) + CRC.size)
+            self.buildReport(buffer, 0x7F, CC_REG, FC_ALLOCREG, len(registerData), registerData)
+            self.allocReport = bytes(buffer)
+            self.allocSerialNumber = list(serialNumber)
+            self.allocAddress = address
         #need to send alloc msg
-        self.sendData(0x7F, CC_REG, FC_ALLOCREG, len(registerData), registerData)
+        if self.transport is not None:
+            self.writeReport(self.allocReport)
         
         self.setState(State.ALLOC_WAIT_CONFIRM)
  
@@ -396,120 +836,118 @@ class GoodWeCommunicator(object):
         #lookup the inverter and set it to confirmed
         if self.inverter.address == address:
             self.log.debug("Confirmed address: %s", address)
-            self.inverter.addressConfirmed = True
-            self.inverter.isOnline = True #inverter is online, we first need to get its information
-            self.inverter.lastSeen = millis()
-
-            self.log.info('Inverter now online.')
- 
-            #get the information straight away
-            self.setState(State.ALLOC_ASK_INFO)
+            self.registrationConfirmed()
         else:
             self.log.error("Could not find the inverter with address: %s", address)
             self.setState(State.OFFLINE)
 
 
+    def registrationConfirmed(self):
+        self.inverter.addressConfirmed = True
+        self.inverter.isOnline = True #inverter is online, we first need to get its information
+        self.inverterSeen()
+        self.resuming = False
+        #the next connect tries this address first
+        self.resumeRegistration = True
+
+        self.log.info('Inverter now online.')
+
+        #ask for the static information once per registration, in between the running info queries
+        self.staticQueries = [FC_QRYID, FC_QRYSTT]
+        self.staticAttempts = 0
+
+        if self.onRegistered is not None:
+            self.onRegistered(self.inverter)
+
+        #get the information straight away
+        self.setState(State.ALLOC_ASK_INFO)
+
+
+    def restoreRegistration(self, serial, address):
+        #warm start with an inverter registered by a previous run, discovery is the fallback
+        self.inverter.serial = serial
+        self.inverter.serialNumber = list(bytearray(serial.encode('latin-1')))
+        self.inverter.address = address
+        self.resumeRegistration = True
+
+
     def handleIncomingInformation(self, address, dataLength, data):
         self.log.debug("Handle incoming information")
-        if dataLength < 44:
+        layout = getRunningInfoLayout(dataLength)
+        if layout is None:
             return
 
-        runningInfo = RunningInfo()
-        inverterType = InverterType.SINGLEPHASE
-            
-        if dataLength == 66:
-            inverterType = InverterType.THREEPHASE
-
-        runningInfo.timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-        dtPtr = 0
-        runningInfo.vpv1 = self.bytesToFloat(data[dtPtr:], 10)
-        dtPtr += 2
-        runningInfo.vpv2 = self.bytesToFloat(data[dtPtr:], 10)
-        dtPtr += 2
-        runningInfo.ipv1 = self.bytesToFloat(data[dtPtr:], 10)
-        dtPtr += 2
-        runningInfo.ipv2 = self.bytesToFloat(data[dtPtr:], 10)
-        dtPtr += 2
-        runningInfo.vac1 = self.bytesToFloat(data[dtPtr:], 10)
-        dtPtr += 2
-        if inverterType == InverterType.THREEPHASE:
-            runningInfo.vac2 = self.bytesToFloat(data[dtPtr:], 10)
-            dtPtr += 2
-            runningInfo.vac3 = self.bytesToFloat(data[dtPtr:], 10)
-            dtPtr += 2
- 
-        runningInfo.iac1 = self.bytesToFloat(data[dtPtr:], 10)
-        dtPtr += 2
-        if inverterType == InverterType.THREEPHASE:
-            runningInfo.iac2 = self.bytesToFloat(data[dtPtr:], 10)
-            dtPtr += 2
-            runningInfo.iac3 = self.bytesToFloat(data[dtPtr:], 10)
-            dtPtr += 2
- 
-        runningInfo.fac1 = self.bytesToFloat(data[dtPtr:], 100)
-        dtPtr += 2
-        if inverterType == InverterType.THREEPHASE:
-            runningInfo.fac2 = self.bytesToFloat(data[dtPtr:], 100)
-            dtPtr += 2
-            runningInfo.fac3 = self.bytesToFloat(data[dtPtr:], 100)
-            dtPtr += 2
- 
-        runningInfo.pac = (data[dtPtr] << 8) | (data[dtPtr + 1])
-        dtPtr += 2
-        runningInfo.workMode = (data[dtPtr] << 8) | (data[dtPtr + 1])
-        dtPtr += 2
-        runningInfo.temp = self.bytesToFloat(data[dtPtr:], 10)
-        dtPtr += 2
-        errorMessage = (data[dtPtr] << 24) | (data[dtPtr + 1] << 16) | (data[dtPtr + 2] << 8) | (data[dtPtr + 3])
-        runningInfo.errorMessage = [i for i, x in enumerate(reversed(bin(errorMessage))) if x == "1"]
-        dtPtr += 4
-        runningInfo.eTotal = self.bytes4ToFloat(data[dtPtr:], 10)
-        dtPtr += 4
-        runningInfo.hTotal = (data[dtPtr] << 24) | (data[dtPtr + 1] << 16) | (data[dtPtr + 2] << 8) | (data[dtPtr + 3])
-        dtPtr += 4
-        runningInfo.tempFault = self.bytesToFloat(data[dtPtr:], 10)
-        dtPtr += 2
-        runningInfo.pv1Fault = self.bytesToFloat(data[dtPtr:], 10)
-        dtPtr += 2
-        runningInfo.pv2Fault = self.bytesToFloat(data[dtPtr:], 10)
-        dtPtr += 2
-        runningInfo.line1VFault = self.bytesToFloat(data[dtPtr:], 10)
-        dtPtr += 2
-        if inverterType == InverterType.THREEPHASE:
-            runningInfo.line2VFault = self.bytesToFloat(data[dtPtr:], 10)
-            dtPtr += 2
-            runningInfo.line3VFault = self.bytesToFloat(data[dtPtr:], 10)
-            dtPtr += 2
-        
-        runningInfo.line1FFault = self.bytesToFloat(data[dtPtr:], 100)
-        dtPtr += 2
-        if inverterType == InverterType.THREEPHASE:
-            runningInfo.line2FFault = self.bytesToFloat(data[dtPtr:], 100)
-            dtPtr += 2
-            runningInfo.line3FFault = self.bytesToFloat(data[dtPtr:], 100)
-            dtPtr += 2
-
-        runningInfo.gcfiFault = (data[dtPtr] << 8) | (data[dtPtr + 1])
-        dtPtr += 2
-        runningInfo.eDay = self.bytesToFloat(data[dtPtr:], 10)
-
-        self.inverter.lastSeen = millis()
+        runningInfo = layout.decode(data)
+        runningInfo.requestTime = self.requestTime
+        runningInfo.responseTime = self.receiveTime if self.receiveTime is not None else epochMillis()
+        runningInfo.timestamp = time.strftime("%Y%m%d%H%M%S", time.localtime(runningInfo.responseTime // 1000))
+
+        if self.queryPending and self.pendingQuery == FC_QRYRUN:
+            self.queryPending = False
+            self.rtt = millis() - self.lastInfoUpdateSent
+            self.rttAvg = self.rtt if self.rttAvg == 0 else self.rttAvg * 0.9 + self.rtt * 0.1
+            self.rttHistogram.observe(self.rtt / 1000.0)
+        #poll fast while producing, slow down when the inverter is idle, e.g. waiting for the sun at dawn and dusk
+        if runningInfo.pac == 0:
+            self.pollInterval = min(self.pollMax, self.pollInterval * 2)
+        else:
+            self.pollInterval = self.pollMin
+
+        self.inverterSeen()
         self.inverter.isOnline = True
         
-        self.inverter.inverterType = inverterType
+        self.inverter.inverterType = layout.inverterType
         self.inverter.runningInfo = runningInfo
 
+        if self.onRunningInfo is not None:
+            self.onRunningInfo(self.inverter)
+
          
-    def bytesToFloat(self, bt, factor):
-        #convert two byte to float and then dividing it by factor
-        return float((bt[0] << 8) | bt[1]) / factor
+    def handleIdInfo(self, dataLength, data):
+        if dataLength < IDINFO.size:
+            return
+        idInfo = decodeIdInfo(data)
+        if self.state == State.RESUME:
+            self.queryPending = False
+            if idInfo.serial != self.inverter.serial.strip(" \x00"):
+                #another inverter took the address, start over
+                self.log.info("Found inverter %s instead of %s, looking for inverters", idInfo.serial, self.inverter.serial)
+                self.inverter.serial = ""
+                self.inverter.serialNumber = []
+                self.inverter.idInfo = None
+                self.inverter.settingInfo = None
+                self.setState(State.CONNECTED)
+                return
+            self.inverter.idInfo = idInfo
+            self.registrationConfirmed()
+            self.staticQueries.remove(FC_QRYID)
+            return
+
+        self.inverter.idInfo = idInfo
+        self.log.info("Inverter %s: model %s, firmware %s", self.inverter.serial, self.inverter.idInfo.modelName, self.inverter.idInfo.firmwareVersion)
+        self.staticQueryAnswered(FC_QRYID)
+
+
+    def handleSettingInfo(self, dataLength, data):
+        if dataLength < SETTINGINFO.size:
+            return
+        self.inverter.settingInfo = decodeSettingInfo(data)
+        self.staticQueryAnswered(FC_QRYSTT)
+
+
+    def staticQueryAnswered(self, functionCode):
+        if self.queryPending and self.pendingQuery == functionCode:
+            self.queryPending = False
+        if functionCode in self.staticQueries:
+            self.staticQueries.remove(functionCode)
+            self.staticAttempts = 0
+
+
+    def inverterSeen(self):
+        self.lastSeen = millis()
+        self.inverter.lastSeen = epochMillis()
 
 
-    def bytes4ToFloat(self, bt, factor):
-        #convert four byte to float and then dividing it by factor
-        return float( (bt[0] << 24) | (bt[1] << 16) | (bt[2] << 8) | bt[3]) / factor
-        
-        
     def sendDiscovery(self):
         if not self.inverter.isOnline:
             #send out discovery for unregistered devices.
@@ -520,7 +958,7 @@ class GoodWeCommunicator(object):
     def checkOfflineInverter(self):
         #check inverter timeout
         if self.inverter.isOnline:
-            newOnline = ((millis() - self.inverter.lastSeen) < self.OFFLINE_TIMEOUT)
+            newOnline = ((millis() - self.lastSeen) < self.OFFLINE_TIMEOUT)
 
             #check if inverter timed out
             if not newOnline:
@@ -535,29 +973,66 @@ class GoodWeCommunicator(object):
     def askInverterForInformation(self, force = False):
         if force or (self.inverter.addressConfirmed and self.inverter.isOnline):
             self.sendData(self.inverter.address, CC_READ, FC_QRYRUN, NODATA)
+            self.lastInfoUpdateSent = millis()
+            self.requestTime = epochMillis()
+            self.queryPending = True
+            self.pendingQuery = FC_QRYRUN
 
             self.setState(State.RUNNING)
         else:
             self.log.debug('Skip inverter %s for information. Confirmed = %s, Online = %s', self.inverter.address, self.inverter.addressConfirmed, self.inverter.isOnline)
 
 
+    def askInverterForStaticInfo(self, functionCode = None):
+        if functionCode is None:
+            functionCode = self.staticQueries[0]
+        self.sendData(self.inverter.address, CC_READ, functionCode, NODATA)
+        self.lastInfoUpdateSent = millis()
+        self.requestTime = epochMillis()
+        self.queryPending = True
+        self.pendingQuery = functionCode
+
+
     def handle(self):
     
         # check for state timeouts
         if ((millis() - self.statetime) > self.STATE_TIMEOUT):
-            if self.state == State.RUNNING:
+            if self.state == State.RUNNING or self.state == State.OFFLINE:
                 self.statetime = millis()
             else:
                 self.log.debug("State machine time-out. Last state: %s", self.state)
-                self.state = State.OFFLINE
+                self.stateTimeouts += 1
+                self.setState(State.OFFLINE)
     
         if self.state == State.OFFLINE:
-            self.resetUSBDevice()
+            #close the device straight away, but only look for it again after the reset wait
+            if self.resetDeadline is None:
+                self.closeDevice()
+                self.resetDeadline = millis() + self.resetWait
+
+            if millis() >= self.resetDeadline:
+                self.resetDeadline = None
+                self.resetUSBDevice()
+                if self.transport is None:
+                    #back off while the device is missing, a hotplug event ends the wait
+                    self.resetWait = min(self.DEFAULT_RESETWAIT * 1000, max(self.RESET_WAIT_MIN, self.resetWait * 2))
+                else:
+                    self.resetWait = self.RESET_WAIT_MIN
         
         elif self.state == State.CONNECTED:
-            self.sendRemoveRegistration()
-            self.setState(State.DISCOVER)
-            time.sleep(1)
+            if self.resumeRegistration and self.inverter.serialNumber:
+                #once per registration: ask the inverter at its known address who it is, that takes one round trip
+                self.resumeRegistration = False
+                self.resuming = True
+                self.log.info("Resuming inverter %s at address %s", self.inverter.serial, self.inverter.address)
+                self.setState(State.RESUME)
+                self.askInverterForStaticInfo(FC_QRYID)
+            else:
+                self.resuming = False
+                self.sendRemoveRegistration()
+                self.setState(State.DISCOVER)
+                #give the inverter a second to process the removal before the first discovery
+                self.lastDiscoverySent = millis() - self.DISCOVERY_INTERVAL + 1000
         
         else:
             self.checkIncomingData()
@@ -569,15 +1044,45 @@ class GoodWeCommunicator(object):
             
             elif self.state == State.ALLOC:
                 self.sendAllocateRegisterAddress(self.inverter.serialNumber, self.inverter.address)
+
+            elif self.state == State.RESUME:
+                if millis() - self.lastInfoUpdateSent >= self.getResponseTimeout():
+                    #the inverter lost its address, e.g. after a power cycle. Give it the same one again.
+                    self.log.debug("No answer at address %s, allocating it again", self.inverter.address)
+                    self.queryPending = False
+                    self.sendAllocateRegisterAddress(self.inverter.serialNumber, self.inverter.address)
+
+            elif self.state == State.ALLOC_WAIT_CONFIRM:
+                if self.resuming and millis() - self.statetime >= self.getResponseTimeout():
+                    self.log.info("Inverter %s did not take its address again, looking for inverters", self.inverter.serial)
+                    self.setState(State.CONNECTED)
      
             elif self.state == State.ALLOC_ASK_INFO:
                 self.askInverterForInformation(True)
                 
             elif self.state == State.RUNNING:
-                #ask for info update every second
-                if millis() - self.lastInfoUpdateSent >= self.INFO_INTERVAL:
-                    self.askInverterForInformation()
-                    self.lastInfoUpdateSent = millis()
+                if self.queryPending and millis() - self.lastInfoUpdateSent >= self.getResponseTimeout():
+                    self.queryPending = False
+                    self.queryTimeouts += 1
+                    self.pollInterval = min(self.pollMax, self.pollInterval * 2)
+                    self.log.debug("No answer to info query within %d ms, next query in %d ms", self.getResponseTimeout(), self.pollInterval)
+                    if self.pendingQuery in self.staticQueries:
+                        self.staticAttempts += 1
+                        if self.staticAttempts >= self.STATIC_ATTEMPTS:
+                            self.log.warning("Inverter does not answer query 0x%02x, giving up until it registers again", self.pendingQuery)
+                            self.staticQueryAnswered(self.pendingQuery)
+
+                #the next query goes out as soon as the answer is in, but not before the poll interval
+                deadline = self.getPollDeadline()
+                if not self.queryPending and millis() >= deadline:
+                    scheduled = self.requestTime + deadline - self.lastInfoUpdateSent
+                    if self.staticQueries:
+                        self.askInverterForStaticInfo()
+                    else:
+                        self.askInverterForInformation()
+                    jitter = max(0, self.requestTime - scheduled)
+                    self.pollJitter.observe(jitter / 1000.0)
+                    self.pollJitterMax = max(self.pollJitterMax, jitter)
                 
                 #check response timeout
                 self.checkOfflineInverter()
@@ -585,5 +1090,165 @@ class GoodWeCommunicator(object):
             self.checkIncomingData()
 
 
+    def getTimeout(self):
+        #milliseconds until handle() has work to do when no data arrives from the inverter
+        now = millis()
+        if self.state == State.OFFLINE:
+            if self.resetDeadline is None:
+                return 0
+            deadline = self.resetDeadline
+
+        elif self.state == State.DISCOVER:
+            deadline = min(self.statetime + self.STATE_TIMEOUT + 1, self.lastDiscoverySent + self.DISCOVERY_INTERVAL)
+
+        elif self.state == State.ALLOC_WAIT_CONFIRM:
+            deadline = self.statetime + (self.getResponseTimeout() if self.resuming else self.STATE_TIMEOUT + 1)
+
+        elif self.state == State.RESUME:
+            deadline = self.lastInfoUpdateSent + self.getResponseTimeout()
+
+        elif self.state == State.RUNNING:
+            if self.queryPending:
+                deadline = self.lastInfoUpdateSent + self.getResponseTimeout()
+            else:
+                deadline = self.getPollDeadline()
+            if self.inverter.isOnline:
+                deadline = min(deadline, self.lastSeen + self.OFFLINE_TIMEOUT)
+
+        else:
+            return 0
+
+        return max(0, deadline - now)
+
+
+    def deviceAdded(self):
+        #hotplug: the device is there again, stop waiting
+        if self.state == State.OFFLINE:
+            self.resetWait = self.RESET_WAIT_MIN
+            if self.resetDeadline is not None:
+                self.resetDeadline = millis()
+
+
+    def rediscover(self):
+        #forget the registration and look for the inverter again, without closing the device
+        self.resumeRegistration = False
+        self.inverter.isOnline = False
+        self.inverter.addressConfirmed = False
+        if self.transport is not None:
+            self.setState(State.CONNECTED)
+        else:
+            self.deviceAdded()
+
+
+    def deviceRemoved(self):
+        #hotplug: don't wait for the timeouts to find out
+        if self.state != State.OFFLINE:
+            self.log.info("Device %s removed", self.rawdevice)
+            self.inverter.isOnline = False
+            self.setState(State.OFFLINE)
+        self.closeDevice()
+
+
+    def getPollDeadline(self):
+        #monotonic time of the next query
+        if not self.pollAlign or self.requestTime == 0:
+            return self.lastInfoUpdateSent + self.pollInterval
+        #the first multiple of the poll interval on the wall clock at least half an interval after the last query,
+        #so the samples of all inverters line up and a late query doesn't shift the ones after it
+        scheduled = self.requestTime - self.requestTime % self.pollInterval + self.pollInterval
+        if scheduled - self.requestTime < self.pollInterval // 2:
+            scheduled += self.pollInterval
+        return self.lastInfoUpdateSent + scheduled - self.requestTime
+
+
+    def getResponseTimeout(self):
+        #a slow inverter gets more time
+        return max(self.RESPONSE_TIMEOUT, int(self.rttAvg * 4))
+
+
+    def getStats(self):
+        return {
+            'state': self.state.name,
+            'online': self.inverter.isOnline,
+            'frames': self.frameBuffer.frameCount,
+            'crcErrors': self.frameBuffer.crcErrors,
+            'garbageBytes': self.frameBuffer.garbageBytes,
+            'stateTransitions': dict((state.name, count) for state, count in self.stateCounts.items()),
+            'stateTimeouts': self.stateTimeouts,
+            'resets': self.resets,
+            'queryTimeouts': self.queryTimeouts,
+            'pollInterval': self.pollInterval,
+            'rttAvg': round(self.rttAvg, 1),
+            'pollJitterAvg': round(1000.0 * self.pollJitter.sum / self.pollJitter.count, 1) if self.pollJitter.count else 0.0,
+            'pollJitterMax': self.pollJitterMax,
+        }
+
+
     def getInverter(self):
         return self.inverter
+
+
+class CommunicatorLoop(object):
+    """
+    Runs any number of communicators on one selector. A wakeup only happens
+    when a transport has data or when a communicator has a deadline, and
+    only those communicators are handled.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.communicators = {}        #device path -> communicator
+        self.registered = {}        #communicator -> registered transport
+        self.readers = {}            #other file objects on the selector -> callback
+
+    def add(self, device, gw):
+        self.communicators[device] = gw
+
+    def addReader(self, fileobj, callback):
+        #call back when fileobj becomes readable, e.g. for hotplug events
+        self.selector.register(fileobj, selectors.EVENT_READ, callback)
+        self.readers[fileobj] = callback
+
+    def removeReader(self, fileobj):
+        self.selector.unregister(fileobj)
+        del self.readers[fileobj]
+
+    def remove(self, device):
+        gw = self.communicators.pop(device)
+        gw.closeDevice()
+        self.updateSelector()
+        return gw
+
+    def updateSelector(self):
+        #transports are reopened after every reset, so track the transport objects rather than the fd numbers
+        for gw in list(self.registered):
+            if gw.transport is not self.registered[gw]:
+                self.selector.unregister(self.registered.pop(gw))
+
+        for gw in self.communicators.values():
+            if gw.transport is not None and gw not in self.registered:
+                self.selector.register(gw.transport, selectors.EVENT_READ, gw)
+                self.registered[gw] = gw.transport
+
+    def poll(self, timeout):
+        #wait at most timeout milliseconds for a communicator to have work, and handle it
+        self.updateSelector()
+
+        for gw in self.communicators.values():
+            timeout = min(timeout, gw.getTimeout())
+        events = self.selector.select(max(0, timeout) / 1000.0)
+
+        ready = set()
+        for key, mask in events:
+            if key.fileobj in self.readers:
+                key.data()
+            else:
+                ready.add(key.data)
+        for gw in list(self.communicators.values()):
+            if gw in ready or gw.getTimeout() == 0:
+                gw.handle()
+
+    def close(self):
+        for gw in self.communicators.values():
+            gw.closeDevice()
+        self.selector.close()
@@ -0,0 +1,132 @@
+"""
+Unix socket to control the running daemon.
+
+A client connects, sends one command line and gets one JSON document
+back: {"ok": true, "result": ...} or {"ok": false, "error": "..."}.
+The server is non-blocking and runs on the selector of the
+CommunicatorLoop, so commands are handled between two inverter events
+and never race with the communicators.
+
+    GoodWe.py ctl status
+    GoodWe.py ctl set pollmin 2000
+"""
+from __future__ import absolute_import
+import errno
+import logging
+import os
+import socket
+
+# simplejson supports byte strings
+import simplejson as json
+
+
+class ControlServer(object):
+
+    MAX_REQUEST = 4096            #bytes of a command line
+
+    def __init__(self, path, loop, handler):
+        #handler(list of words) returns the result, raises ValueError for a bad command
+        self.path = path
+        self.loop = loop
+        self.handler = handler
+        self.buffers = {}                #connection -> bytes received so far
+
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                raise IOError(errno.EADDRINUSE, 'Another daemon listens on %s' % path)
+            except socket.error as e:
+                if e.errno == errno.EADDRINUSE:
+                    raise
+                #left behind by a crash
+                os.remove(path)
+            finally:
+                probe.close()
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        os.chmod(path, 0o600)
+        self.server.listen(4)
+        self.server.setblocking(False)
+        loop.addReader(self.server, self.accept)
+
+    def fileno(self):
+        return self.server.fileno()
+
+    def accept(self):
+        try:
+            connection, address = self.server.accept()
+        except (IOError, OSError):
+            return
+        connection.setblocking(False)
+        self.buffers[connection] = b''
+        self.loop.addReader(connection, lambda: self.read(connection))
+
+    def read(self, connection):
+        try:
+            data = connection.recv(self.MAX_REQUEST)
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b''
+        if not data:
+            self.closeConnection(connection)
+            return
+
+        buffer = self.buffers[connection] + data
+        if b'\n' not in buffer and len(buffer) < self.MAX_REQUEST:
+            self.buffers[connection] = buffer
+            return
+
+        line = buffer.split(b'\n', 1)[0].decode('utf-8', 'replace')
+        try:
+            response = {'ok': True, 'result': self.handler(line.split())}
+        except ValueError as e:
+            response = {'ok': False, 'error': str(e)}
+        except Exception as e:
+            logging.exception('Control command %s failed', line)
+            response = {'ok': False, 'error': str(e)}
+
+        try:
+            #responses are small, a client that doesn't read them is cut off
+            connection.settimeout(1.0)
+            connection.sendall(json.dumps(response, sort_keys = True).encode('utf-8') + b'\n')
+        except (IOError, OSError) as e:
+            logging.debug('Unable to answer a control command: %s', e)
+        self.closeConnection(connection)
+
+    def closeConnection(self, connection):
+        self.loop.removeReader(connection)
+        del self.buffers[connection]
+        connection.close()
+
+    def close(self):
+        for connection in list(self.buffers):
+            self.closeConnection(connection)
+        self.loop.removeReader(self.server)
+        self.server.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def request(path, words, timeout = 5.0):
+    """
+    Send a command to the daemon listening on path and return its response document.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(path)
+        client.sendall((' '.join(words) + '\n').encode('utf-8'))
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        client.close()
+    return json.loads(b''.join(chunks))
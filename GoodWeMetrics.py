@@ -0,0 +1,168 @@
+"""
+Metrics of the daemon in the Prometheus text format and as a JSON document.
+
+The hot paths only increment plain integer attributes or call
+Histogram.observe, both well below a microsecond. Everything else happens
+when the metrics are read: collectors registered with a Registry turn the
+getStats() of the communicators and the publisher into metric families.
+MetricsServer serves them over HTTP from its own thread.
+"""
+from __future__ import absolute_import
+import bisect
+import threading
+
+
+# seconds, from a fast USB round trip to a broker that is down
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# seconds, deviation of scheduled work from its time
+JITTER_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram(object):
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)    #the last one counts the values above the highest bound
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        #(upper bound, number of values <= bound) like the Prometheus buckets, the last bound is inf
+        total = 0
+        buckets = []
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+    def quantile(self, fraction):
+        #upper bound of the bucket holding the quantile, good enough to alert on
+        if self.count == 0:
+            return 0.0
+        for bound, total in self.cumulative():
+            if total >= fraction * self.count:
+                return bound if bound != float('inf') else self.bounds[-1]
+
+
+class Metric(object):
+    """
+    A metric family as returned by a collector: samples are (labels dict, value) with
+    an int, float or Histogram value.
+    """
+
+    __slots__ = ('name', 'type', 'help', 'samples')
+
+    def __init__(self, name, type, help, samples = None):
+        self.name = name
+        self.type = type            #counter, gauge or histogram
+        self.help = help
+        self.samples = samples if samples is not None else []
+
+    def add(self, value, **labels):
+        self.samples.append((labels, value))
+        return self
+
+
+def formatLabels(labels, extra = None):
+    items = sorted(labels.items())
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in items) + '}'
+
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.collectors = []
+
+    def register(self, collector):
+        #collector() returns a list of Metric
+        self.collectors.append(collector)
+
+    def collect(self):
+        metrics = []
+        for collector in self.collectors:
+            metrics.extend(collector())
+        return metrics
+
+    def render(self):
+        #Prometheus text exposition format
+        lines = []
+        for metric in self.collect():
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for labels, value in metric.samples:
+                if isinstance(value, Histogram):
+                    for bound, total in value.cumulative():
+                        lines.append('%s_bucket%s %d' % (metric.name, formatLabels(labels, ('le', formatValue(bound))), total))
+                    lines.append('%s_sum%s %r' % (metric.name, formatLabels(labels), value.sum))
+                    lines.append('%s_count%s %d' % (metric.name, formatLabels(labels), value.count))
+                else:
+                    lines.append('%s%s %s' % (metric.name, formatLabels(labels), formatValue(value)))
+        return '\n'.join(lines) + '\n'
+
+    def toDict(self):
+        #for the JSON stats document: name -> value, or label values joined by ',' -> value for labelled metrics
+        stats = {}
+        for metric in self.collect():
+            for labels, value in metric.samples:
+                if isinstance(value, Histogram):
+                    value = {'count': value.count, 'sum': round(value.sum, 6),
+                             'p50': value.quantile(0.5), 'p95': value.quantile(0.95), 'p99': value.quantile(0.99)}
+                if labels:
+                    stats.setdefault(metric.name, {})[','.join(str(labels[name]) for name in sorted(labels))] = value
+                else:
+                    stats[metric.name] = value
+        return stats
+
+
+class MetricsServer(threading.Thread):
+
+    def __init__(self, registry, port, address = ''):
+        threading.Thread.__init__(self, name = 'GoodWeMetrics')
+        self.daemon = True
+        #only imported when metrics are served, http.server takes long to import
+        try:
+            from http.server import HTTPServer, BaseHTTPRequestHandler
+        except ImportError:
+            from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                #scrapes are not worth a line in the log
+                pass
+
+        self.server = HTTPServer((address, port), Handler)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
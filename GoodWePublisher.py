@@ -0,0 +1,357 @@
+"""
+MQTT publishing stage that never blocks the inverter loop.
+
+Messages are handed to a bounded in-memory queue and published from a
+dedicated thread. Messages for latest-value topics replace a pending
+message for the same topic, and when the queue is full the oldest
+message is dropped. While the broker is unreachable messages are
+appended to a spool file, which is drained in bulk after reconnecting
+and also survives a restart. Without a spool file they wait in the
+queue. The last retained message of every topic is published again
+after a reconnect.
+
+ChangeFilter reduces the running info to the values that actually
+changed, for publishing deltas instead of the full document.
+"""
+from __future__ import absolute_import
+import base64
+import collections
+import logging
+import os
+import threading
+import time
+
+# simplejson supports byte strings
+import simplejson as json
+
+from GoodWeMetrics import Histogram
+
+
+class Publisher(threading.Thread):
+
+    MAX_INFLIGHT = 100            #messages handed to paho but not yet written to the broker
+    RETRY_WAIT = 1.0            #seconds to wait after paho refused a message before trying again
+
+    def __init__(self, client, maxQueue = 1000, spoolFile = "", spoolMaxBytes = 10485760):
+        threading.Thread.__init__(self, name = 'GoodWePublisher')
+        self.daemon = True
+        self.client = client
+        self.maxQueue = maxQueue
+        self.spoolFile = spoolFile
+        self.spoolMaxBytes = spoolMaxBytes
+
+        self.queue = collections.deque()    #[topic, payload, retain, submitted]
+        self.pending = {}                    #topic -> queued entry that newer messages replace
+        self.inflight = {}                    #paho message id -> submitted
+        self.early = set()                    #message ids paho confirmed before we registered them
+        self.retained = {}                    #topic -> last retained payload, published again after a reconnect
+        self.condition = threading.Condition()
+        self.connected = False
+        self.retryAt = 0                    #time.time() before which nothing is sent after a refused message
+        self.running = True
+
+        self.published = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.spooled = 0
+        self.latencyTotal = 0.0
+        self.latencyMax = 0.0
+        self.latencyLast = 0.0
+        self.latencyHistogram = Histogram()
+
+        client.on_connect = self.onConnect
+        client.on_disconnect = self.onDisconnect
+        client.on_publish = self.onPublish
+
+    def submit(self, topic, payload, retain = False, coalesce = False):
+        """
+        Queue a message, never blocks. With coalesce a message still waiting for
+        the same topic is replaced, use it for topics where only the latest value counts.
+        """
+        with self.condition:
+            entry = self.pending.get(topic) if coalesce else None
+            if entry is not None:
+                entry[1] = payload
+                entry[2] = retain
+                self.coalesced += 1
+                return
+
+            if len(self.queue) >= self.maxQueue:
+                dropped = self.queue.popleft()
+                if self.pending.get(dropped[0]) is dropped:
+                    del self.pending[dropped[0]]
+                self.dropped += 1
+
+            entry = [topic, payload, retain, time.time()]
+            self.queue.append(entry)
+            if coalesce:
+                self.pending[topic] = entry
+            if retain:
+                self.retained[topic] = payload
+            self.condition.notify()
+
+    def stop(self, timeout = 5.0):
+        #publish what is left, or spool it when the broker is not there
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.join(timeout)
+
+    def setClient(self, client, maxQueue, spoolFile, spoolMaxBytes):
+        """
+        Publish through another client from now on, without stopping the thread. The old
+        client is disconnected in the background, what it didn't publish is sent again.
+        """
+        with self.condition:
+            old = self.client
+            self.client = client
+            self.maxQueue = maxQueue
+            self.spoolFile = spoolFile
+            self.spoolMaxBytes = spoolMaxBytes
+            while len(self.queue) > self.maxQueue:
+                dropped = self.queue.popleft()
+                if self.pending.get(dropped[0]) is dropped:
+                    del self.pending[dropped[0]]
+                self.dropped += 1
+            self.connected = False
+            self.inflight.clear()
+            self.early.clear()
+            client.on_connect = self.onConnect
+            client.on_disconnect = self.onDisconnect
+            client.on_publish = self.onPublish
+            self.condition.notify()
+        #callbacks of the old client are ignored from now on. paho's loop_stop joins its network thread, which may be waiting for a connect
+        threading.Thread(target = self.retire, args = (old,), name = 'GoodWeMQTTRetire', daemon = True).start()
+
+    def retire(self, client):
+        client.disconnect()
+        client.loop_stop()
+
+    def onConnect(self, client, userdata, flags, rc):
+        with self.condition:
+            if client is not self.client:
+                return
+            self.connected = (rc == 0)
+            if self.connected:
+                #retained state published on an old connection may never have reached the broker, or was dropped from
+                #the queue while waiting for the first one
+                queued = set(entry[0] for entry in self.queue)
+                for topic, payload in self.retained.items():
+                    if topic not in queued:
+                        entry = self.pending[topic] = [topic, payload, True, time.time()]
+                        self.queue.append(entry)
+            self.retryAt = 0
+            self.condition.notify()
+        if rc == 0:
+            logging.info('Connected to MQTT broker')
+        else:
+            logging.error('MQTT broker refused the connection: %s', rc)
+
+    def onDisconnect(self, client, userdata, rc):
+        with self.condition:
+            if client is not self.client:
+                return
+            self.connected = False
+            #messages written to a dead connection are gone, don't keep waiting for them
+            self.inflight.clear()
+            self.early.clear()
+            self.condition.notify()
+        logging.warning('Disconnected from MQTT broker: %s', rc)
+
+    def onPublish(self, client, userdata, mid):
+        with self.condition:
+            if client is not self.client:
+                return
+            submitted = self.inflight.pop(mid, None)
+            if submitted is None:
+                self.early.add(mid)
+            else:
+                latency = time.time() - submitted
+                self.latencyLast = latency
+                self.latencyTotal += latency
+                self.latencyMax = max(self.latencyMax, latency)
+                self.latencyHistogram.observe(latency)
+            self.condition.notify()
+
+    def canSend(self):
+        return self.connected and time.time() >= self.retryAt
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.hasWork():
+                    self.condition.wait(max(0.01, min(1.0, self.retryAt - time.time())))
+
+                if not self.running and (not self.queue or not (self.canSend() or self.spoolFile)):
+                    #without a broker or a spool file what is left is lost
+                    self.dropped += len(self.queue)
+                    return
+                connected = self.canSend()
+                entries = list(self.queue)
+                self.queue.clear()
+                self.pending.clear()
+
+            if connected:
+                if self.hasSpool():
+                    self.drainSpool()
+                for i, entry in enumerate(entries):
+                    if not self.send(entry[0], entry[1], entry[2], entry[3]):
+                        self.requeue(entries[i:])
+                        break
+            elif entries:
+                self.spool(entries)
+                if not self.running:
+                    return
+
+    def hasWork(self):
+        #called with the condition held
+        if not self.canSend():
+            #spool while the broker is away, or keep waiting in the queue without a spool file
+            return bool(self.queue) and bool(self.spoolFile) and not self.connected
+        return (bool(self.queue) and len(self.inflight) < self.MAX_INFLIGHT) or self.hasSpool()
+
+    def requeue(self, entries):
+        #messages that could not be sent: spooled, or back in front of the queue
+        if self.spoolFile:
+            self.spool(entries)
+            return
+        with self.condition:
+            self.queue.extendleft(reversed(entries))
+            while len(self.queue) > self.maxQueue:
+                dropped = self.queue.popleft()
+                if self.pending.get(dropped[0]) is dropped:
+                    del self.pending[dropped[0]]
+                self.dropped += 1
+
+    def send(self, topic, payload, retain, submitted):
+        with self.condition:
+            while self.connected and len(self.inflight) >= self.MAX_INFLIGHT:
+                self.condition.wait(1.0)
+            if not self.connected:
+                return False
+            info = self.client.publish(topic, payload, retain = retain)
+            if info.rc != 0:
+                #paho did not take it, usually it lost the connection and reports that shortly. Don't retry right away.
+                self.retryAt = time.time() + self.RETRY_WAIT
+                return False
+            if info.mid in self.early:
+                self.early.discard(info.mid)
+            else:
+                self.inflight[info.mid] = submitted
+            self.published += 1
+        return True
+
+    def hasSpool(self):
+        return bool(self.spoolFile) and os.path.exists(self.spoolFile) and os.path.getsize(self.spoolFile) > 0
+
+    def spool(self, entries):
+        if not self.spoolFile:
+            self.dropped += len(entries)
+            return
+
+        size = os.path.getsize(self.spoolFile) if os.path.exists(self.spoolFile) else 0
+        try:
+            with open(self.spoolFile, 'a') as fp:
+                for topic, payload, retain, submitted in entries:
+                    if isinstance(payload, (bytes, bytearray)):
+                        #binary payloads like MessagePack batches are no JSON strings, they are spooled as base64
+                        line = json.dumps([topic, base64.b64encode(payload).decode('ascii'), retain, submitted, 'base64']) + '\n'
+                    else:
+                        line = json.dumps([topic, payload, retain, submitted]) + '\n'
+                    if size + len(line) > self.spoolMaxBytes:
+                        self.dropped += 1
+                        continue
+                    fp.write(line)
+                    size += len(line)
+                    self.spooled += 1
+        except (IOError, OSError) as e:
+            logging.error('Unable to spool MQTT messages to %s: %s', self.spoolFile, e)
+            self.dropped += len(entries)
+
+    def drainSpool(self):
+        #move the spool out of the way first, messages that fail again are spooled to a new file
+        draining = self.spoolFile + '.draining'
+        os.replace(self.spoolFile, draining)
+        logging.info('Publishing %d bytes of spooled MQTT messages', os.path.getsize(draining))
+
+        with open(draining) as fp:
+            entries = []
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                    if len(entry) > 4 and entry[4] == 'base64':
+                        entry = [entry[0], base64.b64decode(entry[1]), entry[2], entry[3]]
+                    entries.append(entry)
+                except (ValueError, TypeError):
+                    #a line cut off by a crash
+                    continue
+
+        for i, (topic, payload, retain, submitted) in enumerate(entries):
+            if not self.send(topic, payload, retain, submitted):
+                self.spool(entries[i:])
+                break
+        os.remove(draining)
+
+    def getStats(self):
+        with self.condition:
+            return {
+                'queue': len(self.queue),
+                'inflight': len(self.inflight),
+                'published': self.published,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+                'spooled': self.spooled,
+                'spoolBytes': os.path.getsize(self.spoolFile) if self.hasSpool() else 0,
+                'latencyLast': round(self.latencyLast * 1000, 1),
+                'latencyAvg': round(self.latencyTotal * 1000 / self.published, 1) if self.published else 0.0,
+                'latencyMax': round(self.latencyMax * 1000, 1),
+            }
+
+
+class ChangeFilter(object):
+    """
+    Remembers the values last published for one inverter and tells which of the new
+    values changed by more than their deadband. Every keyframeInterval ms all values
+    are published again, so a subscriber that missed a change catches up.
+    """
+
+    IGNORE = ('timestamp', 'requestTime', 'responseTime')        #change on every sample, sent along with the changes instead
+
+    def __init__(self, deadbands = None, keyframeInterval = 300000):
+        self.deadbands = deadbands or {}
+        self.keyframeInterval = keyframeInterval
+        self.last = None
+        self.lastKeyframe = 0
+        self.online = None
+
+    def changes(self, values, now):
+        """
+        Returns (keyframe, changed values). On a keyframe all values are returned.
+        """
+        if self.last is None or now - self.lastKeyframe >= self.keyframeInterval:
+            self.last = dict((name, list(value) if isinstance(value, list) else value) for name, value in values.items())
+            self.lastKeyframe = now
+            return True, values
+
+        changed = {}
+        last = self.last
+        for name, value in values.items():
+            previous = last.get(name)
+            if value == previous or name in self.IGNORE:
+                continue
+            #compare against the published value, so a slow drift is published once it exceeds the deadband
+            deadband = self.deadbands.get(name)
+            if deadband and isinstance(value, (int, float)) and isinstance(previous, (int, float)) and abs(value - previous) < deadband:
+                continue
+            changed[name] = value
+            last[name] = list(value) if isinstance(value, list) else value
+        return False, changed
+
+    def onlineChanged(self, online):
+        if online == self.online:
+            return False
+        self.online = online
+        return True
+
+    def forceKeyframe(self):
+        self.last = None
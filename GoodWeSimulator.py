@@ -0,0 +1,281 @@
+#!/usr/bin/python -tt
+"""
+Software GoodWe inverters, so the daemon and the protocol stack run without hardware.
+
+A SimulatedInverter answers discovery (FC_OFFLINE -> FC_REGREQ), address
+allocation (FC_ALLOCREG -> FC_ADDCONF), removal (FC_REMREG -> FC_REMCONF),
+running info queries (FC_QRYRUN -> FC_RESRUN) in the single or three
+phase layout and the ID and setting queries (FC_QRYID, FC_QRYSTT).
+Responses are delivered after a configurable latency over a
+SOCK_SEQPACKET socketpair, which keeps the report boundaries of a hidraw
+device, optionally with garbage bytes, crc errors and dropped responses.
+
+Run this module to load test the communicator state machine:
+
+usage: GoodWeSimulator.py [-n INVERTERS] [-d SECONDS] [--latency MS] ...
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import heapq
+import logging
+import math
+import random
+import socket
+import threading
+import time
+
+import GoodWeCommunicator as goodwe
+
+
+def buildFrame(src, dst, controlCode, functionCode, data = b''):
+    frame = bytearray([0xAA, 0x55, src, dst, controlCode, functionCode, len(data)]) + data
+    crc = sum(frame)
+    frame += bytearray([(crc >> 8) & 0xff, crc & 0xff])
+    return bytes(frame)
+
+
+class SimulatedInverter(object):
+
+    PEAK_POWER = 3000            #W at noon
+
+    def __init__(self, serial, threePhase = False, latency = 50, garbage = 0, crcErrors = 0.0, dropouts = 0.0, reportSize = 64):
+        self.serial = serial.encode('ascii')[:16].ljust(16, b' ')
+        self.threePhase = threePhase
+        self.latency = latency            #ms between request and response
+        self.garbage = garbage            #random bytes sent before every response
+        self.crcErrors = crcErrors        #fraction of responses with a corrupted byte
+        self.dropouts = dropouts        #fraction of responses that are never sent
+        self.reportSize = reportSize    #responses are split in reports of this size
+        self.address = None                #allocated address, None while unregistered
+        self.eTotal = 18000.0
+        self.hTotal = 20000
+        self.random = random.Random(serial)
+
+    def respond(self, frame):
+        #frame starts with the 0xAA 0x55 header, returns the response frames
+        if len(frame) < 9 or frame[0:2] != b'\xAA\x55':
+            return []
+        src, dst, controlCode, functionCode, length = bytearray(frame[2:7])
+        data = frame[7:7 + length]
+
+        if controlCode == goodwe.CC_REG:
+            if functionCode == goodwe.FC_OFFLINE and self.address is None:
+                return [buildFrame(0x7F, src, goodwe.CC_REG, goodwe.FC_REGREQ, self.serial)]
+            if functionCode == goodwe.FC_ALLOCREG and len(data) == 17 and data[0:16] == self.serial:
+                self.address = bytearray(data)[16]
+                return [buildFrame(self.address, src, goodwe.CC_REG, goodwe.FC_ADDCONF)]
+            if functionCode == goodwe.FC_REMREG and dst == self.address:
+                self.address = None
+                return [buildFrame(dst, src, goodwe.CC_REG, goodwe.FC_REMCONF)]
+
+        elif controlCode == goodwe.CC_READ and dst == self.address and self.address is not None:
+            if functionCode == goodwe.FC_QRYRUN:
+                layout = goodwe.RUNNINGINFO_THREEPHASE if self.threePhase else goodwe.RUNNINGINFO_SINGLEPHASE
+                return [buildFrame(self.address, src, goodwe.CC_READ, goodwe.FC_RESRUN, layout.encode(self.runningInfo()))]
+            if functionCode == goodwe.FC_QRYID:
+                model = b'GW10K-DT' if self.threePhase else b'GW3000-SS'
+                return [buildFrame(self.address, src, goodwe.CC_READ, goodwe.FC_RESID, goodwe.IDINFO.pack(
+                    b'01.00', model.ljust(10), b'GOODWE'.ljust(16), self.serial, b'3600', b'410-00000-00', 0x02))]
+            if functionCode == goodwe.FC_QRYSTT:
+                return [buildFrame(self.address, src, goodwe.CC_READ, goodwe.FC_RESSTT, goodwe.SETTINGINFO.pack(1000, 60, 1840, 2640, 4750, 5150))]
+
+        return []
+
+    def runningInfo(self):
+        #a clear day: production follows the sun between 6:00 and 18:00
+        now = time.localtime()
+        hour = now.tm_hour + now.tm_min / 60.0 + now.tm_sec / 3600.0
+        sun = max(0.0, math.sin(math.pi * (hour - 6) / 12))
+        noise = 1 + self.random.uniform(-0.02, 0.02)
+
+        runningInfo = goodwe.RunningInfo()
+        runningInfo.pac = int(self.PEAK_POWER * sun * noise)
+        runningInfo.workMode = 1 if runningInfo.pac > 0 else 0
+        runningInfo.vpv1 = round(300 * min(1.0, sun * 4) * noise, 1)
+        runningInfo.vpv2 = round(290 * min(1.0, sun * 4) * noise, 1)
+        runningInfo.ipv1 = round(runningInfo.pac / 2.0 / runningInfo.vpv1, 1) if runningInfo.vpv1 else 0.0
+        runningInfo.ipv2 = round(runningInfo.pac / 2.0 / runningInfo.vpv2, 1) if runningInfo.vpv2 else 0.0
+        phases = 3 if self.threePhase else 1
+        for phase in range(1, phases + 1):
+            setattr(runningInfo, 'vac%d' % phase, round(230 * noise, 1))
+            setattr(runningInfo, 'iac%d' % phase, round(runningInfo.pac / 230.0 / phases, 1))
+            setattr(runningInfo, 'fac%d' % phase, round(50 * (1 + self.random.uniform(-0.001, 0.001)), 2))
+        runningInfo.temp = round(25 + 20 * sun, 1)
+        runningInfo.errorMessage = []
+        runningInfo.eDay = round(self.PEAK_POWER * 7.6 / 1000 * (1 - math.cos(math.pi * min(max(hour - 6, 0), 12) / 12)) / 2, 1)
+        runningInfo.eTotal = self.eTotal + runningInfo.eDay
+        runningInfo.hTotal = self.hTotal
+        return runningInfo
+
+
+class Scheduler(threading.Thread):
+    """
+    Delivers the responses of all simulated inverters at their due time from one thread.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name = 'GoodWeSimulator')
+        self.daemon = True
+        self.queue = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.start()
+
+    def send(self, due, sock, reports):
+        with self.condition:
+            heapq.heappush(self.queue, (due, self.sequence, sock, reports))
+            self.sequence += 1
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] > time.time():
+                    self.condition.wait(self.queue[0][0] - time.time() if self.queue else None)
+                due, sequence, sock, reports = heapq.heappop(self.queue)
+
+            for report in reports:
+                try:
+                    sock.send(report)
+                except (IOError, OSError):
+                    #transport closed or the communicator is not reading, a real device drops reports too
+                    break
+
+
+class SimulatedTransport(object):
+
+    def __init__(self, inverter, scheduler):
+        self.inverter = inverter
+        self.scheduler = scheduler
+        self.sock, self.remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.setblocking(False)
+        self.remote.setblocking(False)
+        self.lastWrite = 0.0        #time of the last request, to measure the response latency
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self):
+        try:
+            return self.sock.recv(self.inverter.reportSize)
+        except BlockingIOError:
+            return None
+
+    def write(self, report):
+        #strip the 0xCC 0x99 length USB header
+        report = bytes(report)
+        if report[0:2] != b'\xCC\x99':
+            return
+        self.lastWrite = time.time()
+
+        inverter = self.inverter
+        for response in inverter.respond(report[3:3 + bytearray(report)[2]]):
+            if inverter.random.random() < inverter.dropouts:
+                continue
+            if inverter.random.random() < inverter.crcErrors:
+                response = bytearray(response)
+                response[7] ^= 0xFF
+                response = bytes(response)
+            if inverter.garbage:
+                response = bytes(bytearray(inverter.random.randrange(256) for i in range(inverter.garbage))) + response
+            reports = [response[i:i + inverter.reportSize] for i in range(0, len(response), inverter.reportSize)]
+            self.scheduler.send(self.lastWrite + inverter.latency / 1000.0, self.remote, reports)
+
+    def close(self):
+        self.sock.close()
+        self.remote.close()
+
+
+class Simulator(object):
+    """
+    Transport factory for GoodWeCommunicator: every device name gets its own inverter,
+    which stays registered over transport reopens like a real one.
+    """
+
+    def __init__(self, latency = 50, garbage = 0, crcErrors = 0.0, dropouts = 0.0, reportSize = 64):
+        self.options = dict(latency = latency, garbage = garbage, crcErrors = crcErrors, dropouts = dropouts, reportSize = reportSize)
+        self.inverters = {}
+        self.scheduler = Scheduler()
+
+    def open(self, device):
+        inverter = self.inverters.get(device)
+        if inverter is None:
+            #alternate single and three phase inverters
+            index = len(self.inverters)
+            inverter = SimulatedInverter('SIM%013d' % index, threePhase = index % 2 == 1, **self.options)
+            self.inverters[device] = inverter
+        return SimulatedTransport(inverter, self.scheduler)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Load test the GoodWe communicator against simulated inverters.')
+    parser.add_argument('-n', '--inverters', type = int, default = 10)
+    parser.add_argument('-d', '--duration', type = float, default = 30, help = 'seconds')
+    parser.add_argument('--pollmin', type = int, default = goodwe.GoodWeCommunicator.POLL_MIN, help = 'poll interval in ms while producing')
+    parser.add_argument('--pollmax', type = int, default = goodwe.GoodWeCommunicator.POLL_MAX, help = 'poll interval in ms while idle')
+    parser.add_argument('--noalign', action = 'store_true', help = 'poll pollmin ms after the last query instead of on the wall clock grid')
+    parser.add_argument('--latency', type = int, default = 50, help = 'inverter response time in ms')
+    parser.add_argument('--garbage', type = int, default = 0, help = 'garbage bytes before every response')
+    parser.add_argument('--crcerrors', type = float, default = 0.0, help = 'fraction of responses with a crc error')
+    parser.add_argument('--dropouts', type = float, default = 0.0, help = 'fraction of responses never sent')
+    parser.add_argument('--loglevel', default = 'WARNING')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)-15s %(funcName)s(%(lineno)d) - %(levelname)s: %(message)s', level = getattr(logging, args.loglevel.upper()))
+
+    simulator = Simulator(args.latency, args.garbage, args.crcerrors, args.dropouts)
+    loop = goodwe.CommunicatorLoop()
+    latencies = []
+    firstSample = {}
+
+    def onRunningInfo(inverter, gw):
+        latencies.append(time.time() - gw.transport.lastWrite)
+        firstSample.setdefault(gw, time.time())
+
+    for i in range(args.inverters):
+        device = 'sim%d' % i
+        gw = goodwe.GoodWeCommunicator(logging, None, None, device, simulator.open)
+        gw.pollMin = args.pollmin
+        gw.pollMax = args.pollmax
+        gw.pollAlign = not args.noalign
+        gw.onRunningInfo = lambda inverter, gw = gw: onRunningInfo(inverter, gw)
+        loop.add(device, gw)
+
+    started = time.time()
+    cpu = time.process_time()
+    while time.time() - started < args.duration:
+        loop.poll((started + args.duration - time.time()) * 1000)
+    elapsed = time.time() - started
+    cpu = time.process_time() - cpu
+
+    running = sum(1 for gw in loop.communicators.values() if gw.state == goodwe.State.RUNNING)
+    crcErrors = sum(gw.frameBuffer.crcErrors for gw in loop.communicators.values())
+    timeouts = sum(gw.queryTimeouts for gw in loop.communicators.values())
+    jitterCount = sum(gw.pollJitter.count for gw in loop.communicators.values())
+    jitterAvg = 1000.0 * sum(gw.pollJitter.sum for gw in loop.communicators.values()) / jitterCount if jitterCount else 0.0
+    jitterMax = max([gw.pollJitterMax for gw in loop.communicators.values()] or [0])
+    loop.close()
+
+    latencies.sort()
+    startup = sorted(t - started for t in firstSample.values())
+    print("%d inverters, %d running, %d samples in %.1f s (%.1f samples/s), %d crc errors" % (
+        args.inverters, running, len(latencies), elapsed, len(latencies) / elapsed, crcErrors))
+    print("latency ms: p50 %.1f p95 %.1f p99 %.1f max %.1f" % (percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000,
+                                                           percentile(latencies, 0.99) * 1000, (latencies[-1] if latencies else 0) * 1000))
+    print("query timeouts: %d" % timeouts)
+    print("poll jitter ms: avg %.1f max %d" % (jitterAvg, jitterMax))
+    print("first sample s: p50 %.2f max %.2f" % (percentile(startup, 0.5), startup[-1] if startup else 0))
+    print("cpu: %.2f s (%.1f%%)" % (cpu, 100.0 * cpu / elapsed))
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
@@ -0,0 +1,375 @@
+#!/usr/bin/python -tt
+"""
+Output stages for every running info sample, next to the MQTT Publisher.
+
+Every Sink has its own thread, bounded queue, batch size and flush
+interval. submit() only appends to the queue, so a slow or unreachable
+database never delays the inverter loop or the other sinks. A full queue
+drops the oldest sample, a failed write is logged and retried with the
+next batch after a growing delay.
+
+    InfluxSink      InfluxDB line protocol over UDP or HTTP
+    CsvSink         a CSV file per inverter and day
+    ParquetSink     a Parquet file per inverter and flush, needs pyarrow
+    HttpSink        POSTs the samples as GoodWeBatch documents
+
+Run this module to send the samples of simulated inverters to sinks, e.g.
+a local UDP listener or a directory:
+
+usage: GoodWeSinks.py [--influx URL] [--csv DIR] [--parquet DIR] [--http URL] [-d SECONDS]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import collections
+import importlib.util
+import logging
+import os
+import socket
+import threading
+import time
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+import GoodWeBatch as batch
+import GoodWeCommunicator as goodwe
+
+# the measured values of a running info, in the order of the JSON document
+FIELDS = tuple(name for name, kind in goodwe.RunningInfo.JSON_FIELDS if name not in ('function', 'timestamp', 'requestTime', 'responseTime'))
+
+
+def hasParquet():
+    #without importing pyarrow, which takes long
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def post(url, body, headers):
+    #urllib.request pulls in http.client, email and ssl, only the HTTP sinks need them
+    try:
+        from urllib.request import Request, urlopen
+    except ImportError:
+        from urllib2 import Request, urlopen
+    urlopen(Request(url, body, headers), timeout = 10).close()
+
+
+def sampleValues(runningInfo):
+    #field values of a sample, the error bits as one integer like the inverter sends them
+    values = [getattr(runningInfo, name) for name in FIELDS]
+    values[FIELDS.index('errorMessage')] = sum(1 << bit for bit in runningInfo.errorMessage)
+    return values
+
+
+class Sink(threading.Thread):
+
+    MAX_RETRY_WAIT = 300000        #ms between attempts to write to a sink that keeps failing
+
+    def __init__(self, name, maxQueue = 10000, batchSize = 100, flushInterval = 10000):
+        threading.Thread.__init__(self, name = 'GoodWeSink-' + name)
+        self.daemon = True
+        self.sinkName = name
+        self.maxQueue = maxQueue
+        self.batchSize = batchSize            #write as soon as this many samples are queued
+        self.flushInterval = flushInterval    #or when the oldest one waited this many ms
+
+        self.queue = collections.deque()    #(serial, running info)
+        self.condition = threading.Condition()
+        self.running = True
+        self.retryWait = 0                    #ms to wait after a failed write, 0 while the sink works
+
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.lastError = ""
+
+    def submit(self, serial, runningInfo):
+        """
+        Queue a sample, never blocks. The running info must not be changed afterwards,
+        the communicator decodes every sample into a new one.
+        """
+        with self.condition:
+            if len(self.queue) >= self.maxQueue:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append((serial, runningInfo))
+            if len(self.queue) >= self.batchSize:
+                self.condition.notify()
+
+    def stop(self, timeout = 5.0):
+        #write what is left and close the sink
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.join(timeout)
+
+    def run(self):
+        while True:
+            with self.condition:
+                deadline = time.time() + (self.retryWait or self.flushInterval) / 1000.0
+                while self.running and (len(self.queue) < self.batchSize or self.retryWait) and time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+                #the samples are taken out of the queue while they are written, submit keeps dropping from the front
+                samples = list(self.queue)
+                self.queue.clear()
+                running = self.running
+                if not running and not samples:
+                    break
+
+            if samples:
+                try:
+                    self.write(samples)
+                except Exception as e:
+                    #put the samples back in front of the ones queued during the write and try again later,
+                    #the queue bounds what is kept
+                    with self.condition:
+                        self.queue.extendleft(reversed(samples))
+                        while len(self.queue) > self.maxQueue:
+                            self.queue.popleft()
+                            self.dropped += 1
+                    if not self.retryWait:
+                        logging.error('Unable to write to the %s sink: %s', self.sinkName, e)
+                    self.errors += 1
+                    self.lastError = str(e)
+                    self.retryWait = min(self.MAX_RETRY_WAIT, max(self.flushInterval, self.retryWait * 2))
+                    if not running:
+                        break
+                    continue
+
+                with self.condition:
+                    self.written += len(samples)
+                if self.retryWait:
+                    logging.info('Writing to the %s sink again', self.sinkName)
+                    self.retryWait = 0
+
+        try:
+            self.close()
+        except Exception as e:
+            logging.error('Unable to close the %s sink: %s', self.sinkName, e)
+
+    def write(self, samples):
+        #write a list of (serial, running info), raise an exception to retry them later
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def getStats(self):
+        with self.condition:
+            return {
+                'queue': len(self.queue),
+                'written': self.written,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'failing': bool(self.retryWait),
+                'lastError': self.lastError,
+            }
+
+
+def escapeTag(value):
+    return value.replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+class InfluxSink(Sink):
+    """
+    udp://host:port for the UDP listener of InfluxDB 1.x, otherwise the complete write URL, e.g.
+    http://host:8086/write?db=solar or http://host:8086/api/v2/write?org=home&bucket=solar with a token.
+    """
+
+    MAX_DATAGRAM = 1400            #bytes, stay below the usual MTU
+
+    def __init__(self, url, measurement = 'goodwe', token = None, **options):
+        Sink.__init__(self, 'influx', **options)
+        self.url = url
+        self.measurement = escapeTag(measurement)
+        self.token = token
+        self.socket = None
+        parsed = urlparse(url)
+        if parsed.scheme == 'udp':
+            self.address = (parsed.hostname, parsed.port or 8089)
+            self.socket = socket.socket(socket.AF_INET6 if ':' in parsed.hostname else socket.AF_INET, socket.SOCK_DGRAM)
+        elif parsed.scheme not in ('http', 'https'):
+            raise ValueError('Invalid InfluxDB url: %s' % url)
+        #integers are marked as such, or InfluxDB refuses floats for the same field later
+        self.formats = tuple('%s=%%di' % name if kind == 'int' else '%s=%%r' % name
+                             for name, kind in zip(FIELDS, self.fieldKinds()))
+
+    def fieldKinds(self):
+        #the decoders keep the values without a scale as integers, fields they don't set keep their default
+        scales = dict(goodwe.RUNNINGINFO_SINGLEPHASE.fields + goodwe.RUNNINGINFO_THREEPHASE.fields)
+        defaults = goodwe.RunningInfo()
+        return ['int' if name == 'errorMessage' or (name in scales and not scales[name]) or
+                (name not in scales and isinstance(getattr(defaults, name), int)) else 'float' for name in FIELDS]
+
+    def formatLine(self, serial, runningInfo):
+        fields = ','.join(format % value for format, value in zip(self.formats, sampleValues(runningInfo)))
+        return '%s,serial=%s %s %d' % (self.measurement, escapeTag(serial.strip()), fields, runningInfo.responseTime * 1000000)
+
+    def write(self, samples):
+        lines = [self.formatLine(serial, runningInfo) for serial, runningInfo in samples]
+        if self.socket is not None:
+            datagram = []
+            size = 0
+            for line in lines:
+                if datagram and size + len(line) + 1 > self.MAX_DATAGRAM:
+                    self.socket.sendto('\n'.join(datagram).encode('utf-8'), self.address)
+                    datagram = []
+                    size = 0
+                datagram.append(line)
+                size += len(line) + 1
+            if datagram:
+                self.socket.sendto('\n'.join(datagram).encode('utf-8'), self.address)
+            return
+
+        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if self.token:
+            headers['Authorization'] = 'Token ' + self.token
+        post(self.url, '\n'.join(lines).encode('utf-8'), headers)
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+
+
+class CsvSink(Sink):
+    """
+    <path>/<serial>-YYYYMMDD.csv with the time in ms since the epoch and the fields, a new file every day.
+    """
+
+    def __init__(self, path, **options):
+        Sink.__init__(self, 'csv', **options)
+        self.path = path
+        self.header = 'time,' + ','.join(FIELDS) + '\n'
+
+    def write(self, samples):
+        files = {}
+        for serial, runningInfo in samples:
+            fileName = os.path.join(self.path, '%s-%s.csv' % (serial.strip(), time.strftime('%Y%m%d', time.localtime(runningInfo.responseTime // 1000))))
+            lines = files.get(fileName)
+            if lines is None:
+                lines = files[fileName] = []
+            lines.append('%d,%s\n' % (runningInfo.responseTime, ','.join(map(str, sampleValues(runningInfo)))))
+
+        for fileName, lines in files.items():
+            exists = os.path.exists(fileName)
+            with open(fileName, 'a') as fp:
+                if not exists:
+                    fp.write(self.header)
+                fp.writelines(lines)
+
+
+class ParquetSink(Sink):
+    """
+    <path>/<serial>-YYYYMMDDTHHMMSS.parquet for every flush, named after its first sample.
+    Parquet files can't be appended to, so use a large batch size and flush interval.
+    """
+
+    def __init__(self, path, **options):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError('The parquet sink needs the pyarrow package')
+        Sink.__init__(self, 'parquet', **options)
+        self.path = path
+        self.pyarrow = pyarrow
+
+    def write(self, samples):
+        pyarrow = self.pyarrow
+        serials = collections.OrderedDict()
+        for serial, runningInfo in samples:
+            serials.setdefault(serial.strip(), []).append(runningInfo)
+
+        for serial, runningInfos in serials.items():
+            columns = list(zip(*[sampleValues(runningInfo) for runningInfo in runningInfos]))
+            arrays = [pyarrow.array([runningInfo.responseTime for runningInfo in runningInfos], pyarrow.timestamp('ms', 'UTC'))]
+            arrays.extend(pyarrow.array(column) for column in columns)
+            table = pyarrow.Table.from_arrays(arrays, ['time'] + list(FIELDS))
+            fileName = os.path.join(self.path, '%s-%s.parquet' % (serial, time.strftime('%Y%m%dT%H%M%S', time.localtime(runningInfos[0].responseTime // 1000))))
+            pyarrow.parquet.write_table(table, fileName + '.tmp')
+            os.rename(fileName + '.tmp', fileName)
+
+
+class HttpSink(Sink):
+    """
+    POSTs a JSON list with a GoodWeBatch document for every inverter in the batch.
+    """
+
+    def __init__(self, url, token = None, **options):
+        Sink.__init__(self, 'http', **options)
+        self.url = url
+        self.token = token
+
+    def write(self, samples):
+        batches = collections.OrderedDict()
+        for serial, runningInfo in samples:
+            sampleBatch = batches.get(serial)
+            if sampleBatch is None:
+                sampleBatch = batches[serial] = batch.SampleBatch(serial.strip(), len(samples))
+            sampleBatch.add(runningInfo.responseTime, dict(zip(FIELDS, sampleValues(runningInfo))))
+
+        body = '[' + ','.join(sampleBatch.encode('json') for sampleBatch in batches.values()) + ']'
+        headers = {'Content-Type': 'application/json'}
+        if self.token:
+            headers['Authorization'] = 'Bearer ' + self.token
+        post(self.url, body.encode('utf-8'), headers)
+
+
+# config section -> sink class, constructed with the url or path and the options
+SINKS = collections.OrderedDict([('influx', InfluxSink), ('csv', CsvSink), ('parquet', ParquetSink), ('http', HttpSink)])
+
+
+def main():
+    import argparse
+    import GoodWeSimulator
+
+    parser = argparse.ArgumentParser(description = 'Send the samples of simulated inverters to sinks.')
+    parser.add_argument('--influx', help = 'udp://host:port or InfluxDB write url')
+    parser.add_argument('--csv', help = 'directory')
+    parser.add_argument('--parquet', help = 'directory')
+    parser.add_argument('--http', help = 'url')
+    parser.add_argument('-n', '--inverters', type = int, default = 2)
+    parser.add_argument('-d', '--duration', type = float, default = 10, help = 'seconds')
+    parser.add_argument('--batchsize', type = int, default = 10)
+    parser.add_argument('--flushinterval', type = int, default = 5000, help = 'ms')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)-15s %(funcName)s(%(lineno)d) - %(levelname)s: %(message)s', level = logging.INFO)
+
+    options = dict(batchSize = args.batchsize, flushInterval = args.flushinterval)
+    sinks = []
+    if args.influx:
+        sinks.append(InfluxSink(args.influx, **options))
+    if args.csv:
+        sinks.append(CsvSink(args.csv, **options))
+    if args.parquet:
+        sinks.append(ParquetSink(args.parquet, **options))
+    if args.http:
+        sinks.append(HttpSink(args.http, **options))
+    for sink in sinks:
+        sink.start()
+
+    def onRunningInfo(inverter):
+        for sink in sinks:
+            sink.submit(inverter.serial, inverter.runningInfo)
+
+    simulator = GoodWeSimulator.Simulator()
+    loop = goodwe.CommunicatorLoop()
+    for i in range(args.inverters):
+        gw = goodwe.GoodWeCommunicator(logging, None, None, 'sim%d' % i, simulator.open)
+        gw.resetWait = 0
+        gw.onRunningInfo = onRunningInfo
+        loop.add('sim%d' % i, gw)
+
+    started = time.time()
+    while time.time() - started < args.duration:
+        loop.poll((started + args.duration - time.time()) * 1000)
+    loop.close()
+
+    for sink in sinks:
+        sink.stop()
+        print(sink.sinkName, sink.getStats())
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
@@ -0,0 +1,310 @@
+#!/usr/bin/python -tt
+"""
+Local time series store of the running info samples, so a broker outage does not leave a gap.
+
+Every inverter gets its own files in the store directory:
+- <serial>-raw-YYYYMMDD.dat    every sample of a day
+- <serial>-1m-YYYYMM.dat        1 minute rollups of a month
+- <serial>-15m-YYYY.dat        15 minute rollups of a year
+- <serial>-1d.dat                daily rollups
+
+A file starts with an 8 byte magic, followed by fixed size little endian
+records ordered by time: raw records are the timestamp in milliseconds
+since the epoch and the sample in the three phase running info frame
+layout, rollup records hold the mean of the measurements over the window,
+the pac range and the last energy counters. Files are only appended to,
+in large chunks every flush interval to spare the SD card, and memory
+mapped for queries. Whole files are removed when they pass the retention.
+
+usage: GoodWeStore.py <directory> [serial] [--from TIME] [--to TIME] [--resolution raw|1m|15m|1d]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import datetime
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+
+import GoodWeCommunicator as goodwe
+
+RAW_MAGIC = b'GWRAW001'
+ROLLUP_MAGIC = b'GWRUP001'
+
+LAYOUT = goodwe.RUNNINGINFO_THREEPHASE        #holds every field of both inverter types
+RAW = struct.Struct('<q' + LAYOUT.struct.format[1:].replace('>', ''))
+
+# measurements averaged over a rollup window
+MEAN_FIELDS = ('vpv1', 'vpv2', 'ipv1', 'ipv2', 'vac1', 'vac2', 'vac3', 'iac1', 'iac2', 'iac3', 'fac1', 'fac2', 'fac3', 'pac', 'temp')
+# window start, sample count, means, pac min and max, last eTotal, max eDay, last hTotal, all error bits seen
+ROLLUP = struct.Struct('<qI' + 'f' * len(MEAN_FIELDS) + 'ffddII')
+ROLLUP_NAMES = ('time', 'count') + MEAN_FIELDS + ('pacMin', 'pacMax', 'eTotal', 'eDay', 'hTotal', 'errorMessage')
+
+RESOLUTIONS = ('raw', '1m', '15m', '1d')
+FILE_PATTERN = re.compile(r'^(?P<serial>.+)-(?P<resolution>raw|1m|15m|1d)(-(?P<period>\d+))?\.dat$')
+
+millis = lambda: int(round(time.time() * 1000))
+
+
+def windowStart(resolution, timestamp):
+    #start of the rollup window a timestamp in ms falls in, days follow the local time
+    if resolution == '1m':
+        return timestamp - timestamp % 60000
+    if resolution == '15m':
+        return timestamp - timestamp % 900000
+    day = datetime.date.fromtimestamp(timestamp / 1000.0)
+    return int(time.mktime(day.timetuple())) * 1000
+
+
+def fileName(serial, resolution, timestamp):
+    day = datetime.date.fromtimestamp(timestamp / 1000.0)
+    if resolution == 'raw':
+        return '%s-raw-%s.dat' % (serial, day.strftime('%Y%m%d'))
+    if resolution == '1m':
+        return '%s-1m-%s.dat' % (serial, day.strftime('%Y%m'))
+    if resolution == '15m':
+        return '%s-15m-%s.dat' % (serial, day.strftime('%Y'))
+    return '%s-1d.dat' % serial
+
+
+def periodEnd(resolution, period):
+    #first day after the period in a file name, for the retention
+    if resolution == 'raw':
+        return datetime.datetime.strptime(period, '%Y%m%d').date() + datetime.timedelta(days = 1)
+    if resolution == '1m':
+        start = datetime.datetime.strptime(period, '%Y%m').date()
+        return (start + datetime.timedelta(days = 32)).replace(day = 1)
+    return datetime.date(int(period) + 1, 1, 1)
+
+
+class Rollup(object):
+    """
+    Accumulates the samples of one rollup window.
+    """
+
+    __slots__ = ('start', 'count', 'sums', 'pacMin', 'pacMax', 'eTotal', 'eDay', 'hTotal', 'errors')
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.sums = [0.0] * len(MEAN_FIELDS)
+        self.pacMin = None
+        self.pacMax = None
+        self.eTotal = 0.0
+        self.eDay = 0.0
+        self.hTotal = 0
+        self.errors = 0
+
+    def add(self, runningInfo, errors):
+        sums = self.sums
+        for i, name in enumerate(MEAN_FIELDS):
+            sums[i] += getattr(runningInfo, name)
+        pac = runningInfo.pac
+        self.pacMin = pac if self.pacMin is None else min(self.pacMin, pac)
+        self.pacMax = pac if self.pacMax is None else max(self.pacMax, pac)
+        self.eTotal = runningInfo.eTotal
+        self.eDay = max(self.eDay, runningInfo.eDay)
+        self.hTotal = runningInfo.hTotal
+        self.errors |= errors
+        self.count += 1
+
+    def pack(self):
+        means = [value / self.count for value in self.sums]
+        return ROLLUP.pack(self.start, self.count, *(means + [self.pacMin, self.pacMax, self.eTotal, self.eDay, self.hTotal, self.errors]))
+
+
+class Store(object):
+
+    # days to keep the files of every resolution, 0 keeps them forever
+    RETENTION = {'raw': 14, '1m': 366, '15m': 3660, '1d': 0}
+
+    def __init__(self, path, retention = None, maxBytes = 0):
+        self.path = path
+        self.retention = dict(self.RETENTION, **(retention or {}))
+        self.maxBytes = maxBytes            #limit of the total size of the raw files, 0 for no limit
+        self.buffers = {}                    #file name -> records not written yet
+        self.rollups = {}                    #(serial, resolution) -> Rollup of the current window
+        self.lastExpire = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def append(self, serial, runningInfo, timestamp = None):
+        if timestamp is None:
+            timestamp = millis()
+
+        values = [timestamp]
+        errors = 0
+        for name, scale in LAYOUT.fields:
+            value = getattr(runningInfo, name)
+            if name == 'errorMessage':
+                value = errors = sum(1 << bit for bit in value)
+            elif scale:
+                value = int(round(value * scale))
+            values.append(value)
+        self.write(fileName(serial, 'raw', timestamp), RAW_MAGIC, RAW.pack(*values))
+
+        for resolution in ('1m', '15m', '1d'):
+            start = windowStart(resolution, timestamp)
+            rollup = self.rollups.get((serial, resolution))
+            if rollup is not None and rollup.start != start:
+                #the window is complete
+                self.write(fileName(serial, resolution, rollup.start), ROLLUP_MAGIC, rollup.pack())
+                rollup = None
+            if rollup is None:
+                rollup = self.rollups[(serial, resolution)] = Rollup(start)
+            rollup.add(runningInfo, errors)
+
+    def write(self, name, magic, record):
+        buffer = self.buffers.get(name)
+        if buffer is None:
+            buffer = self.buffers[name] = bytearray()
+            if not os.path.exists(os.path.join(self.path, name)):
+                buffer += magic
+        buffer += record
+
+    def flush(self):
+        #one append per file, the only writes the store does
+        buffers, self.buffers = self.buffers, {}
+        for name, buffer in buffers.items():
+            with open(os.path.join(self.path, name), 'ab') as fp:
+                fp.write(buffer)
+
+        today = datetime.date.today()
+        if self.lastExpire != today:
+            self.expire(today)
+            self.lastExpire = today
+
+    def close(self):
+        #incomplete rollup windows are written as they are
+        for (serial, resolution), rollup in self.rollups.items():
+            self.write(fileName(serial, resolution, rollup.start), ROLLUP_MAGIC, rollup.pack())
+        self.rollups = {}
+        self.flush()
+
+    def files(self):
+        #(name, serial, resolution, period) of the store files, oldest period first
+        files = []
+        for name in os.listdir(self.path):
+            match = FILE_PATTERN.match(name)
+            if match:
+                files.append((match.group('period') or '', name, match.group('serial'), match.group('resolution')))
+        return [(name, serial, resolution, period) for period, name, serial, resolution in sorted(files)]
+
+    def expire(self, today):
+        files = self.files()
+        for name, serial, resolution, period in files:
+            days = self.retention.get(resolution)
+            if period and days and periodEnd(resolution, period) + datetime.timedelta(days = days) <= today:
+                os.remove(os.path.join(self.path, name))
+
+        if self.maxBytes:
+            raw = [os.path.join(self.path, name) for name, serial, resolution, period in files
+                   if resolution == 'raw' and period != today.strftime('%Y%m%d') and os.path.exists(os.path.join(self.path, name))]
+            total = sum(os.path.getsize(path) for path in raw)
+            while raw and total > self.maxBytes:
+                path = raw.pop(0)
+                total -= os.path.getsize(path)
+                os.remove(path)
+
+    def serials(self):
+        return sorted(set(serial for name, serial, resolution, period in self.files()))
+
+    def query(self, serial, start, end, resolution = 'raw'):
+        """
+        Yields a dict with the 'time' in ms and the values of every record with start <= time < end.
+        Records still waiting for a flush are not included.
+        """
+        for name, fileSerial, fileResolution, period in self.files():
+            if fileSerial != serial or fileResolution != resolution:
+                continue
+            if period and (periodEnd(resolution, period) <= datetime.date.fromtimestamp(start / 1000.0) or
+                           fileName(serial, resolution, end - 1) < name):
+                continue
+            for record in readRecords(os.path.join(self.path, name), resolution, start, end):
+                yield record
+
+
+def readRecords(path, resolution, start, end):
+    magic, record = (RAW_MAGIC, RAW) if resolution == 'raw' else (ROLLUP_MAGIC, ROLLUP)
+    with open(path, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size < len(magic):
+            return
+        data = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            if data[:len(magic)] != magic:
+                raise ValueError("%s is not a GoodWe store file" % path)
+            #a record cut off by a crash is ignored
+            count = (len(data) - len(magic)) // record.size
+
+            #records are in time order, find the first one in range
+            low, high = 0, count
+            while low < high:
+                middle = (low + high) // 2
+                if struct.unpack_from('<q', data, len(magic) + middle * record.size)[0] < start:
+                    low = middle + 1
+                else:
+                    high = middle
+
+            for i in range(low, count):
+                values = record.unpack_from(data, len(magic) + i * record.size)
+                if values[0] >= end:
+                    break
+                if resolution == 'raw':
+                    runningInfo = LAYOUT.decode(LAYOUT.struct.pack(*values[1:]))
+                    sample = runningInfo.toDict()
+                    del sample['function'], sample['timestamp']
+                    sample['time'] = values[0]
+                else:
+                    #the means are single precision floats
+                    sample = dict(zip(ROLLUP_NAMES, (round(value, 3) if isinstance(value, float) else value for value in values)))
+                    sample['errorMessage'] = [bit for bit in range(32) if sample['errorMessage'] & (1 << bit)]
+                yield sample
+        finally:
+            data.close()
+
+
+def parseTime(value):
+    #epoch seconds, or a local date and time
+    try:
+        return int(float(value) * 1000)
+    except ValueError:
+        pass
+    for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return int(time.mktime(datetime.datetime.strptime(value, format).timetuple())) * 1000
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError("invalid time: %s" % value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Query the local GoodWe sample store.')
+    parser.add_argument('directory')
+    parser.add_argument('serial', nargs = '?', help = 'inverter serial, lists the serials when left out')
+    parser.add_argument('--from', dest = 'start', type = parseTime, help = 'epoch seconds or local "YYYY-MM-DD[ HH:MM[:SS]]", default 24 hours ago')
+    parser.add_argument('--to', dest = 'end', type = parseTime, help = 'default now')
+    parser.add_argument('--resolution', choices = RESOLUTIONS, default = 'raw')
+    args = parser.parse_args()
+
+    store = Store(args.directory)
+    if args.serial is None:
+        for serial in store.serials():
+            print(serial)
+        return 0
+
+    end = args.end if args.end is not None else millis()
+    start = args.start if args.start is not None else end - 86400000
+    names = None
+    for sample in store.query(args.serial, start, end, args.resolution):
+        if names is None:
+            names = ['time'] + sorted(name for name in sample if name != 'time')
+            print(','.join(names))
+        print(','.join(' '.join(map(str, sample[name])) if isinstance(sample[name], list) else str(sample[name]) for name in names))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
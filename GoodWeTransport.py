@@ -0,0 +1,60 @@
+"""
+Transports carry HID reports between a GoodWeCommunicator and an inverter.
+
+A transport is any object with:
+- fileno(): file descriptor that becomes readable when a report arrives
+- read(): the next received report, None when nothing is available
+- write(report): send an output report, starting with the 0xCC 0x99 USB header.
+  The report can be a memoryview of a buffer that is reused after the call.
+- close()
+
+HidrawTransport talks to a real inverter, GoodWeSimulator.SimulatedTransport
+to a software inverter.
+"""
+from __future__ import absolute_import
+import logging
+import os
+
+import hidrawpure as hidraw
+
+
+class HidrawTransport(object):
+    """
+    A hidraw device node on a plain non-blocking fd, one system call per
+    report. Reads ask for the input report size of the report descriptor.
+    Reading into a preallocated buffer with os.readv and writing from a
+    reused one were measured no faster than os.read and os.write of a small
+    bytes object, see the transport benchmark.
+    """
+
+    REPORT_SIZE = hidraw.HIDRAW_BUFFER_SIZE        #a read on a hidraw device returns at most one report
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_NONBLOCK | os.O_CLOEXEC)
+        #the longest input report the device describes, a smaller read would cut reports short
+        self.reportSize = self.REPORT_SIZE
+        try:
+            sizes = hidraw.HIDRaw(self.fd).getReportSizes()
+            if sizes.input > 0:
+                self.reportSize = sizes.input
+        except (IOError, OSError) as e:
+            logging.debug('Unable to read the report descriptor of %s, reading %d bytes: %s', path, self.reportSize, e)
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        try:
+            return os.read(self.fd, self.reportSize) or None
+        except BlockingIOError:
+            return None
+
+    def write(self, report):
+        #report number 0 and the report, what HIDRaw.sendOutputReport sends
+        os.write(self.fd, b'\x00' + report)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
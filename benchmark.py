@@ -0,0 +1,559 @@
+#!/usr/bin/python -tt
+"""
+Benchmarks for the GoodWe protocol handling. Runs without an inverter attached.
+
+Every benchmark reports the median time per operation and the peak
+memory it allocates. Results can be saved as a baseline and compared
+against one. The comparison fails when a benchmark allocates more than
+the threshold above the baseline; allocations are the same on every run.
+Timings are scaled by a calibration loop, so a baseline recorded on one
+machine can be checked on another, but shared CI runners are too noisy
+to fail on them: a slower timing is only reported. The legacy
+implementations are references and are not compared.
+
+The receive path is also benchmarked with the captures in ci/captures of
+a single and a three phase inverter. There was no inverter at hand, so
+they were recorded from GoodWeSimulator with --record: real reports and
+frames as the communicator exchanged them, but synthetic values.
+
+usage: benchmark.py [--capture FILE] [--save FILE] [--compare FILE] [--threshold FRACTION] [--record] [name ...]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import time
+import shutil
+import statistics
+import sys
+import tempfile
+import timeit
+import tracemalloc
+import types
+
+import simplejson as json
+
+import GoodWeCapture
+import GoodWeCommunicator as goodwe
+import GoodWeMetrics
+from GoodWeSimulator import buildFrame
+from GoodWeTransport import HidrawTransport
+
+
+def sampleRunningInfo(threePhase):
+    #a typical running info sample during production hours
+    runningInfo = goodwe.RunningInfo()
+    runningInfo.vpv1 = 312.4
+    runningInfo.vpv2 = 298.7
+    runningInfo.ipv1 = 4.2
+    runningInfo.ipv2 = 3.9
+    runningInfo.vac1 = 231.2
+    runningInfo.iac1 = 10.4
+    runningInfo.fac1 = 50.01
+    if threePhase:
+        runningInfo.vac2 = 230.8
+        runningInfo.vac3 = 232.0
+        runningInfo.iac2 = 10.2
+        runningInfo.iac3 = 10.5
+        runningInfo.fac2 = 50.0
+        runningInfo.fac3 = 49.99
+    runningInfo.pac = 2480
+    runningInfo.workMode = 1
+    runningInfo.temp = 41.3
+    runningInfo.errorMessage = []
+    runningInfo.eTotal = 18734.6
+    runningInfo.hTotal = 21876
+    runningInfo.eDay = 12.7
+    return runningInfo
+
+
+def sampleRunningInfoData(threePhase):
+    layout = goodwe.RUNNINGINFO_THREEPHASE if threePhase else goodwe.RUNNINGINFO_SINGLEPHASE
+    return layout.encode(sampleRunningInfo(threePhase))
+
+
+def legacyDecode(data, dataLength):
+    #the field by field decoder the layouts replaced, kept as reference
+    def bytesToFloat(bt, factor):
+        return float((bt[0] << 8) | bt[1]) / factor
+
+    def bytes4ToFloat(bt, factor):
+        return float((bt[0] << 24) | (bt[1] << 16) | (bt[2] << 8) | bt[3]) / factor
+
+    runningInfo = goodwe.RunningInfo()
+    threePhase = dataLength == 66
+    dtPtr = 0
+    for name in (['vpv1', 'vpv2', 'ipv1', 'ipv2', 'vac1'] + (['vac2', 'vac3'] if threePhase else []) +
+                 ['iac1'] + (['iac2', 'iac3'] if threePhase else [])):
+        setattr(runningInfo, name, bytesToFloat(data[dtPtr:], 10))
+        dtPtr += 2
+    for name in ['fac1'] + (['fac2', 'fac3'] if threePhase else []):
+        setattr(runningInfo, name, bytesToFloat(data[dtPtr:], 100))
+        dtPtr += 2
+    runningInfo.pac = (data[dtPtr] << 8) | (data[dtPtr + 1])
+    dtPtr += 2
+    runningInfo.workMode = (data[dtPtr] << 8) | (data[dtPtr + 1])
+    dtPtr += 2
+    runningInfo.temp = bytesToFloat(data[dtPtr:], 10)
+    dtPtr += 2
+    errorMessage = (data[dtPtr] << 24) | (data[dtPtr + 1] << 16) | (data[dtPtr + 2] << 8) | (data[dtPtr + 3])
+    runningInfo.errorMessage = [i for i, x in enumerate(reversed(bin(errorMessage))) if x == "1"]
+    dtPtr += 4
+    runningInfo.eTotal = bytes4ToFloat(data[dtPtr:], 10)
+    dtPtr += 4
+    runningInfo.hTotal = (data[dtPtr] << 24) | (data[dtPtr + 1] << 16) | (data[dtPtr + 2] << 8) | (data[dtPtr + 3])
+    dtPtr += 4
+    for name in ['tempFault', 'pv1Fault', 'pv2Fault', 'line1VFault'] + (['line2VFault', 'line3VFault'] if threePhase else []):
+        setattr(runningInfo, name, bytesToFloat(data[dtPtr:], 10))
+        dtPtr += 2
+    for name in ['line1FFault'] + (['line2FFault', 'line3FFault'] if threePhase else []):
+        setattr(runningInfo, name, bytesToFloat(data[dtPtr:], 100))
+        dtPtr += 2
+    runningInfo.gcfiFault = (data[dtPtr] << 8) | (data[dtPtr + 1])
+    dtPtr += 2
+    runningInfo.eDay = bytesToFloat(data[dtPtr:], 10)
+    return runningInfo
+
+
+def benchDecode():
+    results = []
+    for threePhase in (False, True):
+        data = sampleRunningInfoData(threePhase)
+        layout = goodwe.getRunningInfoLayout(len(data))
+        #the receive buffer used to be a list, the layouts work on a memoryview of a bytearray
+        dataList = list(data)
+        view = memoryview(bytearray(data))
+        phase = 'threephase' if threePhase else 'singlephase'
+        results.append(('decode legacy ' + phase, lambda dataList = dataList: legacyDecode(dataList, len(dataList))))
+        results.append(('decode layout ' + phase, lambda layout = layout, view = view: layout.decode(view)))
+    return results
+
+
+def sampleInverter(threePhase):
+    inverter = goodwe.Inverter()
+    inverter.serialNumber = list(b'13000SSU11000008')
+    inverter.serial = '13000SSU11000008'
+    inverter.address = goodwe.GoodWeCommunicator.INVERTER_COMMS_ADDRESS
+    inverter.addressConfirmed = True
+    inverter.isOnline = True
+    inverter.inverterType = goodwe.InverterType.THREEPHASE if threePhase else goodwe.InverterType.SINGLEPHASE
+    inverter.runningInfo = sampleRunningInfo(threePhase)
+    return inverter
+
+
+def legacyToJSON(inverter):
+    #the serializer the record encoder replaced: walks plain objects through a callback and sorts every time
+    values = inverter.toDict()
+    legacy = types.SimpleNamespace(**values)
+    legacy.runningInfo = types.SimpleNamespace(**values['runningInfo'])
+    return lambda: json.dumps(legacy, default=lambda o: o.__dict__, sort_keys=True, indent=4)
+
+
+def benchJSON():
+    inverter = sampleInverter(False)
+    legacy = legacyToJSON(inverter)
+    print("payload bytes: legacy %d, indented %d, compact %d" % (len(legacy()), len(inverter.toJSON()), len(inverter.toJSON(True))))
+    return [
+        ('toJSON legacy', legacy),
+        ('toJSON indented', inverter.toJSON),
+        ('toJSON compact', lambda: inverter.toJSON(True)),
+    ]
+
+
+def sampleStream(noisy, count = 100):
+    #what the inverters send: registration requests and running info, optionally with garbage between the frames
+    garbage = bytes(bytearray([0x00, 0xAA, 0x13, 0x55, 0x00, 0xFF, 0xAA, 0x00, 0x55, 0x01]))
+    frames = [
+        buildFrame(0x7F, 0x80, goodwe.CC_REG, goodwe.FC_REGREQ, b'13000SSU11000008'),
+        buildFrame(0x0B, 0x80, goodwe.CC_READ, goodwe.FC_RESRUN, sampleRunningInfoData(False)),
+        buildFrame(0x0B, 0x80, goodwe.CC_READ, goodwe.FC_RESRUN, sampleRunningInfoData(True)),
+    ]
+    stream = bytearray()
+    for i in range(count):
+        if noisy:
+            stream += garbage
+        stream += frames[i % len(frames)]
+    return bytes(stream)
+
+
+def splitReports(stream, size = HidrawTransport.REPORT_SIZE):
+    return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+
+class LegacyFramer(object):
+    #the per byte state machine FrameBuffer replaced, kept as reference
+    def __init__(self):
+        self.inputBuffer = [0] * 96
+        self.startPacketReceived = False
+        self.lastReceivedByte = 0
+        self.curReceivePtr = 0
+        self.numToRead = 0
+        self.frames = 0
+
+    def feed(self, datstr):
+        for incomingData in bytearray(datstr):
+            if self.lastReceivedByte == 0xAA and incomingData == 0x55:
+                self.startPacketReceived = True
+                self.curReceivePtr = 0
+                self.numToRead = 0
+                self.lastReceivedByte = 0x00
+            elif self.startPacketReceived:
+                if self.numToRead > 0 or self.curReceivePtr < 5:
+                    self.inputBuffer[self.curReceivePtr] = incomingData
+                    self.curReceivePtr += 1
+                    if self.curReceivePtr == 5:
+                        self.numToRead = self.inputBuffer[4] + 2
+                    elif self.curReceivePtr > 5:
+                        self.numToRead -= 1
+                if self.curReceivePtr >= 5 and self.numToRead == 0:
+                    self.startPacketReceived = False
+                    self.parse(self.curReceivePtr)
+            self.lastReceivedByte = incomingData
+
+    def parse(self, incomingDataLength):
+        crc = 0xAA + 0x55
+        for cnt in range(0, incomingDataLength - 2):
+            crc += self.inputBuffer[cnt]
+        if ((crc >> 8) & 0xff) == self.inputBuffer[incomingDataLength - 2] and (crc & 0xff) == self.inputBuffer[incomingDataLength - 1]:
+            self.frames += 1
+
+
+def benchFraming():
+    #a header inside the data of a frame that arrives in 8 byte reports must not make the framer skip the frame
+    framer = goodwe.FrameBuffer()
+    frames = 0
+    for report in splitReports(buildFrame(0x0B, 0x80, goodwe.CC_READ, goodwe.FC_RESRUN, b'\x01\xAA\x55\x02' * 8), 8):
+        framer.feed(report)
+        frames += sum(1 for frame in framer.frames())
+    assert frames == 1 and framer.crcErrors == 0 and framer.garbageBytes == 0
+
+    results = []
+    streams = [('clean', splitReports(sampleStream(False))), ('noisy', splitReports(sampleStream(True)))]
+    streams += [(label, receivedReports(capturePath(label))) for label, device in CAPTURES]
+    for label, reports in streams:
+
+        def legacy(reports = reports):
+            framer = LegacyFramer()
+            for report in reports:
+                framer.feed(report)
+            return framer.frames
+
+        def frameBuffer(reports = reports):
+            framer = goodwe.FrameBuffer()
+            frames = 0
+            for report in reports:
+                framer.feed(report)
+                for frame in framer.frames():
+                    frames += 1
+            return frames
+
+        frames = legacy()
+        assert frames == frameBuffer() and frames > 0
+        results.append(('framing legacy ' + label, legacy, frames))
+        results.append(('framing FrameBuffer ' + label, frameBuffer, frames))
+    return results
+
+
+class ReplayTransport(object):
+    #hands out a list of reports and swallows everything that is sent
+    def __init__(self, reports = ()):
+        self.reports = reports
+        self.pos = 0
+
+    def fileno(self):
+        return -1
+
+    def read(self):
+        if self.pos >= len(self.reports):
+            return None
+        self.pos += 1
+        return self.reports[self.pos - 1]
+
+    def write(self, report):
+        pass
+
+    def close(self):
+        pass
+
+
+def sampleCommunicator(reports = ()):
+    #a communicator in the RUNNING state with a registered inverter
+    gw = goodwe.GoodWeCommunicator(logging.getLogger('benchmark'), None, None)
+    gw.transport = ReplayTransport(reports)
+    gw.inverter = sampleInverter(False)
+    gw.setState(goodwe.State.RUNNING)
+    return gw
+
+
+# reports of a capture given with --capture
+CAPTURE_REPORTS = None
+
+# the captures benchmarked by default, and the simulated inverter they are recorded from
+CAPTURE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ci', 'captures')
+CAPTURES = (('singlephase', 'sim0'), ('threephase', 'sim1'))
+
+
+def capturePath(label):
+    return os.path.join(CAPTURE_DIRECTORY, label + '.cap')
+
+
+def receivedReports(path):
+    return [report for timestamp, direction, report in GoodWeCapture.readCapture(path) if direction == GoodWeCapture.RECEIVED]
+
+
+def recordCaptures(samples = 50):
+    #discovery, registration and samples of simulated inverters in 8 byte reports, like the hidraw device
+    import GoodWeSimulator
+    simulator = GoodWeSimulator.Simulator(latency = 5, reportSize = 8)
+    if not os.path.isdir(CAPTURE_DIRECTORY):
+        os.makedirs(CAPTURE_DIRECTORY)
+    for label, device in CAPTURES:
+        path = capturePath(label)
+        if os.path.exists(path):
+            os.remove(path)
+        received = []
+        gw = goodwe.GoodWeCommunicator(logging.getLogger('benchmark'), None, None, device, simulator.open)
+        gw.pollMin = gw.pollMax = 20
+        gw.pollAlign = False
+        gw.onRunningInfo = lambda inverter: received.append(inverter)
+        gw.capture = GoodWeCapture.CaptureWriter(path, 0)
+        loop = goodwe.CommunicatorLoop()
+        loop.add(device, gw)
+        started = time.time()
+        while len(received) < samples and time.time() - started < 30:
+            loop.poll(100)
+        loop.close()
+        gw.capture.close()
+        print("%s: %d samples in %s" % (label, len(received), path))
+
+
+def benchReceive():
+    #the whole receive path: reading the reports, framing, crc, parsing and decoding
+    streams = [('clean', splitReports(sampleStream(False))), ('noisy', splitReports(sampleStream(True)))]
+    streams += [(label, receivedReports(capturePath(label))) for label, device in CAPTURES]
+    if CAPTURE_REPORTS:
+        streams.append(('capture', CAPTURE_REPORTS))
+
+    results = []
+    for label, reports in streams:
+        gw = sampleCommunicator(reports)
+
+        def receive(gw = gw, count = len(reports)):
+            gw.transport.pos = 0
+            while gw.transport.pos < count:
+                gw.checkIncomingData()
+
+        frames = gw.frameBuffer.frameCount
+        receive()
+        frames = gw.frameBuffer.frameCount - frames
+        results.append(('checkIncomingData ' + label, receive, max(1, frames)))
+    return results
+
+
+def benchParse():
+    results = []
+    for threePhase in (False, True):
+        frame = buildFrame(0x0B, 0x80, goodwe.CC_READ, goodwe.FC_RESRUN, sampleRunningInfoData(threePhase))
+        buffer = bytearray(frame)
+        view = memoryview(buffer)
+        phase = 'threephase' if threePhase else 'singlephase'
+
+        def legacyCrc(data = list(buffer), length = len(buffer) - 2):
+            #the byte by byte sum of the original parser
+            crc = 0xAA + 0x55
+            for cnt in range(2, length):
+                crc += data[cnt]
+            return ((crc >> 8) & 0xff) == data[length] and (crc & 0xff) == data[length + 1]
+
+        def crc(buffer = buffer, view = view, end = len(buffer)):
+            return (sum(view[0:end - 2]) & 0xffff) == ((buffer[end - 2] << 8) | buffer[end - 1])
+
+        gw = sampleCommunicator()
+        assert legacyCrc() and crc()
+        results.append(('crc legacy ' + phase, legacyCrc))
+        results.append(('crc sum ' + phase, crc))
+        results.append(('parseIncomingData ' + phase, lambda gw = gw, frame = view[2:]: gw.parseIncomingData(frame)))
+    return results
+
+
+def benchSend():
+    gw = sampleCommunicator()
+    serialNumber = gw.inverter.serialNumber
+    return [
+        ('sendData QRYRUN', lambda: gw.sendData(gw.inverter.address, goodwe.CC_READ, goodwe.FC_QRYRUN, goodwe.NODATA)),
+        ('sendData ALLOCREG', lambda: gw.sendAllocateRegisterAddress(serialNumber, gw.inverter.address)),
+    ]
+
+
+def benchMetrics():
+    #the cost the instrumentation adds to every event on the hot path
+    gw = goodwe.GoodWeCommunicator(None, None, None)
+    histogram = GoodWeMetrics.Histogram()
+
+    def counter():
+        gw.stateTimeouts += 1
+
+    return [
+        ('metrics counter', counter),
+        ('metrics histogram', lambda: histogram.observe(0.042)),
+        ('metrics setState', lambda: gw.setState(goodwe.State.RUNNING)),
+    ]
+
+
+def benchTransport():
+    #whole reports written and read back through a FIFO, the system calls of a hidraw device without one
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'hidraw')
+        os.mkfifo(path)
+        transport = HidrawTransport(path)
+    finally:
+        shutil.rmtree(directory)
+    report = bytes(bytearray(i & 0xff for i in range(transport.reportSize - 1)))
+    readBuffers = (bytearray(transport.reportSize),)
+
+    def roundtrip():
+        transport.write(report)
+        return transport.read()
+
+    #the system calls alone: a new bytes object per report, or a preallocated read buffer, which is no faster for reports this small
+    def read(fd = transport.fd, size = transport.reportSize):
+        os.write(fd, b'\x00' + report)
+        return os.read(fd, size)
+
+    def readv(fd = transport.fd):
+        os.write(fd, b'\x00' + report)
+        return os.readv(fd, readBuffers)
+
+    assert roundtrip() == read() == b'\x00' + report and readv() == transport.reportSize
+    return [
+        ('transport HidrawTransport', roundtrip),
+        ('transport os.read', read),
+        ('transport os.readv', readv),
+    ]
+
+
+BENCHMARKS = {
+    'decode': benchDecode,
+    'framing': benchFraming,
+    'json': benchJSON,
+    'metrics': benchMetrics,
+    'parse': benchParse,
+    'receive': benchReceive,
+    'send': benchSend,
+    'transport': benchTransport,
+}
+
+
+def measure(func, items = 1, repeat = 5):
+    number = 1
+    #scale the number of iterations so a single measurement takes about 0.2 seconds
+    while True:
+        elapsed = timeit.timeit(func, number = number)
+        if elapsed >= 0.2:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(0.2 / elapsed))
+
+    #the median, a single lucky or disturbed repeat doesn't decide
+    return statistics.median(timeit.repeat(func, number = number, repeat = repeat)) / number / items
+
+
+def allocated(func, items = 1):
+    #peak bytes allocated while running func once, per item
+    tracemalloc.start()
+    try:
+        func()
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        func()
+        return max(0, tracemalloc.get_traced_memory()[1] - current) / float(items)
+    finally:
+        tracemalloc.stop()
+
+
+def run(name, func, items = 1, repeat = 5):
+    best = measure(func, items, repeat)
+    peak = allocated(func, items)
+    print("%-40s %10.2f us/op %12.0f ops/s %10.0f B/op" % (name, best * 1e6, 1.0 / best, peak))
+    return best, peak
+
+
+def calibrate():
+    #a fixed pure Python workload, to compare timings of different machines
+    def workload():
+        total = 0
+        for i in range(1000):
+            total += i & 0xff
+        return total
+    return measure(workload, repeat = 10)
+
+
+def compare(results, calibration, baseline, threshold):
+    #names of the benchmarks allocating more than the baseline by more than the threshold. Slower timings, scaled for
+    #the machine, are only reported.
+    scale = calibration / baseline['calibration']
+    regressions = []
+    for name, result in sorted(results.items()):
+        expected = baseline['results'].get(name)
+        if expected is None or 'legacy' in name:
+            continue
+        ratio = result['us'] / (expected['us'] * scale)
+        if ratio > 1 + threshold:
+            print("SLOWER     %-29s %10.2f us/op, baseline %.2f us/op (%+.0f%%)" % (name, result['us'], expected['us'] * scale, (ratio - 1) * 100))
+        #allocations don't depend on the machine, small differences come from the Python version
+        if result['bytes'] > expected['bytes'] * (1 + threshold) + 64:
+            print("REGRESSION %-29s %10d B/op, baseline %d B/op" % (name, result['bytes'], expected['bytes']))
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    global CAPTURE_REPORTS
+
+    parser = argparse.ArgumentParser(description = 'Benchmark the GoodWe protocol stack.')
+    parser.add_argument('names', nargs = '*', help = 'benchmarks to run: %s' % ' '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--capture', help = 'also benchmark the received reports of a capture file')
+    parser.add_argument('--save', help = 'write the results as a baseline')
+    parser.add_argument('--compare', help = 'fail when allocating more than this baseline, report when slower')
+    parser.add_argument('--threshold', type = float, default = 0.25, help = 'allowed increase, default 0.25')
+    parser.add_argument('--record', action = 'store_true', help = 'record the captures in ci/captures again')
+    args = parser.parse_args()
+
+    if args.record:
+        recordCaptures()
+        return 0
+
+    for name in args.names:
+        if name not in BENCHMARKS:
+            print("Unknown benchmark %s, choose from: %s" % (name, " ".join(sorted(BENCHMARKS))))
+            return 2
+    if args.capture:
+        CAPTURE_REPORTS = receivedReports(args.capture)
+
+    calibration = calibrate()
+    results = {}
+    for name in args.names or sorted(BENCHMARKS):
+        for benchmark in BENCHMARKS[name]():
+            best, peak = run(*benchmark)
+            results[benchmark[0]] = {'us': round(best * 1e6, 3), 'bytes': round(peak)}
+    #calibrate before and after, the machine may have been busy during one of them
+    calibration = min(calibration, calibrate())
+    print("%-40s %10.2f us/op" % ('calibration', calibration * 1e6))
+
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump({'calibration': calibration, 'results': results}, fp, indent = 4, sort_keys = True)
+            fp.write('\n')
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        if compare(results, calibration, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,7 +11,6 @@ import struct
 import collections
 import fcntl
 import ioctl_opt
-import binascii
 
 # input.h
 import sys
@@ -65,6 +64,60 @@ HIDRAW_MAX_DEVICES = 64
 HIDRAW_BUFFER_SIZE = 64
 
 DevInfo = collections.namedtuple('DevInfo', ['bustype', 'vendor', 'product'])
+ReportSizes = collections.namedtuple('ReportSizes', ['input', 'output', 'feature'])
+
+# hid.h, short items of a report descriptor: tag, type and size in the prefix byte
+_HID_ITEM_LONG = 0xfe
+_HID_MAIN_INPUT = 0x80
+_HID_MAIN_OUTPUT = 0x90
+_HID_MAIN_FEATURE = 0xb0
+_HID_GLOBAL_REPORT_SIZE = 0x74
+_HID_GLOBAL_REPORT_ID = 0x84
+_HID_GLOBAL_REPORT_COUNT = 0x94
+_HID_GLOBAL_PUSH = 0xa4
+_HID_GLOBAL_POP = 0xb4
+
+def getReportSizes(descriptor):
+    """
+    Returns a ReportSizes instance with the length in bytes of the longest
+    input, output and feature report of a raw report descriptor, including
+    the report number when the device numbers its reports. A read on the
+    hidraw device returns at most the input size.
+    """
+    descriptor = bytearray(descriptor)
+    bits = {}           # (main item, report id) -> bits
+    reportSize = reportCount = reportId = 0
+    stack = []
+    pos = 0
+    while pos < len(descriptor):
+        prefix = descriptor[pos]
+        if prefix == _HID_ITEM_LONG:
+            pos += 3 + (descriptor[pos + 1] if pos + 1 < len(descriptor) else 0)
+            continue
+        size = (0, 1, 2, 4)[prefix & 0x03]
+        value = 0
+        for i, byte in enumerate(descriptor[pos + 1:pos + 1 + size]):
+            value |= byte << (8 * i)
+        pos += 1 + size
+        item = prefix & 0xfc
+        if item == _HID_GLOBAL_REPORT_SIZE:
+            reportSize = value
+        elif item == _HID_GLOBAL_REPORT_COUNT:
+            reportCount = value
+        elif item == _HID_GLOBAL_REPORT_ID:
+            reportId = value
+        elif item == _HID_GLOBAL_PUSH:
+            stack.append((reportSize, reportCount, reportId))
+        elif item == _HID_GLOBAL_POP and stack:
+            reportSize, reportCount, reportId = stack.pop()
+        elif item in (_HID_MAIN_INPUT, _HID_MAIN_OUTPUT, _HID_MAIN_FEATURE):
+            key = (item, reportId)
+            bits[key] = bits.get(key, 0) + reportSize * reportCount
+
+    def longest(main):
+        return max([(count + 7) // 8 + (1 if number else 0)
+                    for (item, number), count in bits.items() if item == main] or [0])
+    return ReportSizes(longest(_HID_MAIN_INPUT), longest(_HID_MAIN_OUTPUT), longest(_HID_MAIN_FEATURE))
 
 class HIDRaw(object):
     """
@@ -91,11 +144,17 @@ class HIDRaw(object):
         self._ioctl(_HIDIOCGRDESCSIZE, size, True)
         descriptor.size = size
         self._ioctl(_HIDIOCGRDESC, descriptor, True)
-        return b''.join(chr(x) for x in descriptor.value[:size.value])
+        return ctypes.string_at(descriptor.value, size.value)
 
     # TODO: decode descriptor into a python object
     #def getReportDescriptor(self):
 
+    def getReportSizes(self):
+        """
+        Returns the ReportSizes of the device, see getReportSizes.
+        """
+        return getReportSizes(self.getRawReportDescriptor())
+
     def getInfo(self):
         """
         Returns a DevInfo instance, a named tuple with the following items:
@@ -130,9 +189,7 @@ class HIDRaw(object):
         """
         Send an output report.
         """
-        length = len(report) + 1
-        buf = ctypes.create_string_buffer(struct.pack("B", report_num) + report, length)
-        self._device.write(buf)
+        self._device.write(struct.pack("B", report_num) + report)
 
 # sendFeatureReport seems to be unused, remove it?
 